@@ -0,0 +1,52 @@
+"""
+measures how many v1 tokens can be parsed per second, compared to the previous split based parser.
+only parsing is measured, signature verification and metadata lookups are excluded.
+run from the repository root: ENVIRONMENT=TEST python -m benchmarks.bench_auth
+"""
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+from time import time
+from uuid import UUID, uuid4
+
+import ujson as json
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from kh_common.auth import _v1parse
+from kh_common.base64 import b64decode, b64encode
+from kh_common.datetime import datetime
+from kh_common.utilities import int_from_bytes, int_to_bytes
+from kh_common.utilities.speed import test
+
+
+load = b'.'.join([
+	b'ed25519',
+	b64encode(int_to_bytes(1)),
+	b64encode(int_to_bytes(int(time() + 86400))),
+	b64encode(int_to_bytes(1234567890)),
+	b64encode(uuid4().bytes),
+	json.dumps({ 'ip': '127.0.0.1', 'email': 'user@example.com' }).encode(),
+])
+content = b64encode(b'1') + b'.' + b64encode(load)
+token = (content + b'.' + b64encode(Ed25519PrivateKey.generate().sign(content))).decode()
+
+
+def split_parse() :
+	# the parser _v1parse replaced
+	content, signature = token.rsplit('.', 1)
+	load = b64decode(content[content.find('.')+1:])
+	algorithm, key_id, expires, user_id, guid, data = load.split(b'.', 5)
+	algorithm = algorithm.decode()
+	key_id = int_from_bytes(b64decode(key_id))
+	expires = datetime.fromtimestamp(int_from_bytes(b64decode(expires)))
+	user_id = int_from_bytes(b64decode(user_id))
+	guid = UUID(bytes=b64decode(guid))
+	assert datetime.now() < expires
+	return user_id, guid.bytes
+
+
+def single_pass_parse() :
+	load = _v1parse(token)
+	return load.user_id, load.guid
+
+
+if __name__ == '__main__' :
+	test(split_parse, single_pass_parse, iterations=200000)
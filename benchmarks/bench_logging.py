@@ -0,0 +1,39 @@
+"""
+measures the cost of log calls that never reach the agent.
+run from the repository root: python -m benchmarks.bench_logging
+"""
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+import logging
+
+from kh_common.logging import getLogger
+from kh_common.utilities.speed import test
+
+
+logger = getLogger('benchmark', level=logging.INFO, sample_rate=0)
+data = { str(i): list(range(10)) for i in range(100) }
+
+
+def debug_eager() :
+	# disabled by level: short circuits before a record is created, but the dict is still built
+	logger.debug({ 'data': dict(data) })
+
+
+def debug_deferred() :
+	logger.debug(lambda : { 'data': dict(data) })
+
+
+def info_sampled_eager() :
+	# enabled by level but dropped by the sampling filter: a record is created, then filtered
+	logger.info({ 'data': dict(data) })
+
+
+def info_sampled_deferred() :
+	logger.info(lambda : { 'data': dict(data) })
+
+
+def info_sampled_format() :
+	logger.info('%s records', len(data))
+
+
+if __name__ == '__main__' :
+	test(debug_eager, debug_deferred, info_sampled_eager, info_sampled_deferred, info_sampled_format, iterations=100000)
@@ -0,0 +1,97 @@
+"""
+compares requests per second of the previous BaseHTTPMiddleware based CustomHeaderMiddleware against the pure asgi one.
+requests are sent straight into the asgi app, so only framework and middleware overhead is measured.
+run from the repository root: python -m benchmarks.bench_middleware
+"""
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+from asyncio import Event, run
+from time import perf_counter
+from typing import Any, Dict, List
+
+from fastapi import FastAPI, Request
+from starlette.types import ASGIApp, Message, Receive
+
+from kh_common.server.middleware import CustomHeaderMiddleware, HeadersToSet
+
+
+async def base_http_middleware(request: Request, call_next) :
+	# the implementation CustomHeaderMiddleware replaced
+	response = await call_next(request)
+	response.headers.update(HeadersToSet)
+	return response
+
+
+def create_app(middleware: str) -> FastAPI :
+	app = FastAPI()
+
+	if middleware == 'base_http' :
+		app.middleware('http')(base_http_middleware)
+
+	elif middleware == 'asgi' :
+		app.add_middleware(CustomHeaderMiddleware)
+
+	@app.get('/')
+	async def endpoint() :
+		return { 'success': True }
+
+	return app
+
+
+scope: Dict[str, Any] = {
+	'type': 'http',
+	'asgi': { 'version': '3.0' },
+	'http_version': '1.1',
+	'method': 'GET',
+	'scheme': 'http',
+	'path': '/',
+	'raw_path': b'/',
+	'root_path': '',
+	'query_string': b'',
+	'headers': [(b'host', b'localhost')],
+	'client': ('127.0.0.1', 1234),
+	'server': ('127.0.0.1', 80),
+}
+
+
+def receiver() -> Receive :
+	# like a real server, the body is received once and later calls block until the client disconnects
+	received: bool = False
+
+	async def receive() -> Message :
+		nonlocal received
+
+		if received :
+			await Event().wait()
+
+		received = True
+		return { 'type': 'http.request', 'body': b'', 'more_body': False }
+
+	return receive
+
+
+async def requests_per_second(app: ASGIApp, requests: int) -> float :
+	messages: List[Message] = []
+
+	async def send(message: Message) -> None :
+		messages.append(message)
+
+	start: float = perf_counter()
+
+	for _ in range(requests) :
+		await app(dict(scope), receiver(), send)
+
+	elapsed: float = perf_counter() - start
+	assert messages[0]['status'] == 200
+	return requests / elapsed
+
+
+async def main(requests: int = 20000) -> None :
+	for middleware in ('none', 'base_http', 'asgi') :
+		app: FastAPI = create_app(middleware)
+		# warm up, so the middleware stack is built before timing
+		await requests_per_second(app, 100)
+		print(f'[{middleware}] {round(await requests_per_second(app, requests)):,} requests per second')
+
+
+if __name__ == '__main__' :
+	run(main())
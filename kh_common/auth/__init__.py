@@ -1,29 +1,32 @@
-from asyncio import Task, ensure_future
+from asyncio import Task, ensure_future, gather
+from binascii import a2b_base64
 from hashlib import sha1
 from re import compile as re_compile
-from typing import Callable, Dict, Union
+from time import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 from uuid import UUID
 
-import aerospike
 import ujson as json
 from aiohttp import request as async_request
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 from cryptography.hazmat.primitives.serialization import load_der_public_key
 from fastapi import Request
+from starlette.types import Scope as RequestScope
 
+from kh_common.auth.key_ring import KeyRing
+from kh_common.auth.token_cache import TokenCache
 from kh_common.base64 import b64decode, b64encode
-from kh_common.caching import ArgsCache
 from kh_common.caching.key_value_store import KeyValueStore
 from kh_common.config.constants import auth_host
 from kh_common.datetime import datetime
 from kh_common.exceptions.http_error import Forbidden, Unauthorized
 from kh_common.models.auth import AuthState, AuthToken, KhUser, PublicKeyResponse, Scope, TokenMetadata
-from kh_common.utilities import int_from_bytes
 
 
 ua_strip = re_compile(r'\/\d+(?:\.\d+)*')
 KVS: KeyValueStore = KeyValueStore('kheina', 'token')
+tokenCache: TokenCache = TokenCache()
 
 
 class InvalidToken(ValueError) :
@@ -45,8 +48,7 @@ class KhUser(KhUser) :
 		return True
 
 
-@ArgsCache(60 * 60 * 24)  # 24 hour cache
-async def _fetchPublicKey(key_id: int, algorithm: str) -> Ed25519PublicKey :
+async def _fetchPublicKey(key_id: int, algorithm: str) -> Tuple[Ed25519PublicKey, float] :
 	async with async_request(
 		'POST',
 		f'{auth_host}/v1/key',
@@ -67,70 +69,188 @@ async def _fetchPublicKey(key_id: int, algorithm: str) -> Ed25519PublicKey :
 	# don't verify in try/catch so that it doesn't cache an invalid token
 	public_key.verify(b64decode(load.signature), key)
 
-	return public_key
+	return public_key, load.expires.timestamp()
 
 
-async def v1token(token: str) -> AuthToken :
-	content: str
-	signature: str
-	load: str
+keyRing: KeyRing = KeyRing(_fetchPublicKey)
 
-	content, signature = token.rsplit('.', 1)
-	load = b64decode(content[content.find('.')+1:])
 
-	algorithm: bytes
-	key_id: bytes
-	expires: bytes
-	user_id: bytes
+class _V1Load(NamedTuple) :
+	content: bytes
+	signature: bytes
+	algorithm: str
+	key_id: int
+	expires: int
+	user_id: int
 	guid: bytes
 	data: bytes
 
-	algorithm, key_id, expires, user_id, guid, data = load.split(b'.', 5)
 
-	algorithm: str = algorithm.decode()
-	key_id: int = int_from_bytes(b64decode(key_id))
-	expires: datetime = datetime.fromtimestamp(int_from_bytes(b64decode(expires)))
-	user_id: int = int_from_bytes(b64decode(user_id))
-	guid: UUID = UUID(bytes=b64decode(guid))
+_urlsafe: bytes = bytes.maketrans(b'-_', b'+/')
+_padding: Tuple[bytes, bytes, bytes, bytes] = (b'', b'=', b'==', b'=')
 
-	if key_id <= 0 :
-		raise Unauthorized('Key is invalid.')
 
-	if datetime.now() > expires :
-		raise Unauthorized('Key has expired.')
+def _b64(chunk: bytes) -> bytes :
+	# unpadded urlsafe base64. a length of 1 mod 4 is never valid, the single '=' makes a2b_base64 reject it
+	return a2b_base64(chunk.translate(_urlsafe) + _padding[len(chunk) % 4])
+
+
+def _v1parse(token: str) -> _V1Load :
+	"""
+	parses a v1 token with a single scan over its bytes, using offsets rather than splitting. fields are decoded in order,
+	so malformed, invalid, or expired tokens are rejected before the remaining fields are decoded and before any objects are built.
+	token format: b64(version).b64(algorithm.b64(key_id).b64(expires).b64(user_id).b64(guid).data).b64(signature)
+	"""
+	raw: bytes = token.encode()
+	load_start: int = raw.find(b'.') + 1
+	content_end: int = raw.rfind(b'.')
+
+	if not 0 < load_start < content_end :
+		raise InvalidToken('The given token is malformed.')
+
+	try :
+		view: memoryview = memoryview(raw)
+		load: bytes = _b64(view[load_start:content_end].tobytes())
+
+		i: int = load.index(b'.')
+		j: int = load.index(b'.', i + 1)
+		key_id: int = int.from_bytes(_b64(load[i + 1:j]), 'big')
+
+		if key_id <= 0 :
+			raise Unauthorized('Key is invalid.')
+
+		k: int = load.index(b'.', j + 1)
+		expires: int = int.from_bytes(_b64(load[j + 1:k]), 'big')
 
+		if time() > expires :
+			raise Unauthorized('Key has expired.')
+
+		j = load.index(b'.', k + 1)
+		user_id: int = int.from_bytes(_b64(load[k + 1:j]), 'big')
+
+		k = load.index(b'.', j + 1)
+		guid: bytes = _b64(load[j + 1:k])
+		algorithm: str = load[:i].decode()
+
+	except ValueError as e :
+		raise InvalidToken('The given token is malformed.') from e
+
+	if len(guid) != 16 :
+		raise InvalidToken('The given token is malformed.')
+
+	return _V1Load(
+		content=view[:content_end].tobytes(),
+		signature=view[content_end + 1:].tobytes(),
+		algorithm=algorithm,
+		key_id=key_id,
+		expires=expires,
+		user_id=user_id,
+		guid=guid,
+		# data is json, and may itself contain dots
+		data=load[k + 1:],
+	)
 
-	token_info: Task[TokenMetadata] = ensure_future(KVS.get_async(guid.bytes))
-	public_key: Dict[str, Union[str, int, Ed25519PublicKey]] = await _fetchPublicKey(key_id, algorithm)
 
+def _v1verifySignature(public_key: Ed25519PublicKey, load: _V1Load) -> None :
 	try :
-		public_key.verify(b64decode(signature), content.encode())
+		public_key.verify(b64decode(load.signature), load.content)
 
 	except :
 		raise Unauthorized('Key validation failed.')
 
 
+def _v1checkMetadata(load: _V1Load, token_info: TokenMetadata) -> None :
 	try :
-		token_info: TokenMetadata = await token_info
-
 		assert token_info.state == AuthState.active, 'This token is no longer active.'
-		assert token_info.algorithm == algorithm, 'Token algorithm mismatch.'
-		assert token_info.expires == expires, 'Token expiration mismatch.'
-		assert token_info.key_id == key_id, 'Token encryption key mismatch.'
-
-	except aerospike.exception.RecordNotFound :
-		raise
+		assert token_info.algorithm == load.algorithm, 'Token algorithm mismatch.'
+		assert token_info.expires == datetime.fromtimestamp(load.expires), 'Token expiration mismatch.'
+		assert token_info.key_id == load.key_id, 'Token encryption key mismatch.'
 
 	except AssertionError as e :
 		raise Unauthorized(str(e))
 
-	return AuthToken(
-		guid=guid,
-		user_id=user_id,
-		expires=expires,
-		data=json.loads(data),
+
+def _v1authToken(token: str, load: _V1Load, generation: int) -> AuthToken :
+	auth_token: AuthToken = AuthToken(
+		guid=UUID(bytes=load.guid),
+		user_id=load.user_id,
+		expires=datetime.fromtimestamp(load.expires),
+		data=json.loads(load.data),
 		token_string=token,
 	)
+	tokenCache.put(load.guid, load.expires, auth_token, generation)
+
+	return auth_token
+
+
+async def v1token(token: str) -> AuthToken :
+	load: _V1Load = _v1parse(token)
+	cached: Optional[AuthToken] = tokenCache.get(load.guid, token)
+
+	if cached :
+		return cached
+
+	# read before the metadata, so that a revocation that arrives while it's in flight isn't overwritten
+	generation: int = tokenCache.generation()
+	token_info: Task[TokenMetadata] = ensure_future(KVS.get_async(load.guid))
+
+	try :
+		_v1verifySignature(await keyRing.get(load.key_id, load.algorithm), load)
+
+	except :
+		# don't leave the lookup running, it holds the kvs lock
+		token_info.cancel()
+		raise
+
+	# a missing record raises aerospike.exception.RecordNotFound
+	_v1checkMetadata(load, await token_info)
+
+	return _v1authToken(token, load, generation)
+
+
+async def v1tokens(tokens: List[str]) -> List[Union[AuthToken, Exception]] :
+	results: List[Union[AuthToken, Exception, None]] = [None] * len(tokens)
+	loads: Dict[int, _V1Load] = { }
+
+	for i, token in enumerate(tokens) :
+		try :
+			load: _V1Load = _v1parse(token)
+			results[i] = tokenCache.get(load.guid, token)
+
+			if not results[i] :
+				loads[i] = load
+
+		except Exception as e :
+			results[i] = e
+
+	if not loads :
+		return results
+
+	generation: int = tokenCache.generation()
+	token_info: Task[Dict[bytes, Optional[TokenMetadata]]] = ensure_future(KVS.get_many_async([load.guid for load in loads.values()]))
+	key_ids: List[Tuple[int, str]] = list({ (load.key_id, load.algorithm) for load in loads.values() })
+	public_keys: Dict[Tuple[int, str], Union[Ed25519PublicKey, Exception]] = dict(zip(key_ids, await gather(*(keyRing.get(*key) for key in key_ids), return_exceptions=True)))
+	token_info: Dict[bytes, Optional[TokenMetadata]] = await token_info
+
+	for i, load in loads.items() :
+		try :
+			public_key: Union[Ed25519PublicKey, Exception] = public_keys[(load.key_id, load.algorithm)]
+
+			if isinstance(public_key, Exception) :
+				raise public_key
+
+			_v1verifySignature(public_key, load)
+
+			if not token_info.get(load.guid) :
+				raise Unauthorized('Token does not exist.')
+
+			_v1checkMetadata(load, token_info[load.guid])
+			results[i] = _v1authToken(tokens[i], load, generation)
+
+		except Exception as e :
+			results[i] = e
+
+	return results
 
 
 tokenVersionSwitch: Dict[bytes, Callable] = {
@@ -138,8 +258,10 @@ tokenVersionSwitch: Dict[bytes, Callable] = {
 }
 
 
-@ArgsCache(30)
 async def verifyToken(token: str) -> AuthToken :
+	"""
+	verified tokens are held in tokenCache, see TokenCache for how long they're trusted before being verified again
+	"""
 	version: bytes = b64decode(token[:token.find('.')])
 
 	if version in tokenVersionSwitch :
@@ -148,8 +270,69 @@ async def verifyToken(token: str) -> AuthToken :
 	raise InvalidToken('The given token uses a version that is unable to be decoded.')
 
 
-async def retrieveAuthToken(request: Request) -> AuthToken :
-	token: str = request.headers.get('Authorization') or request.cookies.get('kh-auth')
+tokensVersionSwitch: Dict[bytes, Callable] = {
+	b'1': v1tokens,
+}
+
+
+async def verifyTokens(tokens: Iterable[str]) -> List[Union[AuthToken, Exception]] :
+	"""
+	verifies many tokens at once, such as for websocket fan-out or internal bulk calls.
+	each public key is resolved once, and the metadata of every token not already cached is retrieved with a single aerospike call.
+	results are returned in the same order as tokens. tokens that fail verification are returned as the exception that caused the failure
+	"""
+	tokens: List[str] = list(tokens)
+	results: List[Union[AuthToken, Exception, None]] = [None] * len(tokens)
+	versions: Dict[bytes, List[int]] = { }
+
+	for i, token in enumerate(tokens) :
+		try :
+			versions.setdefault(b64decode(token[:token.find('.')]), []).append(i)
+
+		except Exception as e :
+			results[i] = InvalidToken(f'The given token could not be decoded: {e}')
+
+	for version, indices in versions.items() :
+		if version not in tokensVersionSwitch :
+			for i in indices :
+				results[i] = InvalidToken('The given token uses a version that is unable to be decoded.')
+			continue
+
+		for i, result in zip(indices, await tokensVersionSwitch[version]([tokens[i] for i in indices])) :
+			results[i] = result
+
+	return results
+
+
+def _auth_cookie(cookie: bytes) -> Optional[str] :
+	# only the kh-auth cookie is parsed, the rest of the header is skipped
+	for morsel in cookie.split(b';') :
+		key, _, value = morsel.partition(b'=')
+
+		if key.strip() == b'kh-auth' :
+			return value.strip().strip(b'"').decode()
+
+	return None
+
+
+def tokenFromHeaders(headers: Iterable[Tuple[bytes, bytes]]) -> Optional[str] :
+	"""
+	finds the auth token in raw asgi headers. the authorization header takes precedence over the kh-auth cookie
+	"""
+	cookie: Optional[str] = None
+
+	for key, value in headers :
+		if key == b'authorization' and value :
+			return value.decode()
+
+		elif key == b'cookie' and not cookie :
+			cookie = _auth_cookie(value)
+
+	return cookie
+
+
+async def retrieveAuthTokenFromScope(scope: RequestScope) -> AuthToken :
+	token: Optional[str] = tokenFromHeaders(scope['headers'])
 
 	if not token :
 		raise Unauthorized('An authentication token was not provided.')
@@ -163,6 +346,10 @@ async def retrieveAuthToken(request: Request) -> AuthToken :
 	return token_data
 
 
+async def retrieveAuthToken(request: Request) -> AuthToken :
+	return await retrieveAuthTokenFromScope(request.scope)
+
+
 def browserFingerprint(request: Request) -> str :
 	headers = json.dumps({
 		'user-agent': userAgentStrip(request.headers.get('user-agent')),
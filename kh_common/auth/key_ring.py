@@ -0,0 +1,133 @@
+from asyncio import CancelledError, Task, ensure_future, gather, shield, sleep
+from time import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+
+from kh_common.logging import Logger, getLogger
+from kh_common.utilities.signal import Terminated
+
+
+KeyFetcher = Callable[[int, str], Awaitable[Tuple[Ed25519PublicKey, float]]]
+
+
+class KeyRing :
+	"""
+	holds the public keys used to verify tokens in memory, keyed by key id and algorithm.
+	once started, keys are refreshed in the background before they expire and the next key id is probed for, so that the first request after a key rotation doesn't wait on the auth host.
+	the network is only hit on the request path for a key id that has never been seen, and concurrent requests for it share a single fetch.
+	"""
+
+	def __init__(self: 'KeyRing', fetch: KeyFetcher, refresh_interval: float = 60, refresh_before: float = 3600) -> None :
+		"""
+		:param fetch: coroutine function that retrieves a key from the auth host, returning the key and its expiration as a unix timestamp
+		:param refresh_interval: seconds between background refreshes
+		:param refresh_before: keys expiring within this many seconds are refreshed
+		"""
+		self._fetch: KeyFetcher = fetch
+		self._refresh_interval: float = refresh_interval
+		self._refresh_before: float = refresh_before
+		self._keys: Dict[Tuple[int, str], Tuple[Ed25519PublicKey, float]] = { }
+		self._pending: Dict[Tuple[int, str], Task] = { }
+		self._task: Optional[Task] = None
+		self.logger: Logger = getLogger()
+
+
+	async def _load(self: 'KeyRing', key_id: int, algorithm: str) -> Ed25519PublicKey :
+		key: Tuple[int, str] = (key_id, algorithm)
+
+		try :
+			public_key, expires = await self._fetch(key_id, algorithm)
+			self._keys[key] = (public_key, expires)
+			return public_key
+
+		finally :
+			self._pending.pop(key, None)
+
+
+	def _request(self: 'KeyRing', key_id: int, algorithm: str) -> Task :
+		key: Tuple[int, str] = (key_id, algorithm)
+
+		if key not in self._pending :
+			self._pending[key] = ensure_future(self._load(key_id, algorithm))
+
+		return self._pending[key]
+
+
+	async def get(self: 'KeyRing', key_id: int, algorithm: str) -> Ed25519PublicKey :
+		entry: Optional[Tuple[Ed25519PublicKey, float]] = self._keys.get((key_id, algorithm))
+
+		if entry and time() < entry[1] :
+			return entry[0]
+
+		# expired keys are refetched as well, fetch raises if the auth host still reports the key as expired.
+		# shielded so that a cancelled request doesn't cancel the fetch for everyone else waiting on it
+		return await shield(self._request(key_id, algorithm))
+
+
+	async def preload(self: 'KeyRing', key_ids: Iterable[int], algorithm: str = 'ed25519') -> None :
+		key_ids: List[int] = list(key_ids)
+		results: List = await gather(*(self._request(key_id, algorithm) for key_id in key_ids), return_exceptions=True)
+
+		for key_id, result in zip(key_ids, results) :
+			if isinstance(result, Exception) :
+				self.logger.warning(f'failed to preload key {key_id} ({algorithm}).', exc_info=result)
+
+
+	async def refresh(self: 'KeyRing') -> None :
+		"""
+		refetches every key close to expiring and probes for the key after the newest key of each algorithm
+		"""
+		now: float = time()
+		newest: Dict[str, int] = { }
+
+		for (key_id, algorithm), (_, expires) in list(self._keys.items()) :
+			newest[algorithm] = max(newest.get(algorithm, 0), key_id)
+
+			if expires < now :
+				del self._keys[(key_id, algorithm)]
+
+		stale: List[Tuple[int, str]] = [key for key, (_, expires) in self._keys.items() if expires - now < self._refresh_before]
+		probes: List[Tuple[int, str]] = [(key_id + 1, algorithm) for algorithm, key_id in newest.items() if (key_id + 1, algorithm) not in self._keys]
+
+		results: List = await gather(*(self._request(*key) for key in stale + probes), return_exceptions=True)
+
+		for key, result in zip(stale, results) :
+			if isinstance(result, Exception) :
+				self.logger.warning(f'failed to refresh key {key[0]} ({key[1]}).', exc_info=result)
+
+		# probes are expected to fail until the next key is issued
+
+
+	async def _run(self: 'KeyRing') -> None :
+		while Terminated.alive :
+			await sleep(self._refresh_interval)
+
+			try :
+				await self.refresh()
+
+			except CancelledError :
+				raise
+
+			except Exception as e :
+				self.logger.error('unexpected error while refreshing keys.', exc_info=e)
+
+
+	async def start(self: 'KeyRing', key_ids: Iterable[int] = (), algorithm: str = 'ed25519') -> Task :
+		"""
+		loads the given keys, refreshes any keys already held, then starts refreshing keys in the background on the running event loop
+		:param key_ids: ids of the keys currently in use, fetched before the first request is served
+		"""
+		await self.preload(key_ids, algorithm)
+		await self.refresh()
+
+		if not self._task or self._task.done() :
+			self._task = ensure_future(self._run())
+
+		return self._task
+
+
+	def stop(self: 'KeyRing') -> None :
+		if self._task :
+			self._task.cancel()
+			self._task = None
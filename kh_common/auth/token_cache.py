@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Any, Dict, Optional, Tuple, Union
+from uuid import UUID
+
+from pika import BlockingConnection, ConnectionParameters
+from pika.channel import Channel
+
+from kh_common.logging import Logger, getLogger
+from kh_common.models.auth import AuthToken
+from kh_common.utilities.signal import Terminated
+
+
+class TokenCache :
+	"""
+	holds verified tokens keyed by guid, so verifying a token that was already seen needs no network calls.
+	tokens are held for at most max_age seconds, after which they're verified again, including their metadata, so revoked tokens stop being accepted.
+	while the listener started by listen is connected, revocations are pushed to the cache, and tokens are held until they expire or are revoked.
+	only use listen if every revocation is published to its exchange.
+	"""
+
+	def __init__(self: 'TokenCache', max_size: int = 100000, max_age: float = 30, max_revocations: int = 10000) -> None :
+		self._max_size: int = max_size
+		self._max_age: float = max_age
+		self._tokens: OrderedDict[bytes, Tuple[float, float, AuthToken]] = OrderedDict()
+		# the listener thread revokes tokens while requests verify and store them
+		self._lock: Lock = Lock()
+		# every revocation increments the generation, tokens whose metadata was read before their guid's last revocation aren't stored.
+		# revocations older than the floor have been forgotten, so tokens read before it aren't stored at all
+		self._generation: int = 0
+		self._floor: int = 0
+		self._revocations: OrderedDict[bytes, int] = OrderedDict()
+		self._max_revocations: int = max_revocations
+		# set while the revocation listener is connected, revocations may be missed at any other time
+		self.listening: bool = False
+		self.logger: Logger = getLogger()
+
+
+	def get(self: 'TokenCache', guid: bytes, token: str) -> Optional[AuthToken] :
+		"""
+		returns the verified token for guid, only if it was issued as exactly the given token string and hasn't expired
+		"""
+		cached: Optional[Tuple[float, float, AuthToken]] = self._tokens.get(guid)
+
+		if not cached :
+			return None
+
+		now: float = time()
+
+		if now > cached[0] or (not self.listening and now - cached[1] > self._max_age) :
+			self._tokens.pop(guid, None)
+			return None
+
+		return cached[2] if cached[2].token_string == token else None
+
+
+	def generation(self: 'TokenCache') -> int :
+		"""
+		returns the current generation, read it before a token's metadata and pass it to put
+		"""
+		return self._generation
+
+
+	def put(self: 'TokenCache', guid: bytes, expires: float, token: AuthToken, generation: int) -> None :
+		"""
+		caches a token that was just verified, including its metadata, unless it was revoked after generation was read
+		"""
+		with self._lock :
+			if generation < self._floor or self._revocations.get(guid, 0) > generation :
+				# the metadata may have been read from before the revocation
+				return
+
+			self._tokens.pop(guid, None)
+			self._tokens[guid] = (expires, time(), token)
+
+			while len(self._tokens) > self._max_size :
+				self._tokens.popitem(last=False)
+
+
+	def revoke(self: 'TokenCache', guid: Union[bytes, UUID]) -> None :
+		guid = guid.bytes if isinstance(guid, UUID) else guid
+
+		with self._lock :
+			self._generation += 1
+			self._tokens.pop(guid, None)
+			self._revocations.pop(guid, None)
+			self._revocations[guid] = self._generation
+
+			while len(self._revocations) > self._max_revocations :
+				self._floor = max(self._floor, self._revocations.popitem(last=False)[1])
+
+
+	def clear(self: 'TokenCache') -> None :
+		with self._lock :
+			self._generation += 1
+			self._floor = self._generation
+			self._tokens.clear()
+			self._revocations.clear()
+
+
+	def listen(self: 'TokenCache', exchange: str = 'token_revocations', connection_info: Optional[Dict[str, Any]] = None) -> Thread :
+		"""
+		starts a daemon thread that consumes revoked guids from the given fanout exchange and evicts them from the cache.
+		each message body must be the 16 raw bytes of a revoked token's guid.
+		connection_info defaults to the message_queue connection_info credentials.
+		"""
+		if connection_info is None :
+			from kh_common.config.credentials import message_queue
+			connection_info = message_queue['connection_info']
+
+		thread: Thread = Thread(target=self._listen, args=(exchange, connection_info), daemon=True)
+		thread.start()
+		return thread
+
+
+	def _listen(self: 'TokenCache', exchange: str, connection_info: Dict[str, Any]) -> None :
+		while Terminated.alive :
+			connection: Optional[BlockingConnection] = None
+
+			try :
+				connection = BlockingConnection(ConnectionParameters(**connection_info))
+				channel: Channel = connection.channel()
+				channel.exchange_declare(exchange=exchange, exchange_type='fanout')
+				queue: str = channel.queue_declare('', exclusive=True).method.queue
+				channel.queue_bind(queue=queue, exchange=exchange)
+
+				# revocations sent while we weren't listening are lost, so anything cached may have been revoked
+				self.clear()
+				self.listening = True
+				self.logger.info(f'listening for token revocations on {exchange}.')
+
+				for _, _, body in channel.consume(queue, auto_ack=True, inactivity_timeout=5) :
+					if not Terminated.alive :
+						break
+
+					if body :
+						self.revoke(body)
+
+			except Exception as e :
+				self.logger.warning('token revocation listener disconnected, attempting to reconnect.', exc_info=e)
+				sleep(1)
+
+			finally :
+				self.listening = False
+
+				try :
+					if connection and connection.is_open :
+						connection.close()
+
+				except Exception as e :
+					self.logger.warning('unexpected exception occurred during message queue close.', exc_info=e)
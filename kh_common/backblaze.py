@@ -1,30 +1,255 @@
+from asyncio import Lock, Semaphore, Task, ensure_future, gather, get_running_loop, shield
 from asyncio import sleep as sleep_async
 from base64 import b64encode
+from collections import OrderedDict, deque
 from hashlib import sha1 as hashlib_sha1
-from time import sleep
-from typing import Any, Dict, Union
+from mmap import ACCESS_READ, mmap
+from os import PathLike, fstat, makedirs, remove, replace, scandir, stat
+from os.path import join
+from time import sleep, time
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, BinaryIO, Callable, Deque, Dict, Iterable, List, Mapping, Optional, Tuple, Union
 from urllib.parse import quote, unquote
+from uuid import uuid4
 
 import ujson as json
-from aiohttp import ClientTimeout
-from aiohttp import request as async_request
+from aiohttp import ClientResponse, ClientTimeout
 from requests import Response
 from requests import get as requests_get
 from requests import post as requests_post
 
 from kh_common.config.credentials import b2
 from kh_common.exceptions.base_error import BaseError
+from kh_common.gateway import session
 from kh_common.logging import Logger, getLogger
 
 
-class B2AuthorizationError(BaseError) :
+class B2Error(BaseError) :
 	pass
 
 
-class B2UploadError(BaseError) :
+class B2AuthorizationError(B2Error) :
 	pass
 
 
+class B2UploadError(B2Error) :
+	pass
+
+
+AuthorizeAccountUrl: str = 'https://api.backblazeb2.com/b2api/v2/b2_authorize_account'
+
+# b2 upload urls are valid for 24 hours, they're retired from the pool a little before that
+UploadUrlLifetime: float = 23 * 60 * 60
+
+# b2 rejects large file parts smaller than 5MB, other than the last
+MinimumPartSize: int = 5 * 1024 ** 2
+
+LargeFileSource = Union[str, PathLike, bytes, bytearray, memoryview, mmap, AsyncIterable[bytes]]
+
+
+StreamSource = Union[str, PathLike, BinaryIO, AsyncIterable[bytes]]
+
+
+def _retry_after(response: ClientResponse) -> Optional[float] :
+	# b2 sends the number of seconds to wait with 429 and 503 responses
+	try :
+		return float(response.headers['retry-after'])
+
+	except (KeyError, ValueError) :
+		return None
+
+
+def _sha1(data: Union[bytes, memoryview]) -> str :
+	return hashlib_sha1(data).hexdigest()
+
+
+async def _memory_parts(view: memoryview, part_size: int) -> AsyncIterator[memoryview] :
+	for start in range(0, len(view), part_size) :
+		yield view[start:start + part_size]
+
+
+async def _mmap_chunks(mapped: mmap, chunk_size: int) -> AsyncIterator[bytes] :
+	# slicing an mmap copies, so no views of it outlive the upload
+	for start in range(0, len(mapped), chunk_size) :
+		yield mapped[start:start + chunk_size]
+
+
+async def _file_chunks(file: BinaryIO, chunk_size: int) -> AsyncIterator[bytes] :
+	loop = get_running_loop()
+
+	while True :
+		chunk: bytes = await loop.run_in_executor(None, file.read, chunk_size)
+
+		if not chunk :
+			return
+
+		yield chunk
+
+
+async def _with_sha1_trailer(chunks: AsyncIterable[bytes], size: int, sha1: Any) -> AsyncIterator[bytes] :
+	"""
+	yields chunks while hashing them, followed by the hex sha1 of everything yielded, as b2 expects for hex_digits_at_end uploads
+	"""
+	sent: int = 0
+
+	async for chunk in chunks :
+		sha1.update(chunk)
+		sent += len(chunk)
+		yield chunk
+
+	if sent != size :
+		raise ValueError(f'upload source yielded {sent} bytes, expected {size}.')
+
+	yield sha1.hexdigest().encode()
+
+
+async def _next_part(parts: AsyncIterator[Union[bytes, memoryview]]) -> Optional[Union[bytes, memoryview]] :
+	try :
+		return await parts.__anext__()
+
+	except StopAsyncIteration :
+		return None
+
+
+async def _stream_parts(stream: AsyncIterable[bytes], part_size: int) -> AsyncIterator[bytes] :
+	buffer: bytearray = bytearray()
+
+	async for chunk in stream :
+		buffer += chunk
+
+		while len(buffer) >= part_size :
+			yield bytes(buffer[:part_size])
+			del buffer[:part_size]
+
+	if buffer :
+		yield bytes(buffer)
+
+
+async def _file_range(file: BinaryIO, start: int, end: Optional[int], chunk_size: int) -> AsyncIterator[bytes] :
+	loop = get_running_loop()
+	file.seek(start)
+	remaining: int = (end - start) if end is not None else -1
+
+	while remaining :
+		chunk: bytes = await loop.run_in_executor(None, file.read, chunk_size if remaining < 0 else min(chunk_size, remaining))
+
+		if not chunk :
+			return
+
+		remaining -= len(chunk) if remaining > 0 else 0
+		yield chunk
+
+
+async def _verify_sha1(parts: AsyncIterable[bytes], sha1: str) -> AsyncIterator[bytes] :
+	"""
+	yields parts while hashing them, raising once they've all been yielded if their sha1 doesn't match
+	"""
+	loop = get_running_loop()
+	hashed = hashlib_sha1()
+
+	async for part in parts :
+		await loop.run_in_executor(None, hashed.update, part)
+		yield part
+
+	if hashed.hexdigest() != sha1 :
+		raise B2Error(f'downloaded sha1 {hashed.hexdigest()} does not match expected sha1 {sha1}.')
+
+
+class DownloadCache :
+	"""
+	size-bounded lru cache of downloaded files on local disk, keyed by file name and version, so repeated downloads of the same file need no network calls.
+	a file's version is its sha1, or its file id for large files uploaded without one, so overwritten files are never served stale.
+	files left in path by previous processes are adopted, least recently accessed first.
+	"""
+
+	def __init__(self: 'DownloadCache', path: Union[str, PathLike], max_size: int = 10 * 1024 ** 3) -> None :
+		"""
+		:param path: directory cached files are stored in, created if it doesn't exist
+		:param max_size: total bytes of cached files, least recently used files are removed beyond it
+		"""
+		makedirs(path, exist_ok=True)
+		self.path: Union[str, PathLike] = path
+		self.max_size: int = max_size
+		self._size: int = 0
+		self._files: OrderedDict[str, int] = OrderedDict()
+
+		for entry in sorted(scandir(path), key=lambda entry : entry.stat().st_atime) :
+			if not entry.is_file() :
+				continue
+
+			if entry.name.endswith('.part') :
+				# downloads that were interrupted by the previous process
+				remove(entry.path)
+				continue
+
+			self._files[entry.name] = entry.stat().st_size
+			self._size += self._files[entry.name]
+
+		self._evict()
+
+
+	@staticmethod
+	def key(filename: str, version: str) -> str :
+		return _sha1(f'{filename}\0{version}'.encode())
+
+
+	def temp(self: 'DownloadCache') -> str :
+		"""
+		returns a new path within the cache directory for a download to be written to before it's put into the cache
+		"""
+		return join(self.path, f'{uuid4().hex}.part')
+
+
+	def open(self: 'DownloadCache', filename: str, version: str) -> Optional[BinaryIO] :
+		"""
+		returns the cached file opened for reading, or None if it isn't cached.
+		an open file remains readable even if it's evicted while being read
+		"""
+		key: str = self.key(filename, version)
+
+		if key not in self._files :
+			return None
+
+		try :
+			file: BinaryIO = open(join(self.path, key), 'rb')
+
+		except FileNotFoundError :
+			self._size -= self._files.pop(key)
+			return None
+
+		self._files.move_to_end(key)
+		return file
+
+
+	def put(self: 'DownloadCache', filename: str, version: str, temp: str) -> bool :
+		"""
+		moves the file at temp, from DownloadCache.temp, into the cache, returning False and removing it if it's larger than the cache
+		"""
+		key: str = self.key(filename, version)
+		size: int = stat(temp).st_size
+
+		if size > self.max_size :
+			remove(temp)
+			return False
+
+		replace(temp, join(self.path, key))
+		self._size += size - self._files.pop(key, 0)
+		self._files[key] = size
+		self._evict()
+		return True
+
+
+	def _evict(self: 'DownloadCache') -> None :
+		while self._size > self.max_size and self._files :
+			key, size = self._files.popitem(last=False)
+			self._size -= size
+
+			try :
+				remove(join(self.path, key))
+
+			except FileNotFoundError :
+				pass
+
+
 class B2Interface :
 
 	def __init__(
@@ -32,12 +257,21 @@ class B2Interface :
 		timeout: float = 300,
 		max_backoff: float = 30,
 		max_retries: float = 15,
-		mime_types: Dict[str, str] = { }
+		mime_types: Dict[str, str] = { },
+		max_upload_urls: int = 32,
+		download_cache: Optional[DownloadCache] = None,
 	) -> None :
 		self.logger: Logger = getLogger()
 		self.b2_timeout: float = timeout
 		self.b2_max_backoff: float = max_backoff
 		self.b2_max_retries: float = max_retries
+		self.b2_max_upload_urls: int = max_upload_urls
+		# idle upload urls, handed out to one upload at a time
+		self._upload_urls: List[Dict[str, Any]] = []
+		self._authorizing: Optional[Task] = None
+		self.b2_download_cache: Optional[DownloadCache] = download_cache
+		# downloads into the cache in progress, keyed by cache key, so concurrent downloads of a file share one
+		self._downloads: Dict[str, Task] = { }
 		self.mime_types: Dict[str, str] = {
 			'jpg': 'image/jpeg',
 			'jpeg': 'image/jpeg',
@@ -52,6 +286,14 @@ class B2Interface :
 		self._b2_authorize()
 
 
+	def _set_authorization(self: 'B2Interface', content: Dict[str, Any]) -> None :
+		self.b2_api_url = content['apiUrl']
+		self.b2_auth_token = content['authorizationToken']
+		self.b2_bucket_id = content['allowed']['bucketId']
+		self.b2_bucket_name = content['allowed']['bucketName']
+		self.b2_download_url = content['downloadUrl']
+
+
 	def _b2_authorize(self: 'B2Interface') -> bool :
 		basic_auth_string: bytes = b'Basic ' + b64encode((b2['key_id'] + ':' + b2['key']).encode())
 		b2_headers: Dict[str, bytes] = { 'authorization': basic_auth_string }
@@ -60,7 +302,7 @@ class B2Interface :
 		for _ in range(self.b2_max_retries) :
 			try :
 				response = requests_get(
-					'https://api.backblazeb2.com/b2api/v2/b2_authorize_account',
+					AuthorizeAccountUrl,
 					headers=b2_headers,
 					timeout=self.b2_timeout,
 				)
@@ -70,11 +312,7 @@ class B2Interface :
 
 			else :
 				if response.ok :
-					content = json.loads(response.content)
-					self.b2_api_url = content['apiUrl']
-					self.b2_auth_token = content['authorizationToken']
-					self.b2_bucket_id = content['allowed']['bucketId']
-					self.b2_download_url = content['downloadUrl']
+					self._set_authorization(json.loads(response.content))
 					return True
 
 		else :
@@ -85,6 +323,102 @@ class B2Interface :
 			)
 
 
+	async def _b2_authorize_async(self: 'B2Interface') -> None :
+		basic_auth_string: str = 'Basic ' + b64encode((b2['key_id'] + ':' + b2['key']).encode()).decode()
+		backoff: float = 1
+		content: Union[bytes, None] = None
+		status: Union[int, None] = None
+
+		for _ in range(self.b2_max_retries) :
+			try :
+				async with session().request(
+					'GET',
+					AuthorizeAccountUrl,
+					headers={ 'authorization': basic_auth_string },
+					timeout=ClientTimeout(self.b2_timeout),
+				) as response :
+					if response.ok :
+						self._set_authorization(await response.json())
+						return
+
+					content = await response.read()
+					status = response.status
+
+			except Exception as e :
+				self.logger.error('error encountered during b2 authorization.', exc_info=e)
+
+			await sleep_async(backoff)
+			backoff = min(backoff * 2, self.b2_max_backoff)
+
+		raise B2AuthorizationError(
+			'b2 authorization handshake failed.',
+			response=json.loads(content) if content else None,
+			status=status,
+		)
+
+
+	async def _reauthorize_async(self: 'B2Interface', rejected_token: str) -> None :
+		"""
+		obtains a new auth token after rejected_token was rejected by b2, without blocking the event loop.
+		concurrent callers share a single authorization, and callers whose token has already been replaced return immediately
+		"""
+		if rejected_token != self.b2_auth_token :
+			return
+
+		if not self._authorizing or self._authorizing.done() :
+			self._authorizing = ensure_future(self._b2_authorize_async())
+
+		await shield(self._authorizing)
+
+
+	async def _b2_api_async(self: 'B2Interface', call: str, body: Dict[str, Any]) -> Dict[str, Any] :
+		"""
+		calls a b2 api endpoint, retrying with backoff and reauthorizing if the auth token has expired
+		"""
+		backoff: float = 1
+		content: Union[bytes, None] = None
+		status: Union[int, None] = None
+
+		for _ in range(self.b2_max_retries) :
+			token: str = self.b2_auth_token
+			retry_after: Optional[float] = None
+
+			try :
+				async with session().request(
+					'POST',
+					f'{self.b2_api_url}/b2api/v2/{call}',
+					json=body,
+					headers={ 'authorization': token },
+					timeout=ClientTimeout(self.b2_timeout),
+				) as response :
+					if response.ok :
+						return await response.json()
+
+					content = await response.read()
+					status = response.status
+					retry_after = _retry_after(response)
+
+					if status == 401 :
+						# obtain new auth token
+						await self._reauthorize_async(token)
+						continue
+
+					elif status < 500 and status not in { 408, 429 } :
+						break
+
+			except Exception as e :
+				self.logger.error(f'error encountered during b2 {call}.', exc_info=e)
+
+			await sleep_async(backoff if retry_after is None else retry_after)
+			backoff = min(backoff * 2, self.b2_max_backoff)
+
+		raise B2Error(
+			f'b2 {call} failed after {self.b2_max_retries} attempts or with a non-retryable status.',
+			response=json.loads(content) if content else None,
+			status=status,
+		)
+
+
 	def _get_mime_from_filename(self: 'B2Interface', filename: str) -> str :
 		extension: str = filename[filename.rfind('.') + 1:]
 		if extension in self.mime_types :
@@ -106,7 +440,9 @@ class B2Interface :
 					timeout=self.b2_timeout,
 				)
 				if response.ok :
-					return json.loads(response.content)
+					upload_url: Dict[str, Any] = json.loads(response.content)
+					upload_url['expires'] = time() + UploadUrlLifetime
+					return upload_url
 
 				elif response.status_code == 401 :
 					# obtain new auth token
@@ -135,29 +471,36 @@ class B2Interface :
 		status: Union[int, None] = None
 
 		for _ in range(self.b2_max_retries) :
+			token: str = self.b2_auth_token
+			retry_after: Optional[float] = None
+
 			try :
-				async with async_request(
+				async with session().request(
 					'POST',
 					self.b2_api_url + '/b2api/v2/b2_get_upload_url',
 					json={ 'bucketId': self.b2_bucket_id },
-					headers={ 'authorization': self.b2_auth_token },
+					headers={ 'authorization': token },
 					timeout=ClientTimeout(self.b2_timeout),
 				) as response :
 					if response.ok :
-						return await response.json()
+						upload_url: Dict[str, Any] = await response.json()
+						upload_url['expires'] = time() + UploadUrlLifetime
+						return upload_url
 
 					elif response.status == 401 :
 						# obtain new auth token
-						self._b2_authorize()
+						await self._reauthorize_async(token)
+						continue
 
 					else :
 						content = await response.read()
 						status = response.status
+						retry_after = _retry_after(response)
 
 			except Exception as e :
 				self.logger.error('error encountered during b2 obtain upload url.', exc_info=e)
 
-			await sleep_async(backoff)
+			await sleep_async(backoff if retry_after is None else retry_after)
 			backoff = min(backoff * 2, self.b2_max_backoff)
 
 		raise B2AuthorizationError(
@@ -167,9 +510,33 @@ class B2Interface :
 		)
 
 
+	def _pooled_upload_url(self: 'B2Interface') -> Optional[Dict[str, Any]] :
+		now: float = time()
+
+		while self._upload_urls :
+			upload_url: Dict[str, Any] = self._upload_urls.pop()
+
+			if upload_url['expires'] > now :
+				return upload_url
+
+		return None
+
+
+	def _release_upload_url(self: 'B2Interface', upload_url: Dict[str, Any]) -> None :
+		"""
+		returns an upload url to the pool once its upload has succeeded. urls that failed must not be released, b2 expects a new url after any failure
+		"""
+		if len(self._upload_urls) < self.b2_max_upload_urls :
+			self._upload_urls.append(upload_url)
+
+
+	async def _acquire_upload_url_async(self: 'B2Interface') -> Dict[str, Any] :
+		return self._pooled_upload_url() or await self._obtain_upload_url_async()
+
+
 	def b2_upload(self: 'B2Interface', file_data: bytes, filename: str, content_type:Union[str, None]=None, sha1:Union[str, None]=None) -> Dict[str, Any] :
 		# obtain upload url
-		upload_url: str = self._obtain_upload_url()
+		upload_url: Dict[str, Any] = self._pooled_upload_url() or self._obtain_upload_url()
 
 		sha1: str = sha1 or hashlib_sha1(file_data).hexdigest()
 		content_type: str = content_type or self._get_mime_from_filename(filename)
@@ -186,8 +553,13 @@ class B2Interface :
 		content: Union[str, None] = None
 		status: Union[int, None] = None
 
-		for _ in range(self.b2_max_retries) :
+		for attempt in range(self.b2_max_retries) :
 			try :
+				if attempt :
+					# b2 expects a new upload url to be obtained after any failure
+					upload_url = self._obtain_upload_url()
+					headers['authorization'] = upload_url['authorizationToken']
+
 				response = requests_post(
 					upload_url['uploadUrl'],
 					headers=headers,
@@ -200,6 +572,7 @@ class B2Interface :
 					assert content_type == content['contentType']
 					assert sha1 == content['contentSha1']
 					assert filename == unquote(content['fileName'])
+					self._release_upload_url(upload_url)
 					return content
 
 				else :
@@ -224,63 +597,91 @@ class B2Interface :
 		)
 
 
-	async def b2_delete_file_async(self: 'B2Interface', filename: str) -> bool :
-		files = None
+	async def b2_list_files_async(self: 'B2Interface', prefix: str = '', versions: bool = False, page_size: int = 1000) -> AsyncIterator[Dict[str, Any]] :
+		"""
+		yields the info of every file whose name starts with prefix, in name order, requesting page_size files at a time.
+		with versions, every version of each file is yielded, newest first, rather than only the latest.
+		"""
+		call: str = 'b2_list_file_versions' if versions else 'b2_list_file_names'
+		body: Dict[str, Any] = {
+			'bucketId': self.b2_bucket_id,
+			'prefix': prefix,
+			'startFileName': prefix,
+			'maxFileCount': page_size,
+		}
 
-		for _ in range(self.b2_max_retries) :
-			try :
-				async with async_request(
-					'POST',
-					self.b2_api_url + '/b2api/v2/b2_list_file_versions',
-					json={
-						'bucketId': self.b2_bucket_id,
-						'startFileName': filename,
-						'maxFileCount': 5,
-					},
-					headers={ 'authorization': self.b2_auth_token },
-				) as response :
-					if response.status == 401 :
-						self._b2_authorize()
-						continue
+		while True :
+			page: Dict[str, Any] = await self._b2_api_async(call, body)
 
-					files = (await response.json())['files']
-					break
+			for file in page['files'] :
+				yield file
 
-			except Exception as e :
-				self.logger.error('error encountered during b2 delete.', exc_info=e)
+			if not page.get('nextFileName') :
+				return
 
-		assert files
+			body['startFileName'] = page['nextFileName']
 
-		deletes = 0
+			if versions :
+				body['startFileId'] = page.get('nextFileId')
 
-		for file in files :
+
+	async def _file_versions(self: 'B2Interface', filename: str, page_size: int = 100) -> List[Dict[str, Any]] :
+		files: List[Dict[str, Any]] = []
+
+		# a name sorts before every other name it's a prefix of, so its versions are listed first
+		async for file in self.b2_list_files_async(filename, versions=True, page_size=page_size) :
 			if file['fileName'] != filename :
-				continue
+				break
+
+			files.append(file)
+
+		return files
+
+
+	async def b2_delete_file_async(self: 'B2Interface', filename: str) -> bool :
+		"""
+		deletes every version of filename, returning whether any were deleted
+		"""
+		files: List[Dict[str, Any]] = await self._file_versions(filename)
+		results: List[Any] = await gather(*(
+			self._b2_api_async('b2_delete_file_version', { 'fileId': file['fileId'], 'fileName': file['fileName'] })
+			for file in files
+		), return_exceptions=True)
 
-			for _ in range(self.b2_max_retries) :
+		for result in results :
+			if isinstance(result, Exception) :
+				self.logger.error('error encountered during b2 delete.', exc_info=result)
+
+		return any(not isinstance(result, Exception) for result in results)
+
+
+	async def _for_each(self: 'B2Interface', func: Callable[[str], Awaitable[Any]], filenames: Iterable[str], concurrency: int, default: Any) -> Dict[str, Any] :
+		semaphore: Semaphore = Semaphore(concurrency)
+		filenames: List[str] = list(dict.fromkeys(filenames))
+
+		async def run(filename: str) -> Any :
+			async with semaphore :
 				try :
-					async with async_request(
-						'POST',
-						self.b2_api_url + '/b2api/v2/b2_delete_file_version',
-						json={
-							'fileId': file['fileId'],
-							'fileName': file['fileName'],
-						},
-						headers={ 'authorization': self.b2_auth_token },
-						raise_for_status=True,
-					) as response :
-						deletes += 1
-						break
+					return await func(filename)
 
 				except Exception as e :
-					self.logger.error('error encountered during b2 delete.', exc_info=e)
+					self.logger.error(f'error encountered during b2 {func.__name__} of {filename}.', exc_info=e)
+					return default
 
-		return bool(deletes)
+		return dict(zip(filenames, await gather(*map(run, filenames))))
+
+
+	async def b2_delete_many_async(self: 'B2Interface', filenames: Iterable[str], concurrency: int = 16) -> Dict[str, bool] :
+		"""
+		deletes every version of each file, with at most concurrency files being deleted at once.
+		returns whether each file was deleted, files that failed to delete are logged and reported as False
+		"""
+		return await self._for_each(self.b2_delete_file_async, filenames, concurrency, False)
 
 
 	async def b2_upload_async(self: 'B2Interface', file_data: bytes, filename: str, content_type:Union[str, None]=None, sha1:Union[str, None]=None) -> Dict[str, Any] :
 		# obtain upload url
-		upload_url: str = await self._obtain_upload_url_async()
+		upload_url: Dict[str, Any] = await self._acquire_upload_url_async()
 
 		sha1: str = sha1 or hashlib_sha1(file_data).hexdigest()
 		content_type: str = content_type or self._get_mime_from_filename(filename)
@@ -297,9 +698,14 @@ class B2Interface :
 		content: Union[str, None] = None
 		status: Union[int, None] = None
 
-		for _ in range(self.b2_max_retries) :
+		for attempt in range(self.b2_max_retries) :
 			try :
-				async with async_request(
+				if attempt :
+					# b2 expects a new upload url to be obtained after any failure
+					upload_url = await self._obtain_upload_url_async()
+					headers['authorization'] = upload_url['authorizationToken']
+
+				async with session().request(
 					'POST',
 					upload_url['uploadUrl'],
 					headers=headers,
@@ -312,6 +718,7 @@ class B2Interface :
 						assert content_type == content['contentType']
 						assert sha1 == content['contentSha1']
 						assert filename == unquote(content['fileName'])
+						self._release_upload_url(upload_url)
 						return content
 
 					else :
@@ -336,28 +743,545 @@ class B2Interface :
 		)
 
 
-	async def b2_get_file_info(self: 'B2Interface', filename: str) :
+	async def b2_get_file_info(self: 'B2Interface', filename: str) -> Optional[Dict[str, Any]] :
+		"""
+		returns the info of the newest version of filename, or None if it doesn't exist or couldn't be retrieved
+		"""
+		try :
+			async for file in self.b2_list_files_async(filename, versions=True, page_size=1) :
+				return file if file['fileName'] == filename else None
+
+		except Exception as e :
+			self.logger.error('error encountered during b2 get file info.', exc_info=e)
+
+		return None
+
+
+	async def b2_get_file_info_many(self: 'B2Interface', filenames: Iterable[str], concurrency: int = 16) -> Dict[str, Optional[Dict[str, Any]]] :
+		"""
+		returns the info of the newest version of each file, with at most concurrency lookups at once
+		"""
+		return await self._for_each(self.b2_get_file_info, filenames, concurrency, None)
+
+
+	async def _upload_part(self: 'B2Interface', file_id: str, upload_url: Optional[Dict[str, Any]], part_number: int, part: Union[bytes, memoryview], sha1: str) -> Dict[str, Any] :
+		"""
+		uploads a single part of a large file, returning the part upload url so that it can be reused for the next part
+		"""
+		backoff: float = 1
+		content: Union[bytes, None] = None
+		status: Union[int, None] = None
+
 		for _ in range(self.b2_max_retries) :
 			try :
-				async with async_request(
+				if not upload_url :
+					upload_url = await self._b2_api_async('b2_get_upload_part_url', { 'fileId': file_id })
+
+				async with session().request(
 					'POST',
-					self.b2_api_url + '/b2api/v2/b2_list_file_versions',
-					json={
-						'bucketId': self.b2_bucket_id,
-						'startFileName': filename,
-						'maxFileCount': 5,
+					upload_url['uploadUrl'],
+					headers={
+						'authorization': upload_url['authorizationToken'],
+						'X-Bz-Part-Number': str(part_number),
+						'Content-Length': str(len(part)),
+						'X-Bz-Content-Sha1': sha1,
 					},
-					headers={ 'authorization': self.b2_auth_token },
+					data=part,
+					timeout=ClientTimeout(self.b2_timeout),
 				) as response :
+					status = response.status
+
+					if response.ok :
+						content: Dict[str, Any] = await response.json()
+						assert sha1 == content['contentSha1']
+						return upload_url
+
+					content = await response.read()
+
+					if status < 500 and status not in { 401, 408, 429 } :
+						break
+
+			except (AssertionError, B2Error) :
+				raise
+
+			except Exception as e :
+				self.logger.error('error encountered during b2 part upload.', exc_info=e)
+
+			# b2 expects a new upload url to be obtained after any failure
+			upload_url = None
+			await sleep_async(backoff)
+			backoff = min(backoff * 2, self.b2_max_backoff)
+
+		raise B2UploadError(
+			f'Upload of part {part_number} to b2 failed after {self.b2_max_retries} attempts or with a non-retryable status.',
+			response=json.loads(content) if content else None,
+			status=status,
+			file_id=file_id,
+			part_number=part_number,
+			filesize=len(part),
+		)
+
+
+	async def _upload_parts(self: 'B2Interface', file_id: str, parts: AsyncIterator[Union[bytes, memoryview]], concurrency: int) -> List[str] :
+		sha1s: Dict[int, str] = { }
+		lock: Lock = Lock()
+		part_count: int = 0
+
+		async def worker() -> None :
+			nonlocal part_count
+			# each worker keeps its own part upload url, since b2 only allows one upload at a time per url
+			upload_url: Optional[Dict[str, Any]] = None
+
+			while True :
+				# parts are read one at a time, so at most one part per worker is held in memory
+				async with lock :
+					try :
+						part: Union[bytes, memoryview] = await parts.__anext__()
+
+					except StopAsyncIteration :
+						return
+
+					part_count += 1
+					part_number: int = part_count
+
+				try :
+					# hashlib releases the gil for large inputs, so hashing doesn't block the event loop
+					sha1: str = await get_running_loop().run_in_executor(None, _sha1, part)
+					upload_url = await self._upload_part(file_id, upload_url, part_number, part, sha1)
+					sha1s[part_number] = sha1
+
+				finally :
+					if isinstance(part, memoryview) :
+						part.release()
+
+		workers: List[Task] = [ensure_future(worker()) for _ in range(concurrency)]
+
+		try :
+			await gather(*workers)
+
+		except :
+			for task in workers :
+				task.cancel()
+
+			# wait for the cancelled workers to release their parts, mmap'd sources can't be closed until they do
+			await gather(*workers, return_exceptions=True)
+			raise
+
+		return [sha1s[i] for i in range(1, part_count + 1)]
+
+
+	async def _upload_large(self: 'B2Interface', parts: AsyncIterator[Union[bytes, memoryview]], filename: str, content_type: str, concurrency: int) -> Dict[str, Any] :
+		first: Optional[Union[bytes, memoryview]] = await _next_part(parts)
+		second: Optional[Union[bytes, memoryview]] = await _next_part(parts) if first is not None else None
+
+		if second is None :
+			# b2 requires at least two parts, anything that fits in one is uploaded normally
+			data: bytes = bytes(first or b'')
+
+			if isinstance(first, memoryview) :
+				first.release()
+
+			return await self.b2_upload_async(data, filename, content_type)
+
+		async def all_parts() -> AsyncIterator[Union[bytes, memoryview]] :
+			yield first
+			yield second
+
+			async for part in parts :
+				yield part
+
+		try :
+			file_id: str = (await self._b2_api_async('b2_start_large_file', {
+				'bucketId': self.b2_bucket_id,
+				'fileName': filename,
+				'contentType': content_type,
+			}))['fileId']
+
+			try :
+				sha1s: List[str] = await self._upload_parts(file_id, all_parts(), concurrency)
+				return await self._b2_api_async('b2_finish_large_file', { 'fileId': file_id, 'partSha1Array': sha1s })
+
+			except :
+				try :
+					await self._b2_api_async('b2_cancel_large_file', { 'fileId': file_id })
+
+				except Exception as e :
+					self.logger.error('failed to cancel b2 large file upload.', exc_info=e)
+
+				raise
+
+		finally :
+			# the first two parts were read ahead, and aren't released by the workers if the upload fails before they're sent.
+			# releasing an already released view does nothing
+			for part in (first, second) :
+				if isinstance(part, memoryview) :
+					part.release()
+
+
+	async def b2_upload_large_async(
+		self: 'B2Interface',
+		source: LargeFileSource,
+		filename: str,
+		content_type: Union[str, None] = None,
+		part_size: int = 100 * 1024 ** 2,
+		concurrency: int = 4,
+	) -> Dict[str, Any] :
+		"""
+		uploads a file as a b2 large file, split into parts of part_size bytes, with up to concurrency parts uploading at once.
+		source may be a path to a file, which is mmap'd, any bytes-like object, including an mmap, or an async iterable of bytes.
+		at most concurrency parts are held in memory at once, and each part's sha1 is computed just before it's sent.
+		sources that fit within a single part are uploaded with b2_upload_async.
+		"""
+		if part_size < MinimumPartSize :
+			raise ValueError(f'part_size must be at least {MinimumPartSize} bytes.')
+
+		content_type = content_type or self._get_mime_from_filename(filename)
+
+		if isinstance(source, (str, PathLike)) :
+			with open(source, 'rb') as file :
+				if not fstat(file.fileno()).st_size :
+					# empty files can't be mmap'd
+					return await self.b2_upload_async(b'', filename, content_type)
+
+				with mmap(file.fileno(), 0, access=ACCESS_READ) as mapped, memoryview(mapped) as view :
+					return await self._upload_large(_memory_parts(view, part_size), filename, content_type, concurrency)
+
+		if isinstance(source, (bytes, bytearray, memoryview, mmap)) :
+			with memoryview(source) as view :
+				return await self._upload_large(_memory_parts(view, part_size), filename, content_type, concurrency)
+
+		return await self._upload_large(_stream_parts(source, part_size), filename, content_type, concurrency)
+
+
+	async def _upload_stream(self: 'B2Interface', chunks: Callable[[], AsyncIterable[bytes]], size: int, filename: str, content_type: str, attempts: int) -> Dict[str, Any] :
+		upload_url: Dict[str, Any] = await self._acquire_upload_url_async()
+		backoff: float = 1
+		content: Union[bytes, None] = None
+		status: Union[int, None] = None
+
+		for attempt in range(attempts) :
+			sha1 = hashlib_sha1()
+			headers: Dict[str, str] = {
+				'authorization': upload_url['authorizationToken'],
+				'X-Bz-File-Name': quote(filename),
+				'Content-Type': content_type,
+				# the sha1 is sent as 40 hex digits after the file
+				'Content-Length': str(size + 40),
+				'X-Bz-Content-Sha1': 'hex_digits_at_end',
+			}
+
+			try :
+				async with session().request(
+					'POST',
+					upload_url['uploadUrl'],
+					headers=headers,
+					data=_with_sha1_trailer(chunks(), size, sha1),
+					timeout=ClientTimeout(self.b2_timeout),
+				) as response :
+					status = response.status
+
+					if response.ok :
+						content: Dict[str, Any] = await response.json()
+						assert content_type == content['contentType']
+						assert sha1.hexdigest() == content['contentSha1']
+						assert filename == unquote(content['fileName'])
+						self._release_upload_url(upload_url)
+						return content
+
+					content = await response.read()
+
+			except (AssertionError, ValueError) :
+				raise
+
+			except Exception as e :
+				if isinstance(e.__cause__, ValueError) :
+					# aiohttp wraps errors raised while sending the body, such as a source that doesn't match size, which retrying won't fix
+					raise e.__cause__
+
+				self.logger.error('error encountered during b2 upload.', exc_info=e)
+
+			if attempt + 1 < attempts :
+				await sleep_async(backoff)
+				backoff = min(backoff * 2, self.b2_max_backoff)
+				# b2 expects a new upload url to be obtained after any failure
+				upload_url = await self._obtain_upload_url_async()
+
+		raise B2UploadError(
+			f'Upload to b2 failed, attempts exceeded: {attempts}.',
+			response=json.loads(content) if content else None,
+			status=status,
+			upload_url=upload_url,
+			filesize=size,
+		)
+
+
+	async def b2_upload_stream_async(
+		self: 'B2Interface',
+		source: StreamSource,
+		filename: str,
+		content_type: Union[str, None] = None,
+		size: Union[int, None] = None,
+		chunk_size: int = 1024 ** 2,
+	) -> Dict[str, Any] :
+		"""
+		uploads a file in a single request without holding it in memory, hashing it as it's sent and appending the sha1 to the body (hex_digits_at_end).
+		source may be a path to a file, which is mmap'd, a binary file object, read from its current position, or an async iterable of bytes.
+		b2 requires the length upfront, so size must be provided for async iterables and file objects that can't be stat'd.
+		async iterables and unseekable file objects can only be read once, so they aren't retried.
+		"""
+		content_type = content_type or self._get_mime_from_filename(filename)
+
+		if isinstance(source, (str, PathLike)) :
+			with open(source, 'rb') as file :
+				size = fstat(file.fileno()).st_size
+
+				if not size :
+					# empty files can't be mmap'd
+					return await self.b2_upload_async(b'', filename, content_type)
+
+				with mmap(file.fileno(), 0, access=ACCESS_READ) as mapped :
+					return await self._upload_stream(lambda : _mmap_chunks(mapped, chunk_size), size, filename, content_type, self.b2_max_retries)
+
+		if hasattr(source, 'read') :
+			seekable: bool = source.seekable()
+			start: int = source.tell() if seekable else 0
+
+			if size is None :
+				if not seekable :
+					raise ValueError('size is required to upload an unseekable file object.')
+
+				size = source.seek(0, 2) - start
+				source.seek(start)
+
+			def chunks() -> AsyncIterable[bytes] :
+				if seekable :
+					source.seek(start)
+
+				return _file_chunks(source, chunk_size)
+
+			return await self._upload_stream(chunks, size, filename, content_type, self.b2_max_retries if seekable else 1)
+
+		if size is None :
+			raise ValueError('size is required to upload an async iterable.')
+
+		return await self._upload_stream(lambda : source, size, filename, content_type, 1)
 
-					if response.status == 401 :
-						self._b2_authorize()
-						continue
 
-					return next(filter(lambda x : x['fileName'] == filename, (await response.json())['files']))
+	async def _b2_download(self: 'B2Interface', method: str, url: str, headers: Dict[str, str] = { }) -> Tuple[Mapping[str, str], bytes] :
+		"""
+		sends a request to the b2 download api, retrying with backoff and reauthorizing if the auth token has expired
+		"""
+		backoff: float = 1
+		content: Union[bytes, None] = None
+		status: Union[int, None] = None
+
+		for _ in range(self.b2_max_retries) :
+			token: str = self.b2_auth_token
+			retry_after: Optional[float] = None
+
+			try :
+				async with session().request(
+					method,
+					url,
+					headers={ **headers, 'authorization': token },
+					timeout=ClientTimeout(self.b2_timeout),
+				) as response :
+					if response.ok :
+						return response.headers, await response.read()
+
+					content = await response.read()
+					status = response.status
+					retry_after = _retry_after(response)
 
-			except StopIteration :
-				self.logger.error('file not found in b2.', exc_info=e)
+					if status == 401 :
+						# obtain new auth token
+						await self._reauthorize_async(token)
+						continue
+
+					elif status < 500 and status not in { 408, 429 } :
+						break
 
 			except Exception as e :
-				self.logger.error('error encountered during b2 get file info.', exc_info=e)
+				self.logger.error('error encountered during b2 download.', exc_info=e)
+
+			await sleep_async(backoff if retry_after is None else retry_after)
+			backoff = min(backoff * 2, self.b2_max_backoff)
+
+		raise B2Error(
+			f'b2 download of {url} failed after {self.b2_max_retries} attempts or with a non-retryable status.',
+			response=json.loads(content) if content else None,
+			status=status,
+		)
+
+
+	async def _b2_download_info(self: 'B2Interface', filename: str) -> Dict[str, Any] :
+		"""
+		returns the id, length and sha1 of the newest version of filename, without downloading it
+		"""
+		headers, _ = await self._b2_download('HEAD', f'{self.b2_download_url}/file/{quote(self.b2_bucket_name)}/{quote(filename)}')
+		sha1: Optional[str] = headers.get('x-bz-content-sha1')
+
+		if sha1 == 'none' :
+			# large files only have a sha1 if one was provided when they were started
+			sha1 = headers.get('x-bz-info-large_file_sha1')
+
+		return {
+			'fileId': headers['x-bz-file-id'],
+			'fileName': filename,
+			'contentType': headers.get('content-type'),
+			'contentLength': int(headers['content-length']),
+			'contentSha1': sha1.replace('unverified:', '') if sha1 else None,
+		}
+
+
+	def _b2_file_version(self: 'B2Interface', info: Dict[str, Any], sha1: Optional[str]) -> str :
+		if sha1 and info['contentSha1'] and sha1 != info['contentSha1'] :
+			raise B2Error(
+				f'newest version of {info["fileName"]} does not match the expected sha1.',
+				expected=sha1,
+				sha1=info['contentSha1'],
+				file_id=info['fileId'],
+			)
+
+		return sha1 or info['contentSha1'] or info['fileId']
+
+
+	async def _b2_download_part(self: 'B2Interface', file_id: str, start: int, end: int) -> bytes :
+		# downloading by id rather than name ensures every part comes from the same version
+		_, content = await self._b2_download(
+			'GET',
+			f'{self.b2_download_url}/b2api/v2/b2_download_file_by_id?fileId={quote(file_id)}',
+			{ 'range': f'bytes={start}-{end - 1}' },
+		)
+
+		if len(content) != end - start :
+			raise B2Error(f'b2 returned {len(content)} bytes for a {end - start} byte range.', file_id=file_id, start=start, end=end)
+
+		return content
+
+
+	async def _b2_download_parts(self: 'B2Interface', file_id: str, start: int, end: int, part_size: int, concurrency: int) -> AsyncIterator[bytes] :
+		"""
+		yields the bytes of file_id from start to end in order, as parts of part_size bytes, with up to concurrency parts downloading at once
+		"""
+		pending: Deque[Task] = deque()
+
+		try :
+			for offset in range(start, end, part_size) :
+				pending.append(ensure_future(self._b2_download_part(file_id, offset, min(offset + part_size, end))))
+
+				if len(pending) >= concurrency :
+					yield await pending.popleft()
+
+			while pending :
+				yield await pending.popleft()
+
+		finally :
+			# parts still downloading when a part fails or the consumer stops iterating are abandoned
+			for task in pending :
+				task.cancel()
+
+			await gather(*pending, return_exceptions=True)
+
+
+	def _b2_download_file(self: 'B2Interface', info: Dict[str, Any], sha1: Optional[str], part_size: int, concurrency: int) -> AsyncIterator[bytes] :
+		parts: AsyncIterator[bytes] = self._b2_download_parts(info['fileId'], 0, info['contentLength'], part_size, concurrency)
+		expected: Optional[str] = info['contentSha1'] or sha1
+		return _verify_sha1(parts, expected) if expected else parts
+
+
+	async def _b2_download_to_cache(self: 'B2Interface', info: Dict[str, Any], sha1: Optional[str], version: str, part_size: int, concurrency: int) -> None :
+		loop = get_running_loop()
+		temp: str = self.b2_download_cache.temp()
+
+		try :
+			with open(temp, 'wb') as file :
+				async for part in self._b2_download_file(info, sha1, part_size, concurrency) :
+					await loop.run_in_executor(None, file.write, part)
+
+		except :
+			remove(temp)
+			raise
+
+		self.b2_download_cache.put(info['fileName'], version, temp)
+
+
+	async def _b2_cache_download(self: 'B2Interface', info: Dict[str, Any], sha1: Optional[str], version: str, part_size: int, concurrency: int) -> None :
+		key: str = DownloadCache.key(info['fileName'], version)
+
+		if key not in self._downloads :
+			task: Task = ensure_future(self._b2_download_to_cache(info, sha1, version, part_size, concurrency))
+			task.add_done_callback(lambda _ : self._downloads.pop(key, None))
+			self._downloads[key] = task
+
+		# shielded so that a cancelled download doesn't cancel it for everyone else waiting on it
+		await shield(self._downloads[key])
+
+
+	async def b2_download_range_async(
+		self: 'B2Interface',
+		filename: str,
+		start: int = 0,
+		end: Optional[int] = None,
+		sha1: Optional[str] = None,
+		part_size: int = 16 * 1024 ** 2,
+		concurrency: int = 4,
+		chunk_size: int = 1024 ** 2,
+	) -> AsyncIterator[bytes] :
+		"""
+		yields the bytes of the newest version of filename from start up to, but not including, end, or to the end of the file if end is None.
+		ranges larger than part_size are downloaded as parts of part_size bytes, with up to concurrency parts downloading, and held in memory, at once.
+		with a download cache, whole files are downloaded into the cache and cached files are read from disk, files larger than the cache are downloaded directly.
+		if sha1 is given, a cached file is read without any network calls, otherwise B2Error is raised if the newest version doesn't match it.
+		whole files are checked against their sha1 as they're downloaded, raising B2Error after the last byte if it doesn't match.
+		"""
+		cache: Optional[DownloadCache] = self.b2_download_cache
+		file: Optional[BinaryIO] = cache.open(filename, sha1) if cache and sha1 else None
+
+		if not file :
+			info: Dict[str, Any] = await self._b2_download_info(filename)
+			version: str = self._b2_file_version(info, sha1)
+			size: int = info['contentLength']
+			end = size if end is None else min(end, size)
+			whole: bool = start == 0 and end == size
+
+			if cache :
+				file = cache.open(filename, version)
+
+				if not file and whole and size <= cache.max_size :
+					await self._b2_cache_download(info, sha1, version, part_size, concurrency)
+					file = cache.open(filename, version)
+
+			if not file :
+				parts: AsyncIterator[bytes] = self._b2_download_file(info, sha1, part_size, concurrency) if whole else self._b2_download_parts(info['fileId'], start, end, part_size, concurrency)
+
+				async for part in parts :
+					yield part
+
+				return
+
+		with file :
+			async for chunk in _file_range(file, start, end, chunk_size) :
+				yield chunk
+
+
+	async def b2_download_async(
+		self: 'B2Interface',
+		filename: str,
+		destination: Union[str, PathLike, BinaryIO],
+		sha1: Optional[str] = None,
+		part_size: int = 16 * 1024 ** 2,
+		concurrency: int = 4,
+	) -> None :
+		"""
+		downloads the newest version of filename to destination, a path or a binary file object written from its current position.
+		the file is downloaded, verified and cached as in b2_download_range_async
+		"""
+		if isinstance(destination, (str, PathLike)) :
+			with open(destination, 'wb') as file :
+				return await self.b2_download_async(filename, file, sha1, part_size, concurrency)
+
+		loop = get_running_loop()
+
+		async for chunk in self.b2_download_range_async(filename, sha1=sha1, part_size=part_size, concurrency=concurrency) :
+			await loop.run_in_executor(None, destination.write, chunk)
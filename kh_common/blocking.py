@@ -1,47 +1,297 @@
-from typing import Set
+from collections import OrderedDict
+from select import select
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple, TypeVar
 
-from kh_common.caching import ArgsCache
+from psycopg2 import connect as dbConnect
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import connection as Connection
+
+from kh_common.config.credentials import db
 from kh_common.hashing import Hashable
 from kh_common.sql import SqlInterface
+from kh_common.utilities import __clear_cache__
+from kh_common.utilities.signal import Terminated
+
+
+T = TypeVar('T')
+
+
+BlocklistTriggers: str = """
+CREATE OR REPLACE FUNCTION public.notify_blocklist_update() RETURNS trigger AS $$
+BEGIN
+	PERFORM pg_notify(TG_ARGV[0], (CASE TG_OP WHEN 'DELETE' THEN OLD.user_id ELSE NEW.user_id END)::text);
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tag_blocking_notify
+	AFTER INSERT OR UPDATE OR DELETE ON public.tag_blocking
+	FOR EACH ROW EXECUTE FUNCTION public.notify_blocklist_update('blocklist_updates');
+
+CREATE TRIGGER user_blocking_notify
+	AFTER INSERT OR UPDATE OR DELETE ON public.user_blocking
+	FOR EACH ROW EXECUTE FUNCTION public.notify_blocklist_update('blocklist_updates');
+
+-- blocklists hold the handles of blocked users and the names of non-deprecated blocked tags,
+-- so every user blocking a user or tag is notified when it's renamed or deprecated
+CREATE OR REPLACE FUNCTION public.notify_blocked_user_update() RETURNS trigger AS $$
+BEGIN
+	PERFORM pg_notify(TG_ARGV[0], user_blocking.user_id::text)
+	FROM public.user_blocking
+	WHERE user_blocking.blocked = NEW.user_id;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION public.notify_blocked_tag_update() RETURNS trigger AS $$
+BEGIN
+	PERFORM pg_notify(TG_ARGV[0], tag_blocking.user_id::text)
+	FROM public.tag_blocking
+	WHERE tag_blocking.blocked = NEW.tag_id;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER blocked_user_handle_notify
+	AFTER UPDATE OF handle ON public.users
+	FOR EACH ROW WHEN (OLD.handle IS DISTINCT FROM NEW.handle)
+	EXECUTE FUNCTION public.notify_blocked_user_update('blocklist_updates');
+
+CREATE TRIGGER blocked_tag_notify
+	AFTER UPDATE OF tag, deprecated ON public.tags
+	FOR EACH ROW WHEN (OLD.tag IS DISTINCT FROM NEW.tag OR OLD.deprecated IS DISTINCT FROM NEW.deprecated)
+	EXECUTE FUNCTION public.notify_blocked_tag_update('blocklist_updates');
+"""
+
+
+def tag_mask(tag_ids: Iterable[int]) -> int :
+	"""
+	packs tag ids into an integer bitset, where bit n is set if tag id n is present
+	"""
+	mask: int = 0
+	for tag_id in tag_ids :
+		mask |= 1 << tag_id
+	return mask
+
+
+class Blocklist(NamedTuple) :
+	tags: FrozenSet[str]
+	tag_mask: int
+	users: FrozenSet[str]
+	user_ids: FrozenSet[int]
+
+
+	def blocked(self: 'Blocklist', tags: Iterable[str] = (), uploader: Optional[str] = None) -> bool :
+		return uploader in self.users or not self.tags.isdisjoint(tags)
+
+
+	def blocked_mask(self: 'Blocklist', mask: int, uploader_id: Optional[int] = None) -> bool :
+		"""
+		same as blocked, but accepts a bitset created by tag_mask. checks all tags with a single integer AND
+		"""
+		return uploader_id in self.user_ids or bool(self.tag_mask & mask)
+
+
+	def filter(self: 'Blocklist', items: Iterable[T], tags: Callable[[T], Iterable[str]], uploader: Callable[[T], str] = lambda x : None) -> List[T] :
+		return [item for item in items if not self.blocked(tags(item), uploader(item))]
 
 
 class UserBlocking(SqlInterface, Hashable) :
 
-	def __init__(self) :
+	def __init__(self, TTL: float = 60, max_invalidations: int = 10000) :
 		Hashable.__init__(self)
 		SqlInterface.__init__(self)
+		self._TTL: float = TTL
+		self._blocklists: OrderedDict = OrderedDict()
+		# the listener thread invalidates entries while requests read and store them
+		self._lock: Lock = Lock()
+		# every invalidation increments the generation, queries that started before a user's last invalidation aren't stored.
+		# invalidations older than the floor have been forgotten, so queries that started before it aren't stored for anyone
+		self._generation: int = 0
+		self._floor: int = 0
+		self._invalidations: OrderedDict[int, int] = OrderedDict()
+		self._max_invalidations: int = max_invalidations
 
 
-	@ArgsCache(60)
 	def user_blocked_tags(self, user_id: int) -> Set[str] :
-		data = self.query(
-			"""
-			SELECT tags.tag
-			FROM kheina.public.tag_blocking
-				INNER JOIN kheina.public.tags
-					ON tags.tag_id = blocked
-						AND tags.deprecated = false
-			WHERE user_id = %s;
-			""",
-			(user_id,),
-			fetch_all=True,
-		)
-
-		return set(data)
-
-
-	@ArgsCache(60)
+		return set(self.user_blocklist(user_id).tags)
+
+
 	def user_blocked_users(self, user_id: int) -> Set[str] :
-		data = self.query(
-			"""
-			SELECT users.handle
-			FROM kheina.public.user_blocking
-				INNER JOIN kheina.public.users
-					ON users.user_id = blocked
-			WHERE user_id = %s;
-			""",
-			(user_id,),
-			fetch_all=True,
-		)
-
-		return set(data)
+		return set(self.user_blocklist(user_id).users)
+
+
+	_blocked_tags_query: str = """
+		SELECT tag_blocking.user_id, tags.tag, tags.tag_id
+		FROM kheina.public.tag_blocking
+			INNER JOIN kheina.public.tags
+				ON tags.tag_id = blocked
+					AND tags.deprecated = false
+		WHERE tag_blocking.user_id = ANY(%s);
+	"""
+
+	_blocked_users_query: str = """
+		SELECT user_blocking.user_id, users.handle, users.user_id
+		FROM kheina.public.user_blocking
+			INNER JOIN kheina.public.users
+				ON users.user_id = blocked
+		WHERE user_blocking.user_id = ANY(%s);
+	"""
+
+
+	def _store_blocklists(self, generation: int, user_ids: List[int], tags: List[Tuple[int, str, int]], users: List[Tuple[int, str, int]]) -> Dict[int, Blocklist] :
+		blocked_tags: Dict[int, List[Tuple[str, int]]] = { user_id: [] for user_id in user_ids }
+		blocked_users: Dict[int, List[Tuple[str, int]]] = { user_id: [] for user_id in user_ids }
+
+		for user_id, tag, tag_id in tags :
+			blocked_tags[user_id].append((tag, tag_id))
+
+		for user_id, handle, blocked_id in users :
+			blocked_users[user_id].append((handle, blocked_id))
+
+		blocklists: Dict[int, Blocklist] = { }
+		exp: float = time() + self._TTL
+
+		for user_id in user_ids :
+			blocklists[user_id] = Blocklist(
+				tags=frozenset(tag for tag, _ in blocked_tags[user_id]),
+				tag_mask=tag_mask(tag_id for _, tag_id in blocked_tags[user_id]),
+				users=frozenset(handle for handle, _ in blocked_users[user_id]),
+				user_ids=frozenset(blocked_id for _, blocked_id in blocked_users[user_id]),
+			)
+
+		with self._lock :
+			if generation < self._floor :
+				return blocklists
+
+			for user_id in user_ids :
+				# the query may have read rows from before an invalidation that arrived while it ran
+				if self._invalidations.get(user_id, 0) > generation :
+					continue
+
+				# pop first so that the cache stays ordered by expiration
+				self._blocklists.pop(user_id, None)
+				self._blocklists[user_id] = (exp, blocklists[user_id])
+
+		return blocklists
+
+
+	def _cached_blocklists(self, user_ids: Set[int]) -> Tuple[int, Dict[int, Blocklist]] :
+		"""
+		returns the current generation and the cached blocklists of each user, the generation must be passed to _store_blocklists
+		"""
+		blocklists: Dict[int, Blocklist] = { }
+
+		with self._lock :
+			__clear_cache__(self._blocklists, time)
+
+			for user_id in user_ids :
+				cached: Optional[Tuple[float, Blocklist]] = self._blocklists.get(user_id)
+				if cached :
+					blocklists[user_id] = cached[1]
+
+			return self._generation, blocklists
+
+
+	def user_blocklists(self, user_ids: Iterable[int]) -> Dict[int, Blocklist] :
+		"""
+		retrieves the blocklists of every user provided, only users that are not already cached locally are queried.
+		"""
+		user_ids: Set[int] = set(user_ids)
+		generation, blocklists = self._cached_blocklists(user_ids)
+		remote_ids: List[int] = list(user_ids - blocklists.keys())
+
+		if remote_ids :
+			tags = self.query(self._blocked_tags_query, (remote_ids,), fetch_all=True)
+			users = self.query(self._blocked_users_query, (remote_ids,), fetch_all=True)
+			blocklists.update(self._store_blocklists(generation, remote_ids, tags, users))
+
+		return blocklists
+
+
+	async def user_blocklists_async(self, user_ids: Iterable[int]) -> Dict[int, Blocklist] :
+		user_ids: Set[int] = set(user_ids)
+		generation, blocklists = self._cached_blocklists(user_ids)
+		remote_ids: List[int] = list(user_ids - blocklists.keys())
+
+		if remote_ids :
+			# these share a single connection, so there's nothing to be gained by running them concurrently
+			tags = await self.query_async(self._blocked_tags_query, (remote_ids,), fetch_all=True)
+			users = await self.query_async(self._blocked_users_query, (remote_ids,), fetch_all=True)
+			blocklists.update(self._store_blocklists(generation, remote_ids, tags, users))
+
+		return blocklists
+
+
+	def user_blocklist(self, user_id: int) -> Blocklist :
+		return self.user_blocklists((user_id,))[user_id]
+
+
+	async def user_blocklist_async(self, user_id: int) -> Blocklist :
+		return (await self.user_blocklists_async((user_id,)))[user_id]
+
+
+	def invalidate(self, user_id: int) -> None :
+		with self._lock :
+			self._generation += 1
+			self._blocklists.pop(user_id, None)
+			self._invalidations.pop(user_id, None)
+			self._invalidations[user_id] = self._generation
+
+			while len(self._invalidations) > self._max_invalidations :
+				self._floor = max(self._floor, self._invalidations.popitem(last=False)[1])
+
+
+	def invalidate_all(self) -> None :
+		with self._lock :
+			self._generation += 1
+			self._floor = self._generation
+			self._blocklists.clear()
+			self._invalidations.clear()
+
+
+	def listen(self, channel: str = 'blocklist_updates') -> Thread :
+		"""
+		starts a daemon thread that LISTENs on the given channel and drops a user's cached blocklist whenever their user id is received as a notification payload.
+		the channel is fed by the triggers in BlocklistTriggers, which cover changes to blocks as well as blocked users' handles and blocked tags being renamed or deprecated.
+		since every change to a cached blocklist is pushed, the TTL passed to UserBlocking can be raised to hours, but only once all of BlocklistTriggers is installed.
+		"""
+		assert channel.isidentifier(), 'channel must be a valid identifier.'
+		thread: Thread = Thread(target=self._listen, args=(channel,), daemon=True)
+		thread.start()
+		return thread
+
+
+	def _listen(self, channel: str) -> None :
+		while Terminated.alive :
+			conn: Optional[Connection] = None
+
+			try :
+				conn = dbConnect(**db)
+				conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+
+				with conn.cursor() as cur :
+					cur.execute(f'LISTEN {channel};')
+
+				# notifications sent while we weren't listening are lost, so anything cached may be stale
+				self.invalidate_all()
+				self.logger.info(f'listening for blocklist updates on {channel}.')
+
+				while Terminated.alive :
+					if not select([conn], [], [], 5)[0] :
+						continue
+
+					conn.poll()
+
+					while conn.notifies :
+						self.invalidate(int(conn.notifies.pop(0).payload))
+
+			except Exception as e :
+				self.logger.warning('blocklist listener disconnected, attempting to reconnect.', exc_info=e)
+				sleep(1)
+
+			finally :
+				if conn :
+					conn.close()
@@ -7,6 +7,7 @@ from math import sqrt
 from time import time
 from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Set, Tuple
 
+from kh_common.metrics import CounterValue, cache_requests
 from kh_common.utilities import __clear_cache__
 
 from .key_value_store import KeyValueStore
@@ -95,6 +96,9 @@ def ArgsCache(TTL_seconds:float=0, TTL_minutes:float=0, TTL_hours:float=0, TTL_d
 
 	def decorator(func: Callable) -> Callable :
 
+		hits: CounterValue = cache_requests.labels(func.__qualname__, 'hit')
+		misses: CounterValue = cache_requests.labels(func.__qualname__, 'miss')
+
 		if iscoroutinefunction(func) :
 			@wraps(func)
 			async def wrapper(*key: Tuple[Any], **kwargs:Dict[str, Any]) -> Any :
@@ -102,8 +106,10 @@ def ArgsCache(TTL_seconds:float=0, TTL_minutes:float=0, TTL_hours:float=0, TTL_d
 					__clear_cache__(decorator.cache, time)
 
 				if key in decorator.cache :
+					hits.inc()
 					return copy(decorator.cache[key][1])
 
+				misses.inc()
 				data: Any = await func(*key, **kwargs)
 				decorator.cache[key] = (time() + TTL, data)
 
@@ -115,8 +121,10 @@ def ArgsCache(TTL_seconds:float=0, TTL_minutes:float=0, TTL_hours:float=0, TTL_d
 				__clear_cache__(decorator.cache, time)
 
 				if key in decorator.cache :
+					hits.inc()
 					return copy(decorator.cache[key][1])
 
+				misses.inc()
 				data: Any = func(*key, **kwargs)
 				decorator.cache[key] = (time() + TTL, data)
 
@@ -143,6 +151,8 @@ def KwargsCache(TTL_seconds:float=0, TTL_minutes:float=0, TTL_hours:float=0, TTL
 		arg_spec: FullArgSpec = getfullargspec(func)
 		kw = dict(zip(arg_spec.args[-len(arg_spec.defaults):], arg_spec.defaults)) if arg_spec.defaults else { }
 		arg_spec: Tuple[str] = tuple(arg_spec.args)
+		hits: CounterValue = cache_requests.labels(func.__qualname__, 'hit')
+		misses: CounterValue = cache_requests.labels(func.__qualname__, 'miss')
 
 		if iscoroutinefunction(func) :
 			@wraps(func)
@@ -153,8 +163,10 @@ def KwargsCache(TTL_seconds:float=0, TTL_minutes:float=0, TTL_hours:float=0, TTL
 					__clear_cache__(decorator.cache, time)
 
 				if key in decorator.cache :
+					hits.inc()
 					return copy(decorator.cache[key][1])
 
+				misses.inc()
 				data: Any = await func(*args, **kwargs)
 				decorator.cache[key] = (time() + TTL, data)
 
@@ -168,8 +180,10 @@ def KwargsCache(TTL_seconds:float=0, TTL_minutes:float=0, TTL_hours:float=0, TTL
 				__clear_cache__(decorator.cache, time)
 
 				if key in decorator.cache :
+					hits.inc()
 					return copy(decorator.cache[key][1])
 
+				misses.inc()
 				data: Any = func(*args, **kwargs)
 				decorator.cache[key] = (time() + TTL, data)
 
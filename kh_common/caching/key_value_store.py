@@ -5,14 +5,22 @@ from time import time
 from typing import Any, Dict, Iterable, List, Set, Tuple
 from concurrent.futures import ThreadPoolExecutor
 from asyncio import get_event_loop
+from contextvars import copy_context
 from functools import partial, wraps
 
 import aerospike
 
 from kh_common.config.constants import environment
+from kh_common.metrics import CounterValue, HistogramValue, aerospike_latency, cache_requests
+from kh_common.tracing import span
 from kh_common.utilities import __clear_cache__
 
 
+_put_latency: HistogramValue = aerospike_latency.labels('put')
+_get_latency: HistogramValue = aerospike_latency.labels('get')
+_get_many_latency: HistogramValue = aerospike_latency.labels('get_many')
+
+
 class KeyValueStore :
 
 	_client = None
@@ -29,33 +37,40 @@ class KeyValueStore :
 		self._set: str = set
 		self._get_lock: Lock = Lock()
 		self._get_many_lock: Lock = Lock()
+		self._hits: CounterValue = cache_requests.labels(f'{namespace}.{set}', 'hit')
+		self._misses: CounterValue = cache_requests.labels(f'{namespace}.{set}', 'miss')
 
 
 	def put(self: 'KeyValueStore', key: str, data: Any, TTL: int = 0) :
-		KeyValueStore._client.put(
-			(self._namespace, self._set, key),
-			{ 'data': data },
-			meta={
-				'ttl': TTL,
-			},
-			policy={
-				'max_retries': 3,
-			},
-		)
+		with span('aerospike', op='put'), _put_latency.time() :
+			KeyValueStore._client.put(
+				(self._namespace, self._set, key),
+				{ 'data': data },
+				meta={
+					'ttl': TTL,
+				},
+				policy={
+					'max_retries': 3,
+				},
+			)
 		self._cache[key] = (time() + self._local_TTL, data)
 
 
 	@wraps(put)
 	async def put_async(self: 'KeyValueStore', *args, **kwargs) :
 		with ThreadPoolExecutor() as threadpool :
-			return await get_event_loop().run_in_executor(threadpool, partial(self.put, *args, **kwargs))
+			return await get_event_loop().run_in_executor(threadpool, copy_context().run, partial(self.put, *args, **kwargs))
 
 
 	def _get(self: 'KeyValueStore', key: str) :
 		if key in self._cache :
+			self._hits.inc()
 			return copy(self._cache[key][1])
 
-		_, _, data = KeyValueStore._client.get((self._namespace, self._set, key))
+		self._misses.inc()
+
+		with span('aerospike', op='get'), _get_latency.time() :
+			_, _, data = KeyValueStore._client.get((self._namespace, self._set, key))
 		self._cache[key] = (time() + self._local_TTL, data['data'])
 
 		return copy(data['data'])
@@ -70,15 +85,18 @@ class KeyValueStore :
 	async def get_async(self: 'KeyValueStore', *args, **kwargs) :
 		async with self._get_lock :
 			with ThreadPoolExecutor() as threadpool :
-				return await get_event_loop().run_in_executor(threadpool, partial(self.get, *args, **kwargs))
+				return await get_event_loop().run_in_executor(threadpool, copy_context().run, partial(self.get, *args, **kwargs))
 
 
 	def _get_many(self: 'KeyValueStore', keys: Iterable[str]) :
 		keys: Set[str] = set(keys)
 		remote_keys: Set[str] = keys - self._cache.keys()
+		self._hits.inc(len(keys) - len(remote_keys))
+		self._misses.inc(len(remote_keys))
 
 		if remote_keys :
-			data: List[Tuple[Any]] = KeyValueStore._client.get_many(list(map(lambda k : (self._namespace, self._set, k), remote_keys)))
+			with span('aerospike', op='get_many'), _get_many_latency.time() :
+				data: List[Tuple[Any]] = KeyValueStore._client.get_many(list(map(lambda k : (self._namespace, self._set, k), remote_keys)))
 			data_map: Dict[str, Any] = { }
 
 			exp: float = time() + self._local_TTL
@@ -118,7 +136,7 @@ class KeyValueStore :
 	async def get_many_async(self: 'KeyValueStore', *args, **kwargs) :
 		async with self._get_many_lock :
 			with ThreadPoolExecutor() as threadpool :
-				return await get_event_loop().run_in_executor(threadpool, partial(self.get_many, *args, **kwargs))
+				return await get_event_loop().run_in_executor(threadpool, copy_context().run, partial(self.get_many, *args, **kwargs))
 
 
 	def remove(self: 'KeyValueStore', key: str) -> None :
@@ -136,7 +154,7 @@ class KeyValueStore :
 	@wraps(remove)
 	async def remove_async(self: 'KeyValueStore', *args, **kwargs) :
 		with ThreadPoolExecutor() as threadpool :
-			return await get_event_loop().run_in_executor(threadpool, partial(self.remove, *args, **kwargs))
+			return await get_event_loop().run_in_executor(threadpool, copy_context().run, partial(self.remove, *args, **kwargs))
 
 
 	def exists(self: 'KeyValueStore', key: str) -> bool :
@@ -157,7 +175,7 @@ class KeyValueStore :
 	@wraps(exists)
 	async def exists_async(self: 'KeyValueStore', *args, **kwargs) :
 		with ThreadPoolExecutor() as threadpool :
-			return await get_event_loop().run_in_executor(threadpool, partial(self.exists, *args, **kwargs))
+			return await get_event_loop().run_in_executor(threadpool, copy_context().run, partial(self.exists, *args, **kwargs))
 
 
 	def truncate(self: 'KeyValueStore') -> None :
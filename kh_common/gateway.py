@@ -1,11 +1,449 @@
-from asyncio import sleep
-from typing import Any, Callable, Dict, Iterable, Set, Type
+from asyncio import FIRST_COMPLETED, AbstractEventLoop, Future, Task, TimeoutError, ensure_future, get_running_loop, shield, sleep, wait, wait_for
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import Context, ContextVar, Token
+from copy import copy
+from time import monotonic
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type, Union, get_args, get_origin
 
-from aiohttp import ClientResponse, ClientResponseError, ClientTimeout
-from aiohttp import request as async_request
-from pydantic import BaseModel, parse_obj_as
+from aiohttp import ClientError, ClientResponse, ClientResponseError, ClientSession, ClientTimeout, ContentTypeError, DummyCookieJar, TCPConnector
+from pydantic import BaseConfig, BaseModel, ValidationError, create_model
+from pydantic.fields import ModelField
+from ujson import loads
 
+from kh_common.exceptions.http_error import ServiceUnavailable
 from kh_common.hashing import Hashable
+from kh_common.metrics import CounterValue, GaugeValue, cache_requests, gateway_circuit_state, gateway_concurrency_limit, gateway_hedges, gateway_in_flight, gateway_shed
+from kh_common.tracing import Span, child_span, span
+from kh_common.utilities.json import JsonArrayDecoder
+
+
+# options for the connector shared by every Gateway on an event loop. changes only apply to sessions created afterwards
+connector_options: Dict[str, Any] = {
+	'limit': 256,
+	'limit_per_host': 64,
+	'ttl_dns_cache': 300,
+	'keepalive_timeout': 30,
+}
+
+_sessions: Dict[AbstractEventLoop, ClientSession] = { }
+
+
+def session() -> ClientSession :
+	"""
+	returns the ClientSession shared by every Gateway on the running event loop, so that connections are pooled and kept alive between calls
+	"""
+	loop: AbstractEventLoop = get_running_loop()
+	s: ClientSession = _sessions.get(loop)
+
+	if s and not s.closed :
+		return s
+
+	# sessions can't be used across loops, drop any belonging to loops that have since closed
+	for closed in [l for l in _sessions if l.is_closed()] :
+		del _sessions[closed]
+
+	# cookies set by one response must never be sent with another caller's request, so the session doesn't keep any
+	s = _sessions[loop] = ClientSession(connector=TCPConnector(**connector_options), cookie_jar=DummyCookieJar())
+	return s
+
+
+async def close_sessions() -> None :
+	"""
+	closes the shared session of the running event loop. should be called on shutdown, ServerApp does this automatically
+	"""
+	s: ClientSession = _sessions.pop(get_running_loop(), None)
+
+	if s :
+		await s.close()
+
+
+# remaining seconds the upstream has to respond, sent with every request made under a deadline
+DeadlineHeader: str = 'x-request-deadline'
+
+# absolute deadline, in monotonic seconds, of the current request. set by deadline() or KhDeadlineMiddleware
+request_deadline: ContextVar[Optional[float]] = ContextVar('kh_request_deadline', default=None)
+
+# (method, url, headers, params) of a cached GET
+CacheKey = Tuple[str, str, Tuple[Tuple[str, str], ...], Tuple[Tuple[str, str], ...]]
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[None] :
+	"""
+	bounds every gateway call made within the block, including retries and backoff, to finish within seconds.
+	an existing, earlier deadline is kept.
+	"""
+	current: Optional[float] = request_deadline.get()
+	token: Token = request_deadline.set(min(monotonic() + seconds, current or float('inf')))
+
+	try :
+		yield
+
+	finally :
+		request_deadline.reset(token)
+
+
+async def json_decoder(response: ClientResponse) -> Any :
+	"""
+	decodes the response body as json with ujson, rather than the stdlib json used by ClientResponse.json
+	"""
+	if 'json' not in response.content_type :
+		raise ContentTypeError(
+			response.request_info,
+			response.history,
+			message=f'attempt to decode json with unexpected mimetype: {response.content_type}',
+			headers=response.headers,
+		)
+
+	body: bytes = await response.read()
+	return loads(body) if body.strip() else None
+
+
+def validator(model: Any) -> Optional[Callable[[Any], Any]] :
+	"""
+	compiles a function that validates data against model, equivalent to parse_obj_as(model, data) but without rebuilding the parsing type on each call.
+	model can be any type pydantic can validate, including generics such as List[BaseModel]
+	"""
+	if model is None :
+		return None
+
+	field: ModelField = ModelField.infer(name='__root__', value=..., annotation=model, class_validators=None, config=BaseConfig)
+	# only used to format validation errors
+	error_model: Type[BaseModel] = create_model(f'ParsingModel[{getattr(model, "__name__", str(model))}]', __root__=(model, ...))
+
+	def validate(data: Any) -> Any :
+		value, errors = field.validate(data, { }, loc='__root__')
+
+		if errors :
+			raise ValidationError([errors], error_model)
+
+		return value
+
+	return validate
+
+
+class CircuitBreaker :
+	"""
+	tracks the health of an upstream endpoint over a sliding window of one second buckets.
+	once enough requests within the window have failed the circuit opens and every request is rejected until the cooldown passes,
+	after which a limited number of probe requests are let through (half-open). a healthy probe closes the circuit, a failed one reopens it.
+	each allowed request is given a ticket, the generation of the circuit when it was sent. the generation changes whenever the circuit opens or closes,
+	so the outcomes of requests sent before the latest transition, such as slow requests still in flight when the circuit opened, are ignored.
+	"""
+
+	Closed: int = 0
+	Open: int = 1
+	HalfOpen: int = 2
+
+	def __init__(
+		self: 'CircuitBreaker',
+		name: str,
+		failure_rate: float = 0.5,
+		minimum_requests: int = 20,
+		window: int = 10,
+		cooldown: float = 5,
+		probes: int = 1,
+	) -> None :
+		"""
+		:param name: name of the endpoint, used as the metrics label
+		:param failure_rate: fraction of failed requests within the window that opens the circuit
+		:param minimum_requests: the circuit won't open until at least this many requests have completed within the window
+		:param window: length of the sliding window, in seconds
+		:param cooldown: how long, in seconds, the circuit stays open before letting probes through
+		:param probes: how many concurrent requests are let through while half-open
+		"""
+		self.name: str = name
+		self._failure_rate: float = failure_rate
+		self._minimum_requests: int = minimum_requests
+		self._window: int = window
+		self._cooldown: float = cooldown
+		self._probes: int = probes
+		# each bucket is [second, requests, failures]
+		self._buckets: List[List[int]] = [[0, 0, 0] for _ in range(window)]
+		self._opened: float = 0
+		self._probing: int = 0
+		self._generation: int = 0
+		self.state: int = self.Closed
+		self._state_metric: GaugeValue = gateway_circuit_state.labels(name)
+		self._state_metric.set(self.state)
+
+
+	def _transition(self: 'CircuitBreaker', state: int) -> None :
+		self.state = state
+		self._state_metric.set(state)
+
+		if state == self.HalfOpen :
+			return
+
+		self._generation += 1
+		self._probing = 0
+
+		if state == self.Open :
+			self._opened = monotonic()
+
+		elif state == self.Closed :
+			for bucket in self._buckets :
+				bucket[:] = [0, 0, 0]
+
+
+	def counts(self: 'CircuitBreaker') -> List[int] :
+		"""
+		returns [requests, failures] within the current window
+		"""
+		oldest: int = int(monotonic()) - self._window
+		requests: int = 0
+		failures: int = 0
+
+		for second, r, f in self._buckets :
+			if second > oldest :
+				requests += r
+				failures += f
+
+		return [requests, failures]
+
+
+	def allow(self: 'CircuitBreaker') -> Optional[int] :
+		"""
+		returns a ticket if a request may be sent, otherwise None. every ticket must be passed back to record once the request completes
+		"""
+		if self.state == self.Closed :
+			return self._generation
+
+		if self.state == self.Open :
+			if monotonic() - self._opened < self._cooldown :
+				return None
+
+			self._transition(self.HalfOpen)
+
+		if self._probing >= self._probes :
+			return None
+
+		self._probing += 1
+		return self._generation
+
+
+	def record(self: 'CircuitBreaker', ticket: int, healthy: Optional[bool]) -> None :
+		"""
+		records the outcome of an allowed request. None means the request ended without telling us anything about the endpoint (ex: it was cancelled)
+		:param ticket: the ticket returned by allow when the request was sent
+		"""
+		if ticket != self._generation :
+			# sent before the circuit last opened or closed
+			return
+
+		if self.state != self.Closed :
+			# no requests are allowed while open, so any current ticket outside of closed belongs to a probe
+			self._probing = max(self._probing - 1, 0)
+
+			if healthy is True :
+				self._transition(self.Closed)
+
+			elif healthy is False :
+				self._transition(self.Open)
+
+			return
+
+		if healthy is None :
+			return
+
+		second: int = int(monotonic())
+		bucket: List[int] = self._buckets[second % self._window]
+
+		if bucket[0] != second :
+			bucket[:] = [second, 0, 0]
+
+		bucket[1] += 1
+
+		if healthy :
+			return
+
+		bucket[2] += 1
+		requests, failures = self.counts()
+
+		if requests >= self._minimum_requests and failures >= requests * self._failure_rate :
+			self._transition(self.Open)
+
+
+class ConcurrencyLimiter :
+	"""
+	caps the number of requests in flight to an upstream endpoint, adjusting the cap with additive increase, multiplicative decrease (AIMD).
+	each healthy response raises the limit by 1 / limit, so roughly one per limit's worth of requests, while a failure multiplies it by backoff.
+	the limit decreases at most once per round trip: each acquired request is given a ticket, and only failures of requests acquired since the last decrease lower it again,
+	so a burst of failures from requests that were already in flight counts as a single congestion signal.
+	requests over the limit are rejected immediately rather than queued, so a slow upstream can't pile up coroutines.
+	"""
+
+	def __init__(
+		self: 'ConcurrencyLimiter',
+		name: str,
+		initial_limit: int = 64,
+		min_limit: int = 1,
+		max_limit: int = 256,
+		backoff: float = 0.9,
+	) -> None :
+		"""
+		:param name: name of the endpoint, used as the metrics label
+		:param initial_limit: starting concurrency limit
+		:param min_limit: the limit never decreases below this
+		:param max_limit: the limit never increases above this
+		:param backoff: multiplier applied to the limit on failure
+		"""
+		self.name: str = name
+		self.limit: float = initial_limit
+		self.in_flight: int = 0
+		self._epoch: int = 0
+		self._min_limit: int = min_limit
+		self._max_limit: int = max_limit
+		self._backoff: float = backoff
+		self._limit_metric: GaugeValue = gateway_concurrency_limit.labels(name)
+		self._in_flight_metric: GaugeValue = gateway_in_flight.labels(name)
+		self._limit_metric.set(initial_limit)
+
+
+	def acquire(self: 'ConcurrencyLimiter') -> Optional[int] :
+		"""
+		returns a ticket if a request may be sent, otherwise None. every ticket must be passed back to release once the request completes
+		"""
+		if self.in_flight >= int(self.limit) :
+			return None
+
+		self.in_flight += 1
+		self._in_flight_metric.set(self.in_flight)
+		return self._epoch
+
+
+	def release(self: 'ConcurrencyLimiter', ticket: int, healthy: Optional[bool]) -> None :
+		"""
+		releases an acquired request. None means the request ended without telling us anything about the endpoint (ex: it was cancelled)
+		:param ticket: the ticket returned by acquire when the request was sent
+		"""
+		# only grow the limit while it's actually being used, otherwise a quiet period would let it grow unbounded
+		in_use: bool = self.in_flight * 2 >= self.limit
+		self.in_flight -= 1
+		self._in_flight_metric.set(self.in_flight)
+
+		if healthy is True and in_use :
+			self.limit = min(self.limit + 1 / self.limit, self._max_limit)
+
+		elif healthy is False and ticket == self._epoch :
+			self._epoch += 1
+			self.limit = max(self.limit * self._backoff, self._min_limit)
+
+		else :
+			return
+
+		self._limit_metric.set(self.limit)
+
+
+class LatencyTracker :
+	"""
+	keeps the latencies of an endpoint's most recent successful requests to estimate quantiles from.
+	the sorted samples are reused until enough new latencies have been observed, so estimating a quantile is usually just an index.
+	"""
+
+	def __init__(self: 'LatencyTracker', size: int = 200, minimum_samples: int = 20, resort: int = 10) -> None :
+		"""
+		:param size: number of recent latencies kept
+		:param minimum_samples: quantiles aren't estimated until this many latencies have been observed
+		:param resort: how many new latencies are observed before the estimate is recomputed
+		"""
+		self._samples: Deque[float] = deque(maxlen=size)
+		self._minimum_samples: int = minimum_samples
+		self._resort: int = resort
+		self._sorted: List[float] = []
+		self._unsorted: int = 0
+
+
+	def observe(self: 'LatencyTracker', seconds: float) -> None :
+		self._samples.append(seconds)
+		self._unsorted += 1
+
+
+	def quantile(self: 'LatencyTracker', q: float) -> Optional[float] :
+		if len(self._samples) < self._minimum_samples :
+			return None
+
+		if self._unsorted >= self._resort or not self._sorted :
+			self._sorted = sorted(self._samples)
+			self._unsorted = 0
+
+		return self._sorted[min(int(q * len(self._sorted)), len(self._sorted) - 1)]
+
+
+class ResponseCache :
+	"""
+	bounded in-memory store of decoded gateway responses, evicting the least recently stored entry once full.
+	responses are kept for their Cache-Control max-age, capped at ttl, or for ttl if the upstream doesn't send one. no-store responses aren't kept.
+	responses with an ETag are kept past expiry so they can be revalidated with If-None-Match instead of being downloaded again.
+	"""
+
+	def __init__(self: 'ResponseCache', max_size: int = 1024, ttl: float = 60) -> None :
+		"""
+		:param max_size: maximum number of responses held
+		:param ttl: maximum number of seconds a response is considered fresh
+		"""
+		self._max_size: int = max_size
+		self._ttl: float = ttl
+		# key -> (expires, etag, value)
+		self._entries: OrderedDict[CacheKey, Tuple[float, Optional[str], Any]] = OrderedDict()
+
+
+	def max_age(self: 'ResponseCache', cache_control: Optional[str]) -> Optional[float] :
+		"""
+		returns how many seconds a response with the given Cache-Control header is fresh for, or None if it must not be stored
+		"""
+		if not cache_control :
+			return self._ttl
+
+		max_age: float = self._ttl
+
+		for directive in cache_control.lower().split(',') :
+			directive = directive.strip()
+
+			if directive == 'no-store' :
+				return None
+
+			elif directive == 'no-cache' :
+				max_age = 0
+
+			elif directive.startswith('max-age=') :
+				try :
+					max_age = min(max_age, max(float(directive[8:]), 0))
+
+				except ValueError :
+					pass
+
+		return max_age
+
+
+	def get(self: 'ResponseCache', key: CacheKey) -> Optional[Tuple[float, Optional[str], Any]] :
+		"""
+		returns the entry for key as (expires, etag, value), which may be stale. stale entries without an etag are dropped
+		"""
+		entry: Optional[Tuple[float, Optional[str], Any]] = self._entries.get(key)
+
+		if entry and not entry[1] and entry[0] <= monotonic() :
+			del self._entries[key]
+			return None
+
+		return entry
+
+
+	def put(self: 'ResponseCache', key: CacheKey, max_age: float, etag: Optional[str], value: Any) -> None :
+		if not max_age and not etag :
+			self._entries.pop(key, None)
+			return
+
+		self._entries.pop(key, None)
+		self._entries[key] = (monotonic() + max_age, etag, value)
+
+		while len(self._entries) > self._max_size :
+			self._entries.popitem(last=False)
+
+
+	def clear(self: 'ResponseCache') -> None :
+		self._entries.clear()
 
 
 class Gateway(Hashable) :
@@ -20,6 +458,14 @@ class Gateway(Hashable) :
 	}
 
 
+	# methods that are safe to send more than once at the same time
+	IdempotentMethods = {
+		'get',
+		'head',
+		'options',
+	}
+
+
 	def __init__(
 		self: 'Gateway',
 		endpoint: str,
@@ -29,7 +475,12 @@ class Gateway(Hashable) :
 		attempts: int = 3,
 		status_to_retry: Iterable[int] = [429, 502, 503, 504],
 		backoff: Callable = lambda attempt : attempt ** 2,
-		decoder: Callable = ClientResponse.json,
+		decoder: Callable = json_decoder,
+		circuit_breaker: Union[CircuitBreaker, bool] = False,
+		concurrency_limiter: Union[ConcurrencyLimiter, bool] = False,
+		cache: Union[ResponseCache, bool] = False,
+		hedge: bool = False,
+		deadline: Optional[float] = None,
 	) -> None :
 		"""
 		Defines an endpoint to be called later.
@@ -42,16 +493,160 @@ class Gateway(Hashable) :
 		:param attempts: how many times to attempt to reach the endpoint, in total
 		:param status_to_retry: which http status codes should be retried
 		:param backoff: backoff function to run on failure to determine how many seconds to wait before retrying call. Must accept attempt count as param, defaults to attempt ** 2
-		:param decoder: async function used to decode the response body. accepts ClientResponse as arg. defaults to ClientResponse.json
+		:param decoder: async function used to decode the response body. accepts ClientResponse as arg. defaults to json_decoder
+		:param circuit_breaker: circuit breaker guarding the endpoint. True creates one with default settings. disabled by default
+		:param concurrency_limiter: adaptive concurrency limit for the endpoint. True creates one with default settings. disabled by default
+		:param cache: caches GET responses and coalesces identical GETs that are in flight at the same time. True creates a ResponseCache with default settings.
+			responses are cached per url, params and headers, including authorization and cookies. coalesced requests are sent without the caller's deadline or trace.
+		:param hedge: for idempotent methods, sends a second request if the first hasn't responded within the endpoint's recent p95 latency and uses whichever responds first
+		:param deadline: how long, in seconds, a call may take in total across every attempt and backoff. the remaining time is sent to the upstream in the x-request-deadline header.
+			calls made under a request_deadline, such as within deadline() or a request handled with KhDeadlineMiddleware, use the earlier of the two
 		"""
 		self._endpoint: str = endpoint
 		self._model: Type = model
 		self._method: str = method.lower()
-		self._timeout: float = timeout
+		self._timeout: ClientTimeout = ClientTimeout(timeout)
 		self._attempts: int = attempts
 		self._status_to_retry: Set[int] = set(status_to_retry)
 		self._backoff: Callable = backoff
 		self._decoder: Callable = decoder
+		self._validate: Optional[Callable[[Any], Any]] = validator(model)
+		# list models can also be streamed item by item
+		self._validate_item: Optional[Callable[[Any], Any]] = validator(get_args(model)[0]) if get_origin(model) is list and get_args(model) else None
+		self.circuit_breaker: Optional[CircuitBreaker] = CircuitBreaker(endpoint) if circuit_breaker is True else circuit_breaker or None
+		self.concurrency_limiter: Optional[ConcurrencyLimiter] = ConcurrencyLimiter(endpoint) if concurrency_limiter is True else concurrency_limiter or None
+		self._shed_open: CounterValue = gateway_shed.labels(endpoint, 'circuit_open')
+		self._shed_limit: CounterValue = gateway_shed.labels(endpoint, 'concurrency_limit')
+		self.cache: Optional[ResponseCache] = (ResponseCache() if cache is True else cache or None) if self._method == 'get' else None
+		self._in_flight: Dict[CacheKey, Task] = { }
+		self._cache_hit: CounterValue = cache_requests.labels(endpoint, 'hit')
+		self._cache_miss: CounterValue = cache_requests.labels(endpoint, 'miss')
+		self._cache_revalidated: CounterValue = cache_requests.labels(endpoint, 'revalidated')
+		self._deadline: Optional[float] = deadline
+		self.latency: Optional[LatencyTracker] = LatencyTracker() if hedge and self._method in self.IdempotentMethods else None
+		self._hedges_sent: CounterValue = gateway_hedges.labels(endpoint, 'sent')
+		self._hedges_won: CounterValue = gateway_hedges.labels(endpoint, 'won')
+
+
+	def _decode(self: 'Gateway', data: Any) -> Any :
+		if not self._validate :
+			return data
+
+		return self._validate(data)
+
+
+	def _acquire(self: 'Gateway', url: str) -> Tuple[Optional[int], Optional[int]] :
+		"""
+		returns the circuit breaker and concurrency limiter tickets for the request, to be passed to _release once it completes
+		"""
+		breaker: Optional[int] = None
+		limiter: Optional[int] = None
+
+		if self.circuit_breaker :
+			breaker = self.circuit_breaker.allow()
+
+			if breaker is None :
+				self._shed_open.inc()
+				raise ServiceUnavailable('upstream service is unavailable, circuit is open.', logdata={ 'url': url })
+
+		if self.concurrency_limiter :
+			limiter = self.concurrency_limiter.acquire()
+
+			if limiter is None :
+				if self.circuit_breaker :
+					self.circuit_breaker.record(breaker, None)
+
+				self._shed_limit.inc()
+				raise ServiceUnavailable('upstream service is at its concurrency limit.', logdata={ 'url': url })
+
+		return breaker, limiter
+
+
+	def _release(self: 'Gateway', tickets: Tuple[Optional[int], Optional[int]], healthy: Optional[bool]) -> None :
+		if self.circuit_breaker :
+			self.circuit_breaker.record(tickets[0], healthy)
+
+		if self.concurrency_limiter :
+			self.concurrency_limiter.release(tickets[1], healthy)
+
+
+	async def _request(self: 'Gateway', url: str, req: Dict[str, Any], key: Optional[CacheKey] = None) -> Any :
+		tickets: Tuple[Optional[int], Optional[int]] = self._acquire(url)
+		healthy: Optional[bool] = None
+		start: float = monotonic()
+		entry: Optional[Tuple[float, Optional[str], Any]] = self.cache.get(key) if key else None
+
+		if entry and entry[1] :
+			req = { **req, 'headers': { **req['headers'], 'if-none-match': entry[1] } }
+
+		try :
+			async with session().request(
+				self._method,
+				url,
+				**req,
+			) as response :
+				healthy = True
+
+				if self.latency :
+					self.latency.observe(monotonic() - start)
+
+				if entry and response.status == 304 :
+					self._cache_revalidated.inc()
+					self.cache.put(key, self.cache.max_age(response.headers.get('cache-control')) or 0, entry[1], entry[2])
+					return entry[2]
+
+				if not self._decoder :
+					return
+
+				data = self._decode(await self._decoder(response))
+
+				if key :
+					max_age: Optional[float] = self.cache.max_age(response.headers.get('cache-control'))
+
+					if max_age is not None :
+						self.cache.put(key, max_age, response.headers.get('etag'), data)
+
+				return data
+
+		except ClientResponseError as e :
+			# client errors mean the endpoint is up and answering
+			healthy = e.status < 500 and e.status != 429
+			raise
+
+		except (ClientError, TimeoutError) :
+			healthy = False
+			raise
+
+		finally :
+			self._release(tickets, healthy)
+
+
+	def _build(self: 'Gateway', body: Optional[dict], params: Optional[dict], auth: Optional[str], headers: Optional[Dict[str, str]]) -> Dict[str, Any] :
+		req: Dict[str, Any] = {
+			'timeout': self._timeout,
+			'raise_for_status': True,
+			'headers': {
+				'accept': 'application/json',
+			},
+		}
+
+		if self._method in self.MethodsWithoutBody :
+			req['params'] = body
+
+		else :
+			req['json'] = body
+
+		if params :
+			# body may be None for methods without a body, and shouldn't be modified in place
+			req['params'] = { **req['params'], **params } if req.get('params') else params
+
+		if headers :
+			req['headers'].update(headers)
+
+		if auth :
+			req['headers']['authorization'] = 'Bearer ' + str(auth)
+
+		return req
 
 
 	async def __call__(
@@ -70,54 +665,192 @@ class Gateway(Hashable) :
 		:param auth: auth will be passed to the authorization as a bearer token (NOTE: auth will override any authorization header passed via headers)
 		:param kwargs: any other keyword arguments will be passed to endpoint.format if a string format was provided for the endpoint
 		:return: decoded json response using the model provided upon initialization
-		:raises: all standard aiohttp errors on failure.
+		:raises: all standard aiohttp errors on failure, ServiceUnavailable if the request was shed by the circuit breaker or concurrency limiter.
 		"""
-		req = {
-			'timeout': ClientTimeout(self._timeout),
-			'raise_for_status': True,
-			'headers': {
-				'accept': 'application/json',
-			},
-		}
+		req: Dict[str, Any] = self._build(body, params, auth, headers)
+		url: str = self._endpoint.format(**kwargs)
 
-		if self._method in self.MethodsWithoutBody :
-			req['params'] = body
+		if self.cache :
+			# every header is part of the key, so responses to one user's authorization or cookies are never served to another
+			key: CacheKey = (
+				self._method,
+				url,
+				tuple(sorted((k.lower(), str(v)) for k, v in req['headers'].items())),
+				tuple(sorted((k, str(v)) for k, v in req['params'].items())) if req.get('params') else (),
+			)
+			entry: Optional[Tuple[float, Optional[str], Any]] = self.cache.get(key)
 
-		else :
-			req['json'] = body
+			if entry and entry[0] > monotonic() :
+				self._cache_hit.inc()
+				return copy(entry[2])
 
-		if params :
-			if 'params' in req :
-				req['params'].update(params)
+			self._cache_miss.inc()
 
-			else :
-				req['params'] = params
+			if key not in self._in_flight :
+				# the shared request is sent from an empty context so that it isn't bound by the first caller's deadline or recorded in their trace
+				task: Task = Context().run(ensure_future, self._send(url, req, key))
+				self._in_flight[key] = task
+				task.add_done_callback(lambda t : self._coalesced(key, t))
 
-		if headers :
-			req['headers'].update(headers)
+			# shielded so that one cancelled caller doesn't fail every other caller waiting on the same request
+			shared: Future = shield(self._in_flight[key])
+			expires: Optional[float] = request_deadline.get()
 
-		if auth :
-			req['headers']['authorization'] = 'Bearer ' + str(auth)
+			if expires :
+				# each caller still only waits until its own deadline
+				return copy(await wait_for(shared, max(expires - monotonic(), 0)))
+
+			return copy(await shared)
+
+		return await self._send(url, req)
+
+
+	def _coalesced(self: 'Gateway', key: CacheKey, task: Future) -> None :
+		self._in_flight.pop(key, None)
+
+		if not task.cancelled() :
+			# retrieve the exception so it isn't reported as unhandled when every caller was cancelled
+			task.exception()
+
+
+	async def _hedged(self: 'Gateway', url: str, req: Dict[str, Any], key: Optional[CacheKey], delay: float) -> Any :
+		primary: Task = ensure_future(self._request(url, req, key))
+		pending: Set[Task] = { primary }
+
+		try :
+			done, pending = await wait(pending, timeout=delay)
+
+			if done :
+				return primary.result()
+
+			self._hedges_sent.inc()
+			hedge: Task = ensure_future(self._request(url, req, key))
+			pending.add(hedge)
+
+			while pending :
+				done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+
+				for task in done :
+					if not task.exception() :
+						if task is hedge :
+							self._hedges_won.inc()
+
+						return task.result()
+
+			# both failed (the hedge may have been shed by the concurrency limiter), report the original failure
+			return primary.result()
+
+		finally :
+			for task in pending :
+				task.cancel()
+
+
+	async def _send(self: 'Gateway', url: str, req: Dict[str, Any], key: Optional[CacheKey] = None) -> Any :
+		expires: Optional[float] = request_deadline.get()
+
+		if self._deadline :
+			expires = min(monotonic() + self._deadline, expires or float('inf'))
+
+		with span('gateway', method=self._method, url=url) as s :
+			if s :
+				# propagate the trace to the upstream service
+				req['headers']['traceparent'] = s.traceparent()
+
+			for attempt in range(1, self._attempts + 1) :
+				if expires :
+					remaining: float = expires - monotonic()
+
+					if remaining <= 0 :
+						raise TimeoutError(f'deadline exceeded after {attempt - 1} attempts.')
+
+					req['timeout'] = ClientTimeout(min(self._timeout.total, remaining))
+					req['headers'][DeadlineHeader] = f'{remaining:.3f}'
+
+				try :
+					delay: Optional[float] = self.latency.quantile(0.95) if self.latency else None
+
+					if delay is None :
+						return await self._request(url, req, key)
+
+					return await self._hedged(url, req, key, delay)
+
+				except ClientResponseError as e :
+					if e.status not in self._status_to_retry or attempt == self._attempts :
+						raise
+
+					backoff: float = self._backoff(attempt)
+
+					if expires and monotonic() + backoff >= expires :
+						# the next attempt couldn't start before the deadline
+						raise
+
+					await sleep(backoff)
+
+
+	async def stream(
+		self: 'Gateway',
+		body: dict = None,
+		params: dict = None,
+		auth: str = None,
+		headers: Dict[str, str] = None,
+		**kwargs,
+	) -> AsyncIterator[Any] :
+		"""
+		Calls pre-defined endpoint the same way as __call__, but decodes a json array response incrementally, yielding each item as soon as it's received.
+		If the model provided upon initialization is a list, such as List[BaseModel], each item is validated against the list's item type.
+		Streams aren't retried or cached, and the decoder provided upon initialization isn't used.
+		The connection and concurrency ticket are held until the stream is exhausted or closed, so consumers that may stop early must close it.
+		ex:
+		items = gateway.stream()
+		try :
+			async for item in items :
+				...
+		finally :
+			await items.aclose()
+		:yields: each decoded item of the response array
+		:raises: all standard aiohttp errors on failure, ValueError if the response isn't a json array
+		"""
+		req: Dict[str, Any] = self._build(body, params, auth, headers)
+		url: str = self._endpoint.format(**kwargs)
+
+		# the span isn't made current, since the consumer's context would see it between items, and an early exit
+		# may close the generator from another context entirely
+		s: Optional[Span] = child_span('gateway', method=self._method, url=url)
+
+		if s :
+			req['headers']['traceparent'] = s.traceparent()
+
+		tickets: Optional[Tuple[Optional[int], Optional[int]]] = None
+		healthy: Optional[bool] = None
+
+		try :
+			tickets = self._acquire(url)
+
+			async with session().request(
+				self._method,
+				url,
+				**req,
+			) as response :
+				healthy = True
+				decoder: JsonArrayDecoder = JsonArrayDecoder()
 
-		for attempt in range(1, self._attempts + 1) :
-			try :
-				async with async_request(
-					self._method,
-					self._endpoint.format(**kwargs),
-					**req,
-				) as response :
-					if not self._decoder :
-						return
+				async for chunk in response.content.iter_any() :
+					for item in decoder.feed(chunk) :
+						yield self._validate_item(item) if self._validate_item else item
 
-					data = await self._decoder(response)
+				decoder.close()
 
-					if not self._model :
-						return data
+		except ClientResponseError as e :
+			healthy = e.status < 500 and e.status != 429
+			raise
 
-					return parse_obj_as(self._model, data)
+		except (ClientError, TimeoutError) :
+			healthy = False
+			raise
 
-			except ClientResponseError as e :
-				if e.status not in self._status_to_retry or attempt == self._attempts :
-					raise
+		finally :
+			if tickets :
+				self._release(tickets, healthy)
 
-				await sleep(self._backoff(attempt))
+			if s :
+				s.finish()
@@ -1,7 +1,13 @@
 import logging
+from functools import partial
+from math import inf
+from queue import Empty, Full, Queue
+from random import random
+from threading import Lock, Thread
+from time import time
 from traceback import format_tb
-from types import ModuleType
-from typing import Any, Callable, Dict, List, Tuple, Union
+from types import FunctionType, MethodType, ModuleType
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
 
 from google.api_core.exceptions import RetryError
 from google.auth import compute_engine
@@ -9,23 +15,215 @@ from google.cloud import logging as google_logging
 
 from kh_common.config.repo import name as repo_name
 from kh_common.config.repo import short_hash
+from kh_common.tracing import trace_id
 from kh_common.utilities import getFullyQualifiedClassName
-from kh_common.utilities.json import json_stream
+from kh_common.utilities.json import json_dumps, json_stream
+from kh_common.utilities.signal import Terminated
+
+
+class TerminalBatch :
+
+	def __init__(self, agent: 'TerminalAgent') -> None :
+		self.agent: TerminalAgent = agent
+		self.entries: List[str] = []
+
+	def log_text(self, log: str, severity:str='INFO', labels:Optional[Dict[str, str]]=None) -> None :
+		self.entries.append(self.agent.format_text(log, severity, labels))
+
+	def log_struct(self, log: Dict[str, Any], severity:str='INFO', labels:Optional[Dict[str, str]]=None) -> None :
+		self.entries.append(self.agent.format_struct(log, severity, labels))
+
+	def commit(self) -> None :
+		if self.entries :
+			print('\n'.join(self.entries))
+			self.entries.clear()
+
+	def __enter__(self) -> 'TerminalBatch' :
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback) -> None :
+		if exc_type is None :
+			self.commit()
 
 
 class TerminalAgent :
 
 	def __init__(self) -> None :
-		import json
 		import time
 		self.time: ModuleType = time
-		self.json: ModuleType = json
 
-	def log_text(self, log: str, severity:str='INFO') -> None :
-		print('[' + self.time.asctime(self.time.localtime(self.time.time())) + ']', severity, '>', log)
+	def _prefix(self, severity: str, labels: Optional[Dict[str, str]]) -> str :
+		prefix: str = '[' + self.time.asctime(self.time.localtime(self.time.time())) + '] ' + severity
+		if labels :
+			prefix += ' ' + ' '.join(f'{k}={v}' for k, v in labels.items())
+		return prefix + ' > '
+
+	def format_text(self, log: str, severity:str='INFO', labels:Optional[Dict[str, str]]=None) -> str :
+		return self._prefix(severity, labels) + log
+
+	def format_struct(self, log: Dict[str, Any], severity:str='INFO', labels:Optional[Dict[str, str]]=None) -> str :
+		return self._prefix(severity, labels) + json_dumps(log, indent=4).decode()
+
+	def log_text(self, log: str, severity:str='INFO', labels:Optional[Dict[str, str]]=None) -> None :
+		print(self.format_text(log, severity, labels))
+
+	def log_struct(self, log: Dict[str, Any], severity:str='INFO', labels:Optional[Dict[str, str]]=None) -> None :
+		print(self.format_struct(log, severity, labels))
+
+	def batch(self) -> TerminalBatch :
+		return TerminalBatch(self)
+
+
+# functions passed as log messages are called to build the log when, and only if, it is going to be sent
+# ex: logger.debug(lambda : { 'data': expensive_function() })
+Deferred: Tuple[type] = (FunctionType, MethodType, partial)
+
+
+def _call_site(record: logging.LogRecord) -> str :
+	return f'{record.pathname}:{record.lineno}'
+
+
+class SampleFilter(logging.Filter) :
+	"""
+	randomly passes rate (0 - 1) of records through. rates can be overridden per logger name or per call site, in the format 'path/to/file.py:lineno'
+	"""
+
+	def __init__(self, rate: float = 1, rates: Dict[str, float] = { }) -> None :
+		logging.Filter.__init__(self)
+		self._rate: float = rate
+		self._rates: Dict[str, float] = dict(rates)
+
+
+	def filter(self, record: logging.LogRecord) -> bool :
+		rate: float = self._rate
+
+		if self._rates :
+			rate = self._rates.get(_call_site(record), self._rates.get(record.name, rate))
+
+		return rate >= 1 or random() < rate
+
+
+class RateLimitFilter(logging.Filter) :
+	"""
+	token bucket rate limiter, allows up to rate records per second from each call site, with bursts of up to burst records.
+	the number of records limited can be found in RateLimitFilter.dropped
+	"""
+
+	def __init__(self, rate: float, burst: int = 10) -> None :
+		assert rate > 0
+		assert burst >= 1
+		logging.Filter.__init__(self)
+		self._rate: float = rate
+		self._burst: int = burst
+		self._buckets: Dict[Tuple[str, int], Tuple[float, float]] = { }
+		self._lock: Lock = Lock()
+		self.dropped: int = 0
+
+
+	def filter(self, record: logging.LogRecord) -> bool :
+		key: Tuple[str, int] = (record.pathname, record.lineno)
+		now: float = time()
+
+		with self._lock :
+			tokens, last = self._buckets.get(key, (self._burst, now))
+			tokens = min(self._burst, tokens + (now - last) * self._rate)
+
+			if tokens < 1 :
+				self._buckets[key] = (tokens, now)
+				self.dropped += 1
+				return False
+
+			self._buckets[key] = (tokens - 1, now)
+			return True
+
+
+class DedupFilter(logging.Filter) :
+	"""
+	collapses identical records logged within window seconds of the first into that record. records are identical if they share
+	a logger, level, call site, message template and exception. once the window has passed, the next identical record is passed
+	through with record.repeated set to the number of records that were collapsed, which LogHandler includes in the log.
+	bursts that stop before then are reported by LogHandler through DedupFilter.expired, see LogHandler.handle
+	"""
 
-	def log_struct(self, log: Dict[str, Any], severity:str='INFO') -> None :
-		print('[' + self.time.asctime(self.time.localtime(self.time.time())) + ']', severity, '>', self.json.dumps(log, indent=4))
+	def __init__(self, window: float = 60) -> None :
+		assert window > 0
+		logging.Filter.__init__(self)
+		self._window: float = window
+		# fingerprint -> (window expires, records collapsed, last record collapsed)
+		self._seen: Dict[Hashable, Tuple[float, int, Optional[logging.LogRecord]]] = { }
+		# earliest window with collapsed records that haven't been reported
+		self._pending: float = inf
+		self._lock: Lock = Lock()
+
+
+	def _fingerprint(self, record: logging.LogRecord) -> Hashable :
+		e: Optional[BaseException] = record.exc_info[1] if record.exc_info else None
+		return (
+			record.name,
+			record.levelno,
+			record.pathname,
+			record.lineno,
+			# the unformatted template, so that records only differing by args are still collapsed
+			record.msg if isinstance(record.msg, str) else None,
+			type(e) if e else None,
+			str(e) if e else None,
+		)
+
+
+	def filter(self, record: logging.LogRecord) -> bool :
+		key: Hashable = self._fingerprint(record)
+		now: float = time()
+
+		with self._lock :
+			if key in self._seen :
+				expires, count, _ = self._seen[key]
+
+				if now < expires :
+					self._seen[key] = (expires, count + 1, record)
+					self._pending = min(self._pending, expires)
+					return False
+
+				if count :
+					record.repeated = count
+
+			self._seen[key] = (now + self._window, 0, None)
+
+			if len(self._seen) > 10000 :
+				# don't let fingerprints pile up forever, expired entries without unreported records can be forgotten
+				self._seen = { k: v for k, v in self._seen.items() if v[0] > now or v[1] }
+
+			return True
+
+
+	def expired(self, flush: bool = False) -> List[logging.LogRecord] :
+		"""
+		returns the last record collapsed in each window that has passed without another identical record arriving to report it,
+		with record.repeated set to the number of records that were collapsed.
+		:param flush: return the records collapsed in every window, including those that haven't passed yet
+		"""
+		now: float = time()
+
+		with self._lock :
+			if not flush and now < self._pending :
+				return []
+
+			records: List[logging.LogRecord] = []
+			pending: float = inf
+
+			for key, (expires, count, last) in self._seen.items() :
+				if not count :
+					continue
+
+				if flush or expires <= now :
+					last.repeated = count
+					records.append(last)
+					self._seen[key] = (expires, 0, None)
+
+				else :
+					pending = min(pending, expires)
+
+			self._pending = pending
+			return records
 
 
 class LogHandler(logging.Handler) :
@@ -46,9 +244,47 @@ class LogHandler(logging.Handler) :
 			self.agent: TerminalAgent = TerminalAgent()
 
 
-	def emit(self, record: logging.LogRecord) -> None :
+	def _report_collapsed(self, flush: bool = False) -> None :
+		for f in self.filters :
+			if isinstance(f, DedupFilter) :
+				for record in f.expired(flush) :
+					# these have already been through the filters once, so they're emitted directly
+					self.acquire()
+					try :
+						self.emit(record)
+					finally :
+						self.release()
+
+
+	def handle(self, record: logging.LogRecord) -> bool :
+		"""
+		handles the record, then reports any bursts collapsed by a DedupFilter that have stopped since the last record
+		"""
+		result: bool = logging.Handler.handle(self, record)
+		self._report_collapsed()
+		return result
+
+
+	def close(self) -> None :
+		self._report_collapsed(True)
+		logging.Handler.close(self)
+
+
+	def prepare(self, record: logging.LogRecord) -> Tuple[str, Union[str, Dict[str, Any]], str] :
+		"""
+		converts a record into the agent method to call, the log to send, and its severity
+		"""
+		if isinstance(record.msg, Deferred) :
+			# only materialized once the record has passed every level check and filter
+			record.msg = record.msg()
+
 		if record.args and isinstance(record.msg, str) :
 			record.msg = record.msg % record.args
+			record.args = None
+
+		# set by DedupFilter
+		repeated: int = getattr(record, 'repeated', 0)
+
 		if record.exc_info :
 			e: Exception = record.exc_info[1]
 			refid = getattr(e, 'refid', None)
@@ -63,37 +299,260 @@ class LogHandler(logging.Handler) :
 			else :
 				errorinfo['message'] = record.msg
 
-			try :
-				self.agent.log_struct(errorinfo, severity=record.levelname)
+			if repeated :
+				errorinfo['repeated'] = repeated
 
-			except RetryError :
-				# we really, really do not want to fail-crash here.
-				# normally we would log this error and move on, but, well.
-				pass
+			return 'log_struct', errorinfo, record.levelname
+
+		if isinstance(record.msg, self._structs) :
+			log: Any = json_stream(record.msg)
+
+			if repeated and isinstance(log, dict) :
+				log['repeated'] = repeated
+
+			return 'log_struct', log, record.levelname
+
+		if repeated :
+			return 'log_text', f'{record.msg} (repeated {repeated} times)', record.levelname
+
+		return 'log_text', str(record.msg), record.levelname
+
+
+	def _send(self, agent: Any, record: logging.LogRecord) -> None :
+		method, log, severity = self.prepare(record)
+		trace: Optional[str] = getattr(record, 'trace_id', None)
+
+		if trace :
+			getattr(agent, method)(log, severity=severity, labels={ 'trace_id': trace })
 
 		else :
+			getattr(agent, method)(log, severity=severity)
+
+
+	def emit(self, record: logging.LogRecord) -> None :
+		if not hasattr(record, 'trace_id') :
+			record.trace_id = trace_id()
+
+		try :
+			self._send(self.agent, record)
+
+		except RetryError :
+			# we really, really do not want to fail-crash here.
+			# normally we would log this error and move on, but, well.
+			pass
+
+
+class QueueLogHandler(LogHandler) :
+	"""
+	ships records from a background thread so that logging never blocks the calling thread on network io.
+	records are buffered in a bounded queue and sent in batches of up to batch_size, at least every flush_interval seconds.
+	once buffer_size records are waiting, new records are dropped, or the oldest waiting record is dropped if drop_oldest is true.
+	the number of dropped records can be found in QueueLogHandler.dropped
+	NOTE: the buffer is drained before the process terminates.
+	"""
+
+	def __init__(
+		self,
+		name: str,
+		*args: Tuple[Any],
+		buffer_size: int = 10000,
+		batch_size: int = 100,
+		flush_interval: float = 1,
+		drop_oldest: bool = False,
+		**kwargs: Dict[str, Any],
+	) -> None :
+		assert buffer_size > 0
+		assert batch_size > 0
+		LogHandler.__init__(self, name, *args, **kwargs)
+		self._queue: Queue = Queue(buffer_size)
+		self._batch_size: int = batch_size
+		self._flush_interval: float = flush_interval
+		self._drop_oldest: bool = drop_oldest
+		self._closed: bool = False
+		self.dropped: int = 0
+		self.sent: int = 0
+		self._worker: Thread = Thread(target=self._work, daemon=True)
+		self._worker.start()
+		Terminated.on_terminate(self.close)
+
+
+	def _enqueue(self, record: logging.LogRecord) -> None :
+		try :
+			self._queue.put_nowait(record)
+			return
+
+		except Full :
+			if not self._drop_oldest :
+				self.dropped += 1
+				return
+
+		try :
+			self._queue.get_nowait()
+			self._queue.task_done()
+			self.dropped += 1
+
+		except Empty :
+			pass
+
+		try :
+			self._queue.put_nowait(record)
+
+		except Full :
+			self.dropped += 1
+
+
+	def emit(self, record: logging.LogRecord) -> None :
+		if self._closed :
+			# the worker has been shut down, so there's no choice but to send on this thread
+			return LogHandler.emit(self, record)
+
+		if record.args and isinstance(record.msg, str) :
+			# format now, since args may be mutated by the caller before the record is shipped
+			record.msg = record.msg % record.args
+			record.args = None
+
+		# the trace is stored in a contextvar, so it must be read on the calling thread
+		record.trace_id = trace_id()
+		self._enqueue(record)
+
+
+	def _ship(self, records: List[logging.LogRecord]) -> None :
+		try :
+			with self.agent.batch() as batch :
+				for record in records :
+					self._send(batch, record)
+
+			self.sent += len(records)
+
+		except RetryError :
+			# we really, really do not want to fail-crash here.
+			self.dropped += len(records)
+
+		except Exception :
+			self.dropped += len(records)
+			self.handleError(records[-1])
+
+
+	def _work(self) -> None :
+		stop: bool = False
+
+		while not stop :
+			records: List[Optional[logging.LogRecord]] = []
+			deadline: float = time() + self._flush_interval
+
+			while len(records) < self._batch_size :
+				try :
+					record: Optional[logging.LogRecord] = self._queue.get(timeout=max(deadline - time(), 0))
+
+				except Empty :
+					break
+
+				if record is None :
+					self._queue.task_done()
+					stop = True
+					break
+
+				records.append(record)
+
+			if records :
+				self._ship(records)
+
+				for _ in records :
+					self._queue.task_done()
+
+
+	def flush(self, timeout: float = 5) -> None :
+		"""
+		blocks until the worker has shipped everything currently in the buffer, or timeout seconds have passed
+		"""
+		deadline: float = time() + timeout
+		while self._queue.unfinished_tasks and self._worker.is_alive() and time() < deadline :
+			self._worker.join(0.01)
+
+
+	def close(self) -> None :
+		if not self._closed :
+			# queue any collapsed records before the worker is told to stop
+			self._report_collapsed(True)
+			self._closed = True
+
 			try :
-				if isinstance(record.msg, self._structs) :
-					self.agent.log_struct(json_stream(record.msg), severity=record.levelname)
-				else :
-					self.agent.log_text(str(record.msg), severity=record.levelname)
+				self._queue.put(None, timeout=1)
 
-			except RetryError :
-				# we really, really do not want to fail-crash here.
-				# normally we would log this error and move on, but, well.
+			except Full :
 				pass
 
+			self._worker.join(5)
+
+		LogHandler.close(self)
+
 
 Logger: type = logging.Logger
 
 
-def getLogger(name: Union[str, None]=None, level:int=logging.INFO, filter:Callable=lambda x : x, disable:List[str]=[], **kwargs:Dict[str, Any]) -> Logger :
+def configure(
+	name: Union[str, None]=None,
+	level:int=logging.INFO,
+	filter:Callable=lambda x : x,
+	disable:List[str]=[],
+	background:bool=False,
+	buffer_size:int=10000,
+	batch_size:int=100,
+	flush_interval:float=1,
+	drop_oldest:bool=False,
+	sample_rate:float=1,
+	sample_rates:Dict[str, float]={ },
+	rate_limit:Optional[float]=None,
+	rate_burst:int=10,
+	dedup_window:float=0,
+	**kwargs:Dict[str, Any],
+) -> None :
+	"""
+	replaces the root handler, closing the previous one once its buffered records are shipped.
+	:param background: ship logs from a background thread via QueueLogHandler, see QueueLogHandler for the buffer_size, batch_size, flush_interval and drop_oldest params
+	:param sample_rate: fraction of records to keep, sample_rates overrides it per logger name or call site. see SampleFilter
+	:param rate_limit: max records per second per call site, with bursts of up to rate_burst. see RateLimitFilter
+	:param dedup_window: collapse identical records logged within this many seconds into one. see DedupFilter
+	"""
 	name: str = name or f'{repo_name}.{short_hash}'
 	for loggerName in disable :
 		logging.getLogger(loggerName).propagate = False
-	logging.root.setLevel(logging.NOTSET)
-	handler: LogHandler = LogHandler(name, level=level)
+	# set the level on root as well as the handler so that disabled calls short circuit in logger.isEnabledFor, before a record is ever created
+	logging.root.setLevel(level)
+
+	handler: LogHandler
+
+	if background :
+		handler = QueueLogHandler(name, level=level, buffer_size=buffer_size, batch_size=batch_size, flush_interval=flush_interval, drop_oldest=drop_oldest)
+
+	else :
+		handler = LogHandler(name, level=level)
+
 	handler.addFilter(filter)
+
+	if sample_rate < 1 or sample_rates :
+		handler.addFilter(SampleFilter(sample_rate, sample_rates))
+
+	if dedup_window :
+		handler.addFilter(DedupFilter(dedup_window))
+
+	if rate_limit :
+		handler.addFilter(RateLimitFilter(rate_limit, rate_burst))
+
+	for old_handler in logging.root.handlers :
+		# make sure any buffered records are shipped before the handler is replaced
+		old_handler.close()
+
 	logging.root.handlers.clear()
 	logging.root.addHandler(handler)
-	return logging.getLogger(name)
+
+
+def getLogger(name: Union[str, None]=None, **kwargs:Dict[str, Any]) -> Logger :
+	"""
+	returns a logger, configuring root logging with the remaining kwargs first, see configure.
+	calls without configuration, such as the getLogger() within kh_common's own classes, only configure root if it hasn't been already, so they never replace the handler a service set up
+	"""
+	if kwargs or not any(isinstance(handler, LogHandler) for handler in logging.root.handlers) :
+		configure(name, **kwargs)
+
+	return logging.getLogger(name or f'{repo_name}.{short_hash}')
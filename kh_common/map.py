@@ -1,6 +1,11 @@
-from typing import Any, Hashable
+from asyncio import Future, ensure_future, get_event_loop, shield
+from collections import OrderedDict
+from copy import copy
+from time import time
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
 
 from kh_common.sql import SqlInterface
+from kh_common.utilities import __clear_cache__
 
 
 class Map(SqlInterface, dict) :
@@ -24,3 +29,139 @@ class Map(SqlInterface, dict) :
 		)
 		self[key] = data[0]
 		return data[0]
+
+
+_missing: object = object()
+
+
+class BatchMap(SqlInterface) :
+	"""
+	async, bounded alternative to Map. keys requested within the same event loop tick are coalesced into a single query.
+	ex:
+	users = BatchMap('users', 'user_id', 'handle', max_size=10000, TTL=300)
+	handles = await users.get_many([1, 2, 3])
+	yields one query in the format: SELECT user_id, handle FROM kheina.public.users WHERE user_id = ANY(%s);
+
+	NOTE: cached values expire after TTL seconds. once max_size entries are cached, the oldest entries are evicted first.
+	"""
+
+	def __init__(self: 'BatchMap', table: str, key: str, value: str, max_size: int = 1024, TTL: float = 60) :
+		assert max_size > 0
+		assert TTL >= 0
+		SqlInterface.__init__(self)
+		self._table: str = f'kheina.public.{table}'
+		self._key: str = key
+		self._value: str = value
+		self._max_size: int = max_size
+		self._TTL: float = TTL
+		self._cache: OrderedDict = OrderedDict()
+		self._pending: Dict[Hashable, Future] = { }
+
+
+	async def _load(self: 'BatchMap', keys: List[Hashable]) -> Dict[Hashable, Any] :
+		data: List[Tuple[Hashable, Any]] = await self.query_async(f"""
+			SELECT {self._key}, {self._value}
+			FROM {self._table}
+			WHERE {self._key} = ANY(%s);
+			""",
+			(keys,),
+			fetch_all=True,
+		)
+		return dict(data)
+
+
+	def _store(self: 'BatchMap', key: Hashable, value: Any) -> None :
+		if key in self._cache :
+			# re-insert so that the cache stays ordered by expiration
+			del self._cache[key]
+
+		self._cache[key] = (time() + self._TTL, value)
+
+		while len(self._cache) > self._max_size :
+			self._cache.popitem(last=False)
+
+
+	async def _dispatch(self: 'BatchMap') -> None :
+		pending: Dict[Hashable, Future] = self._pending
+		self._pending = { }
+
+		try :
+			data: Dict[Hashable, Any] = await self._load(list(pending.keys()))
+
+		except Exception as e :
+			for future in pending.values() :
+				if not future.done() :
+					future.set_exception(e)
+			return
+
+		for key, future in pending.items() :
+			value: Any = data.get(key, _missing)
+
+			if value is not _missing :
+				self._store(key, value)
+
+			if not future.done() :
+				future.set_result(value)
+
+
+	def _request(self: 'BatchMap', key: Hashable) -> Future :
+		if key in self._pending :
+			return self._pending[key]
+
+		future: Future = get_event_loop().create_future()
+
+		if not self._pending :
+			# schedule the query after every coroutine waiting on this tick has had a chance to request its keys
+			get_event_loop().call_soon(ensure_future, self._dispatch())
+
+		self._pending[key] = future
+		return future
+
+
+	def clear(self: 'BatchMap') -> None :
+		self._cache.clear()
+
+
+	def remove(self: 'BatchMap', key: Hashable) -> None :
+		if key in self._cache :
+			del self._cache[key]
+
+
+	async def get(self: 'BatchMap', key: Hashable) -> Any :
+		__clear_cache__(self._cache, time)
+
+		if key in self._cache :
+			return copy(self._cache[key][1])
+
+		# shield the shared future so that one cancelled caller doesn't cancel every other caller awaiting the same key
+		value: Any = await shield(self._request(key))
+
+		if value is _missing :
+			raise KeyError(key)
+
+		return copy(value)
+
+
+	async def get_many(self: 'BatchMap', keys: Iterable[Hashable]) -> Dict[Hashable, Optional[Any]] :
+		"""
+		returns a dict of every key requested. keys that do not exist in the table are returned as None
+		"""
+		__clear_cache__(self._cache, time)
+
+		keys: List[Hashable] = list(keys)
+		futures: Dict[Hashable, Future] = {
+			key: self._request(key)
+			for key in keys
+			if key not in self._cache
+		}
+		local: Dict[Hashable, Any] = {
+			key: copy(self._cache[key][1])
+			for key in keys
+			if key in self._cache
+		}
+
+		for key, future in futures.items() :
+			value: Any = await shield(future)
+			local[key] = None if value is _missing else copy(value)
+
+		return local
@@ -0,0 +1,290 @@
+"""
+in-process metrics in the prometheus text exposition format.
+every metric is recorded per process (per worker). recording a value is a dict lookup and an addition, histograms use fixed buckets so that observing a value never allocates.
+values aren't locked by default, so they must only be recorded from the event loop's thread. metrics recorded from other threads, such as executor threads, must be created with threadsafe=True, or updates may be lost.
+ex:
+requests = registry.counter('requests_total', 'total requests.', ('route',))
+requests.labels('/').inc()
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
+
+DefaultBuckets: Tuple[float] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str :
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str], values: Tuple[str], extra: str = '') -> str :
+	labels: List[str] = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+
+	if extra :
+		labels.append(extra)
+
+	return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str :
+	if value == float('inf') :
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterValue :
+
+	__slots__ = ('value',)
+
+	def __init__(self: 'CounterValue') -> None :
+		self.value: float = 0
+
+
+	def inc(self: 'CounterValue', amount: float = 1) -> None :
+		self.value += amount
+
+
+class GaugeValue(CounterValue) :
+
+	__slots__ = ()
+
+	def dec(self: 'GaugeValue', amount: float = 1) -> None :
+		self.value -= amount
+
+
+	def set(self: 'GaugeValue', value: float) -> None :
+		self.value = value
+
+
+class LockedCounterValue(CounterValue) :
+
+	__slots__ = ('_lock',)
+
+	def __init__(self: 'LockedCounterValue') -> None :
+		CounterValue.__init__(self)
+		self._lock: Lock = Lock()
+
+
+	def inc(self: 'LockedCounterValue', amount: float = 1) -> None :
+		with self._lock :
+			self.value += amount
+
+
+class LockedGaugeValue(GaugeValue) :
+
+	__slots__ = ('_lock',)
+
+	def __init__(self: 'LockedGaugeValue') -> None :
+		GaugeValue.__init__(self)
+		self._lock: Lock = Lock()
+
+
+	def inc(self: 'LockedGaugeValue', amount: float = 1) -> None :
+		with self._lock :
+			self.value += amount
+
+
+	def dec(self: 'LockedGaugeValue', amount: float = 1) -> None :
+		with self._lock :
+			self.value -= amount
+
+
+class HistogramValue :
+
+	__slots__ = ('_buckets', 'counts', 'sum', 'count')
+
+	def __init__(self: 'HistogramValue', buckets: Tuple[float]) -> None :
+		self._buckets: Tuple[float] = buckets
+		self.counts: List[int] = [0] * (len(buckets) + 1)
+		self.sum: float = 0
+		self.count: int = 0
+
+
+	def observe(self: 'HistogramValue', value: float) -> None :
+		# counts are stored per bucket and made cumulative on render
+		self.counts[bisect_left(self._buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+
+	@contextmanager
+	def time(self: 'HistogramValue') -> Iterator[None] :
+		start: float = perf_counter()
+
+		try :
+			yield
+
+		finally :
+			self.observe(perf_counter() - start)
+
+
+class LockedHistogramValue(HistogramValue) :
+
+	__slots__ = ('_lock',)
+
+	def __init__(self: 'LockedHistogramValue', buckets: Tuple[float]) -> None :
+		HistogramValue.__init__(self, buckets)
+		self._lock: Lock = Lock()
+
+
+	def observe(self: 'LockedHistogramValue', value: float) -> None :
+		with self._lock :
+			HistogramValue.observe(self, value)
+
+
+class Metric :
+
+	type: str = 'untyped'
+
+	def __init__(self: 'Metric', name: str, help: str, labels: Iterable[str], value: Callable[[], Union[CounterValue, HistogramValue]]) -> None :
+		"""
+		:param value: creates the value of each child, called once per set of label values
+		"""
+		self.name: str = name
+		self.help: str = help
+		self.label_names: Tuple[str] = tuple(labels)
+		self._value: Callable[[], Union[CounterValue, HistogramValue]] = value
+		self._values: Dict[Tuple[str], Union[CounterValue, HistogramValue]] = { }
+
+		if not self.label_names :
+			self._default = self.labels()
+
+
+	def labels(self: 'Metric', *values: str) -> Union[CounterValue, GaugeValue, HistogramValue] :
+		"""
+		returns the child for the given label values. children should be stored and reused on hot paths
+		"""
+		try :
+			return self._values[values]
+
+		except KeyError :
+			assert len(values) == len(self.label_names), f'{self.name} requires labels: {self.label_names}'
+			value = self._values[values] = self._value()
+			return value
+
+
+	def _render(self: 'Metric') -> Iterator[str] :
+		for values, value in self._values.items() :
+			yield f'{self.name}{_format_labels(self.label_names, values)} {_format_value(value.value)}'
+
+
+	def render(self: 'Metric') -> Iterator[str] :
+		yield f'# HELP {self.name} {self.help}'
+		yield f'# TYPE {self.name} {self.type}'
+		yield from self._render()
+
+
+class Counter(Metric) :
+
+	type: str = 'counter'
+
+	def __init__(self: 'Counter', name: str, help: str, labels: Iterable[str] = (), threadsafe: bool = False) -> None :
+		Metric.__init__(self, name, help, labels, LockedCounterValue if threadsafe else CounterValue)
+
+
+	def inc(self: 'Counter', amount: float = 1) -> None :
+		self._default.inc(amount)
+
+
+class Gauge(Metric) :
+
+	type: str = 'gauge'
+
+	def __init__(self: 'Gauge', name: str, help: str, labels: Iterable[str] = (), threadsafe: bool = False) -> None :
+		Metric.__init__(self, name, help, labels, LockedGaugeValue if threadsafe else GaugeValue)
+
+
+	def inc(self: 'Gauge', amount: float = 1) -> None :
+		self._default.inc(amount)
+
+
+	def dec(self: 'Gauge', amount: float = 1) -> None :
+		self._default.dec(amount)
+
+
+	def set(self: 'Gauge', value: float) -> None :
+		self._default.set(value)
+
+
+class Histogram(Metric) :
+
+	type: str = 'histogram'
+
+	def __init__(self: 'Histogram', name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DefaultBuckets, threadsafe: bool = False) -> None :
+		self.buckets: Tuple[float] = tuple(sorted(buckets))
+		Metric.__init__(self, name, help, labels, partial(LockedHistogramValue if threadsafe else HistogramValue, self.buckets))
+
+
+	def observe(self: 'Histogram', value: float) -> None :
+		self._default.observe(value)
+
+
+	def _render(self: 'Histogram') -> Iterator[str] :
+		for values, value in self._values.items() :
+			cumulative: int = 0
+
+			for le, count in zip(self.buckets + (float('inf'),), value.counts) :
+				cumulative += count
+				le_label: str = 'le="' + _format_value(le) + '"'
+				yield f'{self.name}_bucket{_format_labels(self.label_names, values, le_label)} {cumulative}'
+
+			yield f'{self.name}_sum{_format_labels(self.label_names, values)} {_format_value(value.sum)}'
+			yield f'{self.name}_count{_format_labels(self.label_names, values)} {value.count}'
+
+
+class Registry :
+
+	def __init__(self: 'Registry') -> None :
+		self._metrics: Dict[str, Metric] = { }
+
+
+	def _register(self: 'Registry', metric: Metric) -> Metric :
+		if metric.name in self._metrics :
+			existing: Metric = self._metrics[metric.name]
+			assert type(existing) == type(metric) and existing.label_names == metric.label_names, f'metric {metric.name} is already registered with a different type or labels.'
+			return existing
+
+		self._metrics[metric.name] = metric
+		return metric
+
+
+	def counter(self: 'Registry', name: str, help: str, labels: Iterable[str] = (), threadsafe: bool = False) -> Counter :
+		return self._register(Counter(name, help, labels, threadsafe))
+
+
+	def gauge(self: 'Registry', name: str, help: str, labels: Iterable[str] = (), threadsafe: bool = False) -> Gauge :
+		return self._register(Gauge(name, help, labels, threadsafe))
+
+
+	def histogram(self: 'Registry', name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DefaultBuckets, threadsafe: bool = False) -> Histogram :
+		return self._register(Histogram(name, help, labels, buckets, threadsafe))
+
+
+	def render(self: 'Registry') -> str :
+		lines: List[str] = []
+
+		for metric in self._metrics.values() :
+			lines.extend(metric.render())
+
+		return '\n'.join(lines) + '\n'
+
+
+registry: Registry = Registry()
+
+
+# pre-wired metrics, recorded by kh_common itself. those recorded from executor threads are threadsafe
+request_latency: Histogram = registry.histogram('kh_request_duration_seconds', 'time spent handling http requests.', ('method', 'route', 'status'))
+requests_in_flight: Gauge = registry.gauge('kh_requests_in_flight', 'http requests currently being handled.')
+auth_verifications: Counter = registry.counter('kh_auth_verifications_total', 'outcomes of request token verification.', ('outcome',))
+cache_requests: Counter = registry.counter('kh_cache_requests_total', 'local cache lookups by result.', ('cache', 'result'), threadsafe=True)
+sql_latency: Histogram = registry.histogram('kh_sql_query_duration_seconds', 'time spent executing sql queries.', threadsafe=True)
+aerospike_latency: Histogram = registry.histogram('kh_aerospike_duration_seconds', 'time spent in aerospike calls.', ('op',), threadsafe=True)
+gateway_circuit_state: Gauge = registry.gauge('kh_gateway_circuit_state', 'circuit breaker state per upstream endpoint, 0 closed, 1 open, 2 half-open.', ('endpoint',))
+gateway_concurrency_limit: Gauge = registry.gauge('kh_gateway_concurrency_limit', 'current adaptive concurrency limit per upstream endpoint.', ('endpoint',))
+gateway_in_flight: Gauge = registry.gauge('kh_gateway_in_flight', 'requests currently in flight per upstream endpoint.', ('endpoint',))
+gateway_shed: Counter = registry.counter('kh_gateway_shed_total', 'requests rejected without reaching the upstream endpoint.', ('endpoint', 'reason'))
+gateway_hedges: Counter = registry.counter('kh_gateway_hedged_requests_total', 'hedged requests sent to upstream endpoints, and how many responded first.', ('endpoint', 'outcome'))
@@ -1,4 +1,4 @@
-from typing import Iterable
+from typing import Iterable, Optional
 
 from fastapi import FastAPI, Request
 from fastapi.responses import Response
@@ -7,6 +7,8 @@ from starlette.middleware.exceptions import ExceptionMiddleware
 from kh_common.config.constants import environment
 from kh_common.exceptions import jsonErrorHandler
 from kh_common.exceptions.base_error import BaseError
+from kh_common.gateway import close_sessions
+from kh_common.tracing import TraceCollector
 
 
 NoContentResponse = Response(None, status_code=204)
@@ -15,6 +17,9 @@ NoContentResponse = Response(None, status_code=204)
 def ServerApp(
 	auth: bool = True,
 	auth_required: bool = True,
+	unauthenticated_paths: Iterable[str] = [
+		'/openapi.json',
+	],
 	cors: bool = True,
 	max_age: int = 86400,
 	custom_headers: bool = True,
@@ -63,17 +68,33 @@ def ServerApp(
 		'set-cookie',
 		'www-authenticate',
 	],
+	tracing: bool = False,
+	trace_collector: Optional[TraceCollector] = None,
+	metrics: bool = False,
+	metrics_path: str = '/metrics',
+	deadlines: bool = False,
+	auth_keys: Iterable[int] = (),
 ) -> FastAPI :
 	app = FastAPI()
 	app.add_middleware(ExceptionMiddleware, handlers={ Exception: jsonErrorHandler }, debug=False)
 	app.add_exception_handler(BaseError, jsonErrorHandler)
+	app.add_event_handler('shutdown', close_sessions)
 
 	allowed_protocols = ['http', 'https'] if environment.is_local() else ['https']
 
+	if metrics :
+		# served as a regular route, so scrapers still need to pass the host check, but not auth
+		from kh_common.server.middleware.metrics import MetricsEndpoint
+		app.add_route(metrics_path, MetricsEndpoint(), include_in_schema=False)
+		unauthenticated_paths = list(unauthenticated_paths) + [metrics_path]
+
 	if custom_headers :
 		from kh_common.server.middleware import CustomHeaderMiddleware, HeadersToSet
 		exposed_headers = list(exposed_headers) + list(HeadersToSet.keys())
-		app.middleware('http')(CustomHeaderMiddleware)
+		app.add_middleware(CustomHeaderMiddleware)
+
+	if tracing :
+		exposed_headers = list(exposed_headers) + ['server-timing']
 
 	if cors :
 		from kh_common.server.middleware.cors import KhCorsMiddleware
@@ -91,8 +112,32 @@ def ServerApp(
 		from starlette.middleware.trustedhost import TrustedHostMiddleware
 		app.add_middleware(TrustedHostMiddleware, allowed_hosts=set(allowed_hosts))
 
+	if deadlines :
+		# applies deadlines sent by upstream gateways to the gateway calls made while handling the request.
+		# opt-in, since the header can be sent by anyone, services facing the public internet shouldn't enable it
+		from kh_common.server.middleware.deadline import KhDeadlineMiddleware
+		app.add_middleware(KhDeadlineMiddleware)
+
 	if auth :
+		from kh_common.auth import keyRing
 		from kh_common.server.middleware.auth import KhAuthMiddleware
-		app.add_middleware(KhAuthMiddleware, required=auth_required)
+
+		async def start_key_ring() :
+			# keys are fetched before the first request so that it doesn't wait on the auth host
+			await keyRing.start(auth_keys)
+
+		app.add_event_handler('startup', start_key_ring)
+		app.add_event_handler('shutdown', keyRing.stop)
+		app.add_middleware(KhAuthMiddleware, required=auth_required, unauthenticated_paths=set(unauthenticated_paths))
+
+	if tracing :
+		# added after the other middleware so that it wraps them
+		from kh_common.server.middleware.tracing import KhTracingMiddleware
+		app.add_middleware(KhTracingMiddleware, collector=trace_collector)
+
+	if metrics :
+		# outermost, so request latency includes every middleware
+		from kh_common.server.middleware.metrics import KhMetricsMiddleware
+		app.add_middleware(KhMetricsMiddleware, path=metrics_path)
 
 	return app
@@ -1,6 +1,6 @@
-from typing import Dict
+from typing import Dict, FrozenSet, List, Mapping, Tuple
 
-from fastapi import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from kh_common.config.repo import short_hash
 
@@ -10,7 +10,38 @@ HeadersToSet: Dict[str, str] = {
 }
 
 
-async def CustomHeaderMiddleware(request: Request, call_next):
-	response = await call_next(request)
-	response.headers.update(HeadersToSet)
-	return response
+class CustomHeaderMiddleware:
+	"""
+	injects HeadersToSet into every http response, replacing any header of the same name set by the app.
+	headers are only re-encoded when the mapping has changed since the last response.
+	"""
+
+	def __init__(self, app: ASGIApp, headers: Mapping[str, str] = HeadersToSet) -> None :
+		self.app = app
+		self._source: Mapping[str, str] = headers
+		self._encode()
+
+
+	def _encode(self) -> None :
+		self._encoded_from: Dict[str, str] = dict(self._source)
+		self.headers: List[Tuple[bytes, bytes]] = [(key.lower().encode(), value.encode()) for key, value in self._encoded_from.items()]
+		self.names: FrozenSet[bytes] = frozenset(key for key, _ in self.headers)
+
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None :
+		if scope['type'] != 'http' :
+			await self.app(scope, receive, send)
+			return
+
+		if self._encoded_from != self._source :
+			self._encode()
+
+		headers, names = self.headers, self.names
+
+		async def header_send(message: Message) -> None :
+			if message['type'] == 'http.response.start' :
+				message['headers'] = [header for header in message.get('headers', []) if header[0] not in names] + headers
+
+			await send(message)
+
+		await self.app(scope, receive, header_send)
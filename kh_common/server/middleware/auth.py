@@ -1,49 +1,70 @@
+from typing import Iterable, Set
+
 from starlette.requests import Request
 from starlette.types import ASGIApp, Receive
 from starlette.types import Scope as request_scope
 from starlette.types import Send
 
-from kh_common.auth import AuthToken, InvalidToken, KhUser, Scope, retrieveAuthToken
+from kh_common.auth import AuthToken, InvalidToken, KhUser, Scope, retrieveAuthTokenFromScope
 from kh_common.exceptions import jsonErrorHandler
 from kh_common.exceptions.http_error import BadRequest, HttpError, Unauthorized
+from kh_common.metrics import CounterValue, auth_verifications
+from kh_common.tracing import span
+
+
+_authenticated: CounterValue = auth_verifications.labels('authenticated')
+_invalid: CounterValue = auth_verifications.labels('invalid')
+_unauthorized: CounterValue = auth_verifications.labels('unauthorized')
+_anonymous: CounterValue = auth_verifications.labels('anonymous')
 
 
 class KhAuthMiddleware:
 
-	def __init__(self, app: ASGIApp, required: bool = True) -> None :
+	def __init__(self, app: ASGIApp, required: bool = True, unauthenticated_paths: Iterable[str] = ['/openapi.json']) -> None :
+		"""
+		requests to any of unauthenticated_paths skip token verification entirely and are passed through without a user
+		"""
 		self.app = app
 		self.auth_required = required
+		self.unauthenticated_paths: Set[str] = set(unauthenticated_paths)
 
 
 	async def __call__(self, scope: request_scope, receive: Receive, send: Send) -> None :
+		if scope['type'] == 'lifespan' :
+			# startup and shutdown events, such as loading the key ring, are passed through to the app
+			return await self.app(scope, receive, send)
+
 		if scope['type'] not in { 'http', 'websocket' } :
 			raise NotImplementedError()
 
-		request: Request = Request(scope, receive, send)
-
-		if request.url.path == '/openapi.json' :
+		if scope['path'] in self.unauthenticated_paths :
 			return await self.app(scope, receive, send)
 
 		try :
-			token_data: AuthToken = await retrieveAuthToken(request)
+			with span('auth') :
+				token_data: AuthToken = await retrieveAuthTokenFromScope(scope)
 
 			scope['user'] = KhUser(
 				user_id=token_data.user_id,
 				token=token_data,
 				scope={ Scope.user } | set(map(Scope.__getitem__, token_data.data.get('scope', []))),
 			)
+			_authenticated.inc()
 
 		except InvalidToken as e :
-			return await jsonErrorHandler(request, BadRequest(e))(scope, receive, send)
+			_invalid.inc()
+			return await jsonErrorHandler(Request(scope, receive, send), BadRequest(e))(scope, receive, send)
 
 		except HttpError as e :
 			if isinstance(e, Unauthorized) and self.auth_required :
-				return await jsonErrorHandler(request, e)(scope, receive, send)
+				_unauthorized.inc()
+				return await jsonErrorHandler(Request(scope, receive, send), e)(scope, receive, send)
 
 			scope['user'] = KhUser(
 				user_id=None,
 				token=None,
 				scope={ Scope.default },
 			)
+			_anonymous.inc()
 
 		await self.app(scope, receive, send)
@@ -1,9 +1,6 @@
-from functools import partial
-from typing import Iterable
-from urllib.parse import urlparse
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import ParseResult, urlparse
 
-from fastapi.responses import Response
-from starlette.datastructures import Headers, MutableHeaders
 from starlette.requests import Request
 from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
@@ -12,6 +9,9 @@ from kh_common.exceptions.http_error import BadRequest
 
 
 class KhCorsMiddleware:
+	"""
+	allowed_origins may contain wildcard subdomains in the form '*.example.com', which match any subdomain of example.com, but not example.com itself.
+	"""
 
 	def __init__(
 		self,
@@ -23,9 +23,11 @@ class KhCorsMiddleware:
 		allow_credentials: bool = True,
 		exposed_headers: Iterable[str] = [],
 		max_age: int=86400,
+		max_cached_origins: int = 1024,
 	) -> None :
 		self.app = app
-		self.allowed_origins = set(allowed_origins)
+		self.allowed_origins: Set[str] = set()
+		self.allowed_suffixes: Tuple[str] = ()
 		self.allowed_protocols = set(allowed_protocols)
 		self.allowed_headers = ', '.join(list(allowed_headers) + ['access-control-request-method', 'origin'])
 		self.allowed_methods = ', '.join(map(str.upper, allowed_methods))
@@ -33,58 +35,88 @@ class KhCorsMiddleware:
 		self.exposed_headers = ', '.join(exposed_headers)
 		self.max_age = str(max_age)
 
+		for origin in allowed_origins :
+			if origin.startswith('*.') :
+				self.allowed_suffixes += (origin[1:],)
+
+			else :
+				self.allowed_origins.add(origin)
+
+		# everything but the origin is the same for every response, so encode it once
+		self._headers: List[Tuple[bytes, bytes]] = [
+			(b'access-control-allow-methods', self.allowed_methods.encode()),
+			(b'access-control-allow-headers', self.allowed_headers.encode()),
+			(b'access-control-allow-credentials', self.allow_credentials.encode()),
+			(b'access-control-max-age', self.max_age.encode()),
+			(b'access-control-expose-headers', self.exposed_headers.encode()),
+		]
+
+		# origin headers are client controlled, so the memo is bounded
+		self._max_cached_origins: int = max_cached_origins
+		self._origins: Dict[bytes, bool] = { }
+
+
+	def _match_origin(self, origin: bytes) -> bool :
+		try :
+			parsed: ParseResult = urlparse(origin.decode())
+			host: str = parsed.netloc.split(':')[0]
+
+		except ValueError :
+			return False
+
+		if parsed.scheme not in self.allowed_protocols :
+			return False
+
+		return host in self.allowed_origins or host.endswith(self.allowed_suffixes)
+
+
+	def origin_allowed(self, origin: bytes) -> bool :
+		try :
+			return self._origins[origin]
+
+		except KeyError :
+			if len(self._origins) >= self._max_cached_origins :
+				self._origins.clear()
+
+			allowed = self._origins[origin] = self._match_origin(origin)
+			return allowed
+
 
 	async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None :
 		if scope['type'] != 'http' :
 			await self.app(scope, receive, send)
 			return
 
-		request: Request = Request(scope, receive, send)
+		origin: Optional[bytes] = None
+		preflight: bool = False
 
-		if 'origin' in request.headers :
-			origin = urlparse(request.headers['origin'])
+		for key, value in scope['headers'] :
+			if key == b'origin' :
+				origin = value
 
-			if origin.scheme not in self.allowed_protocols or origin.netloc.split(':')[0] not in self.allowed_origins :
-				response = jsonErrorHandler(request, BadRequest('Origin not allowed.'))
-				await response(scope, receive, send)
-				return
+			elif key == b'access-control-request-method' :
+				preflight = True
 
-			if request.method == 'OPTIONS' and 'access-control-request-method' in request.headers :
-				await Response(
-					None,
-					status_code=204,
-					headers={
-						'access-control-allow-origin': origin.geturl(),
-						'access-control-allow-methods': self.allowed_methods,
-						'access-control-allow-headers': self.allowed_headers,
-						'access-control-allow-credentials': self.allow_credentials,
-						'access-control-max-age': self.max_age,
-						'access-control-expose-headers': self.exposed_headers,
-					},
-				)(scope, receive, send)
-				return
-
-			send = partial(self.send, send=send, headers=request.headers)
+		if origin is None :
+			await self.app(scope, receive, send)
+			return
 
-		await self.app(scope, receive, send)
+		if not self.origin_allowed(origin) :
+			response = jsonErrorHandler(Request(scope, receive, send), BadRequest('Origin not allowed.'))
+			await response(scope, receive, send)
+			return
 
+		headers: List[Tuple[bytes, bytes]] = [(b'access-control-allow-origin', origin)] + self._headers
 
-	async def send(self, message: Message, send: Send, headers: Headers) -> None :
-		if message['type'] != 'http.response.start':
-			await send(message)
+		if preflight and scope['method'] == 'OPTIONS' :
+			await send({ 'type': 'http.response.start', 'status': 204, 'headers': headers })
+			await send({ 'type': 'http.response.body', 'body': b'' })
 			return
 
-		origin = headers['origin']
-		message.setdefault('headers', [])
-		headers = MutableHeaders(scope=message)
+		async def cors_send(message: Message) -> None :
+			if message['type'] == 'http.response.start' :
+				message['headers'] = list(message.get('headers', [])) + headers
 
-		headers.update({
-			'access-control-allow-origin': origin,
-			'access-control-allow-methods': self.allowed_methods,
-			'access-control-allow-headers': self.allowed_headers,
-			'access-control-allow-credentials': self.allow_credentials,
-			'access-control-max-age': self.max_age,
-			'access-control-expose-headers': self.exposed_headers,
-		})
+			await send(message)
 
-		await send(message)
+		await self.app(scope, receive, cors_send)
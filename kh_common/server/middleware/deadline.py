@@ -0,0 +1,52 @@
+from math import isfinite
+from time import monotonic
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from kh_common.gateway import DeadlineHeader, request_deadline
+
+
+class KhDeadlineMiddleware:
+	"""
+	reads the deadline sent by an upstream gateway and applies it to every gateway call made while handling the request.
+	the header is sent by any client, so it should only be trusted on services that are reached through other kh services.
+	"""
+
+	def __init__(self, app: ASGIApp, header: str = DeadlineHeader, max_deadline: float = 30) -> None :
+		"""
+		:param header: header the remaining seconds are read from
+		:param max_deadline: deadlines longer than this many seconds are shortened to it. zero, negative, and non-finite deadlines are ignored
+		"""
+		self.app = app
+		self.header = header.lower().encode()
+		self.max_deadline: float = max_deadline
+
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None :
+		if scope['type'] != 'http' :
+			await self.app(scope, receive, send)
+			return
+
+		for key, value in scope['headers'] :
+			if key == self.header :
+				try :
+					seconds: float = float(value)
+
+				except ValueError :
+					break
+
+				if not isfinite(seconds) or seconds <= 0 :
+					break
+
+				seconds = min(seconds, self.max_deadline)
+				token = request_deadline.set(monotonic() + seconds)
+
+				try :
+					await self.app(scope, receive, send)
+
+				finally :
+					request_deadline.reset(token)
+
+				return
+
+		await self.app(scope, receive, send)
@@ -0,0 +1,82 @@
+from time import perf_counter
+from typing import Callable, Dict, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from kh_common.metrics import HistogramValue, Registry, registry, request_latency, requests_in_flight
+
+
+class KhMetricsMiddleware:
+	"""
+	records request latency by route and status and the number of in flight requests. requests to path, where the metrics are
+	served from, are passed through without being recorded so that scrapes don't skew the latencies. see MetricsEndpoint
+	"""
+
+	def __init__(self, app: ASGIApp, path: str = '/metrics') -> None :
+		self.app = app
+		self.path = path
+		self._routes: Dict[Callable, str] = { }
+		self._latencies: Dict[Tuple[str, str, int], HistogramValue] = { }
+
+
+	def _route(self, scope: Scope) -> str :
+		# the router stores the matched endpoint on the scope, routes are mapped back to their path templates to keep label cardinality bounded
+		endpoint: Optional[Callable] = scope.get('endpoint')
+
+		if endpoint is None :
+			return 'unmatched'
+
+		try :
+			return self._routes[endpoint]
+
+		except KeyError :
+			for route in getattr(scope.get('app'), 'routes', []) :
+				if getattr(route, 'endpoint', None) is not None :
+					self._routes[route.endpoint] = getattr(route, 'path', 'unknown')
+
+			return self._routes.setdefault(endpoint, 'unknown')
+
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None :
+		if scope['type'] != 'http' or scope['path'] == self.path :
+			await self.app(scope, receive, send)
+			return
+
+		status: int = 500
+
+		async def metrics_send(message: Message) -> None :
+			nonlocal status
+			if message['type'] == 'http.response.start' :
+				status = message['status']
+			await send(message)
+
+		start: float = perf_counter()
+		requests_in_flight.inc()
+
+		try :
+			await self.app(scope, receive, metrics_send)
+
+		finally :
+			requests_in_flight.dec()
+			key: Tuple[str, str, int] = (scope['method'], self._route(scope), status)
+
+			try :
+				latency: HistogramValue = self._latencies[key]
+
+			except KeyError :
+				latency = self._latencies[key] = request_latency.labels(key[0], key[1], str(status))
+
+			latency.observe(perf_counter() - start)
+
+
+def MetricsEndpoint(registry: Registry = registry) -> Callable :
+	"""
+	returns an endpoint that serves the registry's metrics. it's routed like any other endpoint, so scrapes still pass the host check
+	"""
+
+	async def metrics(request: Request) -> Response :
+		return Response(registry.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+	return metrics
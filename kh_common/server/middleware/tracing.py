@@ -0,0 +1,48 @@
+from typing import Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from kh_common.tracing import Span, TraceCollector, end_trace, server_timing, start_trace
+
+
+class KhTracingMiddleware:
+
+	def __init__(self, app: ASGIApp, collector: Optional[TraceCollector] = None, timing_header: bool = True) -> None :
+		self.app = app
+		self.collector = collector
+		self.timing_header = timing_header
+
+
+	async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None :
+		if scope['type'] != 'http' :
+			await self.app(scope, receive, send)
+			return
+
+		traceparent: Optional[str] = None
+
+		for key, value in scope['headers'] :
+			if key == b'traceparent' :
+				traceparent = value.decode()
+				break
+
+		root, token = start_trace('request', traceparent, method=scope['method'], path=scope['path'])
+
+		async def traced_send(message: Message) -> None :
+			if message['type'] == 'http.response.start' :
+				root.attributes['status'] = message['status']
+
+				if self.timing_header :
+					message['headers'] = list(message.get('headers', [])) + [
+						(b'server-timing', server_timing(root).encode()),
+					]
+
+			await send(message)
+
+		try :
+			await self.app(scope, receive, traced_send)
+
+		finally :
+			end_trace(root, token)
+
+			if self.collector :
+				self.collector.export(root)
@@ -1,5 +1,6 @@
 from asyncio import get_event_loop
 from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from functools import partial, wraps
 from types import TracebackType
 from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
@@ -12,8 +13,10 @@ from psycopg2.extensions import cursor as Cursor
 
 from kh_common.config.credentials import db
 from kh_common.logging import Logger, getLogger
+from kh_common.metrics import sql_latency
 from kh_common.sql.query import Query
 from kh_common.timing import Timer
+from kh_common.tracing import span
 
 
 class SqlInterface :
@@ -63,7 +66,10 @@ class SqlInterface :
 
 			timer = Timer().start()
 
-			cur.execute(sql, params)
+			with span('sql') :
+				cur.execute(sql, params)
+
+			sql_latency.observe(timer.elapsed())
 
 			if commit :
 				SqlInterface._conn.commit()
@@ -106,7 +112,7 @@ class SqlInterface :
 	@wraps(query)
 	async def query_async(self: 'SqlInterface', *args, **kwargs) :
 		with ThreadPoolExecutor() as threadpool :
-			return await get_event_loop().run_in_executor(threadpool, partial(self.query, *args, **kwargs))
+			return await get_event_loop().run_in_executor(threadpool, copy_context().run, partial(self.query, *args, **kwargs))
 
 
 	def transaction(self: 'SqlInterface') -> 'Transaction' :
@@ -161,7 +167,10 @@ class Transaction :
 		try :
 			timer = Timer().start()
 
-			self.cur.execute(sql, params)
+			with span('sql') :
+				self.cur.execute(sql, params)
+
+			sql_latency.observe(timer.elapsed())
 
 			if timer.elapsed() > self._sql._long_query :
 				self._sql.logger.warning(f'query took longer than {self._sql._long_query} seconds:\n{sql}')
@@ -183,4 +192,4 @@ class Transaction :
 	@wraps(query)
 	async def query_async(self: 'Transaction', *args, **kwargs) :
 		with ThreadPoolExecutor() as threadpool :
-			return await get_event_loop().run_in_executor(threadpool, partial(self.query, *args, **kwargs))
+			return await get_event_loop().run_in_executor(threadpool, copy_context().run, partial(self.query, *args, **kwargs))
@@ -0,0 +1,279 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from os import urandom
+from queue import Empty, Full, Queue
+from re import compile as re_compile
+from threading import Thread
+from time import perf_counter, time
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import ujson as json
+
+from kh_common.utilities.signal import Terminated
+
+
+traceparent_regex = re_compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+
+class Span :
+
+	__slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'duration', 'attributes', 'children', '_perf')
+
+	def __init__(self: 'Span', name: str, trace_id: str, parent_id: Optional[str] = None, attributes: Dict[str, Any] = { }) -> None :
+		self.name: str = name
+		self.trace_id: str = trace_id
+		self.span_id: str = urandom(8).hex()
+		self.parent_id: Optional[str] = parent_id
+		self.start: float = time()
+		self.duration: Optional[float] = None
+		self.attributes: Dict[str, Any] = dict(attributes)
+		self.children: List[Span] = []
+		self._perf: float = perf_counter()
+
+
+	def finish(self: 'Span') -> 'Span' :
+		if self.duration is None :
+			self.duration = perf_counter() - self._perf
+		return self
+
+
+	def elapsed(self: 'Span') -> float :
+		return perf_counter() - self._perf if self.duration is None else self.duration
+
+
+	def walk(self: 'Span') -> Iterator['Span'] :
+		yield self
+		for child in self.children :
+			yield from child.walk()
+
+
+	def traceparent(self: 'Span') -> str :
+		return f'00-{self.trace_id}-{self.span_id}-01'
+
+
+_current: ContextVar[Optional[Span]] = ContextVar('kh_span', default=None)
+
+
+def current_span() -> Optional[Span] :
+	return _current.get()
+
+
+def trace_id() -> Optional[str] :
+	current: Optional[Span] = _current.get()
+	return current.trace_id if current else None
+
+
+def start_trace(name: str, traceparent: Optional[str] = None, **attributes: Any) -> Tuple[Span, Token] :
+	"""
+	starts a new root span for the current context. if a w3c traceparent header is provided, the trace is continued from it.
+	the returned token must be passed to end_trace once the trace is complete.
+	"""
+	match = traceparent_regex.match(traceparent) if traceparent else None
+
+	if match :
+		root: Span = Span(name, match.group(1), match.group(2), attributes)
+
+	else :
+		root: Span = Span(name, urandom(16).hex(), None, attributes)
+
+	return root, _current.set(root)
+
+
+def end_trace(root: Span, token: Token) -> Span :
+	_current.reset(token)
+	return root.finish()
+
+
+def child_span(name: str, **attributes: Any) -> Optional[Span] :
+	"""
+	records a child span of the current span without making it the current span, the caller must finish it.
+	used where the context can't be held until the span ends, such as across the yields of an async generator.
+	returns None if there is no trace in the current context.
+	"""
+	parent: Optional[Span] = _current.get()
+
+	if parent is None :
+		return None
+
+	child: Span = Span(name, parent.trace_id, parent.span_id, attributes)
+	parent.children.append(child)
+	return child
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]] :
+	"""
+	records a child span of the current span. does nothing if there is no trace in the current context, so it's safe to use anywhere.
+	ex:
+	with span('sql', query=sql) :
+		...
+	"""
+	child: Optional[Span] = child_span(name, **attributes)
+
+	if child is None :
+		yield None
+		return
+
+	token: Token = _current.set(child)
+
+	try :
+		yield child
+
+	finally :
+		child.finish()
+		_current.reset(token)
+
+
+def server_timing(root: Span) -> str :
+	"""
+	formats the total time spent in each kind of child span as a Server-Timing header value
+	"""
+	totals: Dict[str, float] = { }
+
+	for s in root.walk() :
+		if s is not root :
+			totals[s.name] = totals.get(s.name, 0) + s.elapsed()
+
+	totals['app'] = root.elapsed()
+	return ', '.join(f'{name};dur={round(duration * 1000, 3)}' for name, duration in totals.items())
+
+
+class TraceCollector :
+	"""
+	keeps the most recent max_traces completed traces in memory
+	"""
+
+	def __init__(self: 'TraceCollector', max_traces: int = 1000) -> None :
+		self.traces: Deque[Span] = deque(maxlen=max_traces)
+
+
+	def export(self: 'TraceCollector', root: Span) -> None :
+		self.traces.append(root)
+
+
+class OTLPFileCollector(TraceCollector) :
+	"""
+	appends each completed trace to a file in the OTLP json format, one ExportTraceServiceRequest per line.
+	traces are buffered and written in batches from a background thread, so exporting never touches the disk on the event loop.
+	when the buffer is full, new traces are dropped and counted in dropped.
+	"""
+
+	def __init__(self: 'OTLPFileCollector', path: str, service_name: str = 'kh_common', max_traces: int = 0, buffer_size: int = 10000, batch_size: int = 100, flush_interval: float = 1) -> None :
+		TraceCollector.__init__(self, max_traces)
+		self._path: str = path
+		self._service_name: str = service_name
+		self._queue: Queue = Queue(buffer_size)
+		self._batch_size: int = batch_size
+		self._flush_interval: float = flush_interval
+		self._closed: bool = False
+		self.dropped: int = 0
+		self._worker: Thread = Thread(target=self._work, daemon=True)
+		self._worker.start()
+		Terminated.on_terminate(self.close)
+
+
+	def _attributes(self: 'OTLPFileCollector', attributes: Dict[str, Any]) -> List[Dict[str, Any]] :
+		return [{ 'key': key, 'value': { 'stringValue': str(value) } } for key, value in attributes.items()]
+
+
+	def _span(self: 'OTLPFileCollector', s: Span) -> Dict[str, Any] :
+		data: Dict[str, Any] = {
+			'traceId': s.trace_id,
+			'spanId': s.span_id,
+			'name': s.name,
+			'startTimeUnixNano': str(int(s.start * 1e9)),
+			'endTimeUnixNano': str(int((s.start + s.elapsed()) * 1e9)),
+			'attributes': self._attributes(s.attributes),
+		}
+
+		if s.parent_id :
+			data['parentSpanId'] = s.parent_id
+
+		return data
+
+
+	def _line(self: 'OTLPFileCollector', root: Span) -> str :
+		return json.dumps({
+			'resourceSpans': [{
+				'resource': { 'attributes': self._attributes({ 'service.name': self._service_name }) },
+				'scopeSpans': [{
+					'scope': { 'name': 'kh_common.tracing' },
+					'spans': list(map(self._span, root.walk())),
+				}],
+			}],
+		})
+
+
+	def export(self: 'OTLPFileCollector', root: Span) -> None :
+		TraceCollector.export(self, root)
+
+		if self._closed :
+			self.dropped += 1
+			return
+
+		try :
+			# spans are finished by the time they're exported, so they're serialized on the worker
+			self._queue.put_nowait(root)
+
+		except Full :
+			self.dropped += 1
+
+
+	def _write(self: 'OTLPFileCollector', roots: List[Span]) -> None :
+		try :
+			with open(self._path, 'a') as file :
+				file.write(''.join(self._line(root) + '\n' for root in roots))
+
+		except Exception :
+			self.dropped += len(roots)
+
+
+	def _work(self: 'OTLPFileCollector') -> None :
+		stop: bool = False
+
+		while not stop :
+			roots: List[Span] = []
+			deadline: float = time() + self._flush_interval
+
+			while len(roots) < self._batch_size :
+				try :
+					root: Optional[Span] = self._queue.get(timeout=max(deadline - time(), 0))
+
+				except Empty :
+					break
+
+				if root is None :
+					self._queue.task_done()
+					stop = True
+					break
+
+				roots.append(root)
+
+			if roots :
+				self._write(roots)
+
+				for _ in roots :
+					self._queue.task_done()
+
+
+	def flush(self: 'OTLPFileCollector', timeout: float = 5) -> None :
+		"""
+		blocks until the worker has written every trace currently in the buffer, or timeout seconds have passed
+		"""
+		deadline: float = time() + timeout
+		while self._queue.unfinished_tasks and self._worker.is_alive() and time() < deadline :
+			self._worker.join(0.01)
+
+
+	def close(self: 'OTLPFileCollector') -> None :
+		if not self._closed :
+			self._closed = True
+
+			try :
+				self._queue.put(None, timeout=1)
+
+			except Full :
+				pass
+
+			self._worker.join(5)
@@ -1,10 +1,13 @@
 from datetime import datetime
 from decimal import Decimal
 from enum import Enum
-from typing import Any, Callable, Dict
+from re import Pattern
+from re import compile as re_compile
+from typing import Any, Callable, Dict, List, Optional
 from uuid import UUID
 
 from pydantic import BaseModel
+from ujson import dumps, loads
 
 from kh_common.models.auth import KhUser
 
@@ -33,10 +36,222 @@ _conversions: Dict[type, Callable] = {
 }
 
 
+# conversions used by json_default. these only convert a single level, the encoder recurses into the result itself
+_default_conversions: Dict[type, Callable] = {
+	datetime: str,
+	Decimal: float,
+	filter: list,
+	set: list,
+	frozenset: list,
+	Enum: lambda x : x.name,
+	UUID: lambda x : x.hex,
+	KhUser: lambda x : {
+		'user_id': x.user_id,
+		'scope': x.scope,
+		'token': {
+			'expires': x.token.expires,
+			'guid': x.token.guid,
+			'data': x.token.data,
+		} if x.token else None,
+	},
+	BaseModel: lambda x : x.dict(),
+}
+
+
+def _find_conversion(conversions: Dict[type, Callable], cls: type) -> Optional[Callable] :
+	# strings (including str enums) are always returned as-is
+	if issubclass(cls, str) :
+		return None
+
+	for c in cls.__mro__ :
+		if c in conversions :
+			return conversions[c]
+
+	return None
+
+
+# memoized conversion per concrete type, so the mro is only scanned once per type rather than once per item
+_dispatch: Dict[type, Optional[Callable]] = { }
+_default_dispatch: Dict[type, Optional[Callable]] = { }
+
+
 def json_stream(item: Any) -> Any :
-	if isinstance(item, str) :
+	cls: type = type(item)
+
+	try :
+		convert: Optional[Callable] = _dispatch[cls]
+
+	except KeyError :
+		convert = _dispatch[cls] = _find_conversion(_conversions, cls)
+
+	return convert(item) if convert else item
+
+
+def json_default(item: Any) -> Any :
+	"""
+	default hook for json encoders that accept one (ujson, orjson, stdlib json). called only for values the encoder can't serialize natively.
+	ex: orjson.dumps(data, default=json_default)
+	"""
+	cls: type = type(item)
+
+	try :
+		convert: Optional[Callable] = _default_dispatch[cls]
+
+	except KeyError :
+		convert = _default_dispatch[cls] = _find_conversion(_default_conversions, cls)
+
+	if not convert :
+		raise TypeError(f'Object of type {cls.__name__} is not JSON serializable')
+
+	return convert(item)
+
+
+def _convert_tuples(item: Any) -> Any :
+	"""
+	converts tuple subclasses with a conversion, such as KhUser, anywhere within item, since encoders serialize them as arrays without calling json_default.
+	containers are only copied when something within them was converted
+	"""
+	cls: type = type(item)
+
+	if cls is dict :
+		values: List[Any] = list(map(_convert_tuples, item.values()))
+
+		if any(a is not b for a, b in zip(values, item.values())) :
+			return dict(zip(item.keys(), values))
+
 		return item
-	for cls in type(item).__mro__ :
-		if cls in _conversions :
-			return _conversions[cls](item)
+
+	if cls in { list, tuple, set, frozenset } :
+		values: List[Any] = list(map(_convert_tuples, item))
+		return values if any(a is not b for a, b in zip(values, item)) else item
+
+	if isinstance(item, tuple) and _find_conversion(_default_conversions, cls) :
+		return _convert_tuples(json_default(item))
+
 	return item
+
+
+def _dumps_default(item: Any) -> Any :
+	return _convert_tuples(json_default(item))
+
+
+def json_dumps(item: Any, indent: int = 0) -> bytes :
+	"""
+	encodes item directly to json bytes, without building the intermediate structure json_stream does.
+	NOTE: unlike json_stream, falsy values are not removed from lists and int/str enums are encoded by value.
+	"""
+	return dumps(_convert_tuples(item), default=_dumps_default, indent=indent, ensure_ascii=False, escape_forward_slashes=False).encode()
+
+
+# every byte that can change the nesting or string state of a json document
+_structural: Pattern = re_compile(rb'[\[\]{},"\\]')
+
+
+class JsonArrayDecoder :
+	"""
+	decodes a json array incrementally, returning each element as soon as all of its bytes have been fed.
+	only the element currently being received is buffered, so arbitrarily large arrays can be decoded in constant memory.
+	ex:
+	decoder = JsonArrayDecoder()
+	async for chunk in response.content.iter_any() :
+		for item in decoder.feed(chunk) :
+			...
+	decoder.close()
+	"""
+
+	def __init__(self: 'JsonArrayDecoder') -> None :
+		self._buffer: bytearray = bytearray()
+		self._depth: int = 0
+		self._string: bool = False
+		# index of the byte following a backslash within a string, which can't open or close anything
+		self._escaped: int = -1
+		self._start: int = 0
+		self._count: int = 0
+		self._done: bool = False
+
+
+	def _element(self: 'JsonArrayDecoder', end: int, items: List[Any], last: bool = False) -> None :
+		element: bytes = bytes(self._buffer[self._start:end])
+
+		if element.strip() :
+			items.append(loads(element))
+			self._count += 1
+
+		# only an empty array may have nothing between its brackets, as in [] but not [,1] or [1,]
+		elif not last or self._count :
+			raise ValueError('expected a value in json array.')
+
+		self._start = end + 1
+
+
+	def feed(self: 'JsonArrayDecoder', chunk: bytes) -> List[Any] :
+		"""
+		returns every element completed by chunk. raises ValueError if the document isn't a json array
+		"""
+		buffer: bytearray = self._buffer
+		scanned: int = len(buffer)
+		buffer += chunk
+		items: List[Any] = []
+
+		for match in _structural.finditer(buffer, scanned) :
+			i: int = match.start()
+			c: int = buffer[i]
+
+			if self._string :
+				if i == self._escaped :
+					continue
+
+				if c == 0x5c :  # backslash
+					self._escaped = i + 1
+
+				elif c == 0x22 :  # "
+					self._string = False
+
+				continue
+
+			if self._done :
+				raise ValueError('unexpected data after json array.')
+
+			if self._depth == 0 and (c != 0x5b or buffer[:i].strip()) :  # [
+				raise ValueError('expected a json array.')
+
+			if c == 0x22 :  # "
+				self._string = True
+
+			elif c == 0x5b or c == 0x7b :  # [ {
+				self._depth += 1
+
+				if self._depth == 1 :
+					self._start = i + 1
+
+			elif c == 0x5d or c == 0x7d :  # ] }
+				if self._depth == 1 :
+					self._element(i, items, last=True)
+					self._done = True
+
+				self._depth -= 1
+
+			elif c == 0x2c and self._depth == 1 :  # ,
+				self._element(i, items)
+
+		if self._done and buffer[self._start:].strip() :
+			raise ValueError('unexpected data after json array.')
+
+		# drop everything before the element currently being received
+		consumed: int = len(buffer) if self._done or self._depth == 0 and not buffer.strip() else self._start
+		del buffer[:consumed]
+		self._start = max(self._start - consumed, 0)
+		self._escaped -= consumed
+
+		return items
+
+
+	def close(self: 'JsonArrayDecoder') -> None :
+		"""
+		raises ValueError if the array was never closed, or anything other than whitespace follows it
+		"""
+		if not self._done :
+			raise ValueError('incomplete json array.')
+
+		if self._buffer.strip() :
+			raise ValueError('unexpected data after json array.')
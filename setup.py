@@ -22,7 +22,7 @@ setup(
 	long_description_content_type='text/markdown',
 	author='kheina',
 	url='https://github.com/kheina-com/kh-common',
-	packages=find_packages(exclude=['tests']),
+	packages=find_packages(exclude=['tests', 'benchmarks']),
 	install_requires=list(filter(None, map(str.strip, open('requirements.txt').read().split()))),
 	python_requires='>=3.9.*',
 	license='Mozilla Public License 2.0',
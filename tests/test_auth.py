@@ -1,14 +1,22 @@
 from kh_common.logging import LogHandler; LogHandler.logging_available = False
+from asyncio import gather
 from datetime import datetime, timezone
+from time import time
 from uuid import uuid4
 
 import pytest
+from fastapi.testclient import TestClient
 from pytest import raises
 
-from kh_common.auth import AuthToken, KhUser, Scope, verifyToken
+from kh_common.auth import KVS, AuthToken, InvalidToken, KhUser, Scope, tokenCache, verifyToken, verifyTokens
+from kh_common.auth.key_ring import KeyRing
+from kh_common.auth.token_cache import TokenCache
+from kh_common.base64 import b64encode
 from kh_common.caching.key_value_store import KeyValueStore
 from kh_common.exceptions.http_error import Forbidden, Unauthorized
 from kh_common.models.auth import AuthState, TokenMetadata
+from kh_common.server import ServerApp
+from kh_common.utilities import int_to_bytes
 from tests.utilities.aerospike import AerospikeClient
 from tests.utilities.auth import expires, mock_pk, mock_token
 
@@ -292,3 +300,431 @@ class TestAuthToken :
 
 		# assert
 		assert result
+
+
+	async def test_VerifyToken_TokenCached_NoRemoteCalls(self, mocker) :
+
+		# arrange
+		TestAuthToken.client.clear()
+		key_id = 12345
+		mock_pk(mocker, key_id=key_id)
+		user_id = 1234567890
+		guid = uuid4()
+		token = mock_token(user_id, guid=guid, key_id=key_id)
+
+		TestAuthToken.client.put(('kheina', 'token', guid.bytes), { 'data': TokenMetadata(
+			state=AuthState.active,
+			key_id=key_id,
+			user_id=user_id,
+			version=b'1',
+			algorithm='ed25519',
+			expires=datetime.fromtimestamp(expires, timezone.utc),
+			issued=datetime.now(timezone.utc),
+			fingerprint=b'',
+		)})
+		expected = await verifyToken(token)
+		get_async = mocker.patch.object(KVS, 'get_async')
+
+		# act
+		result = await verifyToken(token)
+
+		# assert
+		assert expected == result
+		get_async.assert_not_called()
+
+
+	async def test_VerifyToken_TokenRevoked_MetadataChecked(self, mocker) :
+
+		# arrange
+		TestAuthToken.client.clear()
+		key_id = 12345
+		mock_pk(mocker, key_id=key_id)
+		user_id = 1234567890
+		guid = uuid4()
+		token = mock_token(user_id, guid=guid, key_id=key_id)
+		metadata = TokenMetadata(
+			state=AuthState.active,
+			key_id=key_id,
+			user_id=user_id,
+			version=b'1',
+			algorithm='ed25519',
+			expires=datetime.fromtimestamp(expires, timezone.utc),
+			issued=datetime.now(timezone.utc),
+			fingerprint=b'',
+		)
+
+		TestAuthToken.client.put(('kheina', 'token', guid.bytes), { 'data': metadata })
+		await verifyToken(token)
+		metadata.state = AuthState.inactive
+		TestAuthToken.client.put(('kheina', 'token', guid.bytes), { 'data': metadata })
+		KVS._cache.clear()
+
+		# act
+		tokenCache.revoke(guid)
+
+		# assert
+		with raises(Unauthorized) :
+			await verifyToken(token)
+
+
+	async def test_VerifyToken_RevokedInMetadataOnly_RejectedAfterMaxAge(self, mocker) :
+
+		# arrange
+		TestAuthToken.client.clear()
+		key_id = 12345
+		mock_pk(mocker, key_id=key_id)
+		user_id = 1234567890
+		guid = uuid4()
+		token = mock_token(user_id, guid=guid, key_id=key_id)
+		metadata = TokenMetadata(
+			state=AuthState.active,
+			key_id=key_id,
+			user_id=user_id,
+			version=b'1',
+			algorithm='ed25519',
+			expires=datetime.fromtimestamp(expires, timezone.utc),
+			issued=datetime.now(timezone.utc),
+			fingerprint=b'',
+		)
+
+		TestAuthToken.client.put(('kheina', 'token', guid.bytes), { 'data': metadata })
+		await verifyToken(token)
+		metadata.state = AuthState.inactive
+		TestAuthToken.client.put(('kheina', 'token', guid.bytes), { 'data': metadata })
+		KVS._cache.clear()
+
+		# act
+		mocker.patch('kh_common.auth.token_cache.time', return_value=time() + 31)
+
+		# assert
+		with raises(Unauthorized) :
+			await verifyToken(token)
+
+
+	def test_TokenCache_OlderThanMaxAge_ReturnsNone(self, mocker) :
+
+		# arrange
+		cache = TokenCache(max_age=30)
+		token = AuthToken(1, datetime.now(), uuid4(), { }, 'a.b.c')
+		cache.put(token.guid.bytes, expires, token, cache.generation())
+
+		# act
+		mocker.patch('kh_common.auth.token_cache.time', return_value=time() + 31)
+		result = cache.get(token.guid.bytes, 'a.b.c')
+
+		# assert
+		assert result is None
+
+
+	def test_TokenCache_Listening_HeldUntilExpiry(self, mocker) :
+
+		# arrange
+		cache = TokenCache(max_age=30)
+		cache.listening = True
+		token = AuthToken(1, datetime.now(), uuid4(), { }, 'a.b.c')
+		cache.put(token.guid.bytes, expires, token, cache.generation())
+
+		# act
+		mocker.patch('kh_common.auth.token_cache.time', return_value=time() + 31)
+		result = cache.get(token.guid.bytes, 'a.b.c')
+
+		# assert
+		assert token == result
+
+
+	def test_TokenCache_DifferentTokenString_ReturnsNone(self) :
+
+		# arrange
+		cache = TokenCache()
+		token = AuthToken(1, datetime.now(), uuid4(), { }, 'a.b.c')
+		cache.put(token.guid.bytes, expires, token, cache.generation())
+
+		# act
+		result = cache.get(token.guid.bytes, 'a.b.d')
+
+		# assert
+		assert result is None
+		assert token == cache.get(token.guid.bytes, 'a.b.c')
+
+
+	def test_TokenCache_Expired_ReturnsNone(self) :
+
+		# arrange
+		cache = TokenCache()
+		token = AuthToken(1, datetime.now(), uuid4(), { }, 'a.b.c')
+		cache.put(token.guid.bytes, 0, token, cache.generation())
+
+		# act
+		result = cache.get(token.guid.bytes, 'a.b.c')
+
+		# assert
+		assert result is None
+
+
+	def test_TokenCache_MaxSize_OldestEvicted(self) :
+
+		# arrange
+		cache = TokenCache(max_size=1)
+		first = AuthToken(1, datetime.now(), uuid4(), { }, 'a')
+		second = AuthToken(2, datetime.now(), uuid4(), { }, 'b')
+
+		# act
+		cache.put(first.guid.bytes, expires, first, cache.generation())
+		cache.put(second.guid.bytes, expires, second, cache.generation())
+
+		# assert
+		assert cache.get(first.guid.bytes, 'a') is None
+		assert second == cache.get(second.guid.bytes, 'b')
+
+
+	def test_TokenCache_RevokedAfterGeneration_NotStored(self) :
+
+		# arrange
+		cache = TokenCache()
+		token = AuthToken(1, datetime.now(), uuid4(), { }, 'a.b.c')
+		generation = cache.generation()
+
+		# act
+		cache.revoke(token.guid)
+		cache.put(token.guid.bytes, expires, token, generation)
+
+		# assert
+		assert cache.get(token.guid.bytes, 'a.b.c') is None
+
+
+	def test_TokenCache_RevocationsForgotten_OlderGenerationsNotStored(self) :
+
+		# arrange
+		cache = TokenCache(max_revocations=1)
+		token = AuthToken(1, datetime.now(), uuid4(), { }, 'a.b.c')
+		generation = cache.generation()
+
+		# act
+		cache.revoke(token.guid)
+		cache.revoke(uuid4())
+		cache.put(token.guid.bytes, expires, token, generation)
+		stale = cache.get(token.guid.bytes, 'a.b.c')
+		cache.put(token.guid.bytes, expires, token, cache.generation())
+
+		# assert
+		assert stale is None
+		assert token == cache.get(token.guid.bytes, 'a.b.c')
+
+
+	async def test_VerifyToken_RevokedWhileMetadataInFlight_NotCached(self, mocker) :
+
+		# arrange
+		TestAuthToken.client.clear()
+		key_id = 12345
+		mock_pk(mocker, key_id=key_id)
+		user_id = 1234567890
+		guid = uuid4()
+		token = mock_token(user_id, guid=guid, key_id=key_id)
+
+		TestAuthToken.client.put(('kheina', 'token', guid.bytes), { 'data': TokenMetadata(
+			state=AuthState.active,
+			key_id=key_id,
+			user_id=user_id,
+			version=b'1',
+			algorithm='ed25519',
+			expires=datetime.fromtimestamp(expires, timezone.utc),
+			issued=datetime.now(timezone.utc),
+			fingerprint=b'',
+		)})
+		KVS._cache.clear()
+		get_async = KVS.get_async
+
+		async def revoked_during_read(key) :
+			# the metadata is read before the revocation lands
+			metadata = await get_async(key)
+			tokenCache.revoke(guid)
+			return metadata
+
+		mocker.patch.object(KVS, 'get_async', revoked_during_read)
+
+		# act
+		result = await verifyToken(token)
+
+		# assert
+		assert result
+		assert tokenCache.get(guid.bytes, token) is None
+
+
+	async def test_VerifyTokens_MixedTokens_ResultsInOrder(self, mocker) :
+
+		# arrange
+		TestAuthToken.client.clear()
+		key_id = 12345
+		mock_pk(mocker, key_id=key_id)
+		user_id = 1234567890
+		guids = [uuid4() for _ in range(3)]
+		tokens = [
+			mock_token(user_id, guid=guids[0], key_id=key_id),
+			mock_token(user_id, guid=guids[1], key_id=key_id, valid_signature=False),
+			mock_token(user_id, guid=guids[2], key_id=key_id),
+			mock_token(user_id, guid=guids[0], key_id=key_id, version=b'0'),
+		]
+
+		for guid in guids[:2] :
+			TestAuthToken.client.put(('kheina', 'token', guid.bytes), { 'data': TokenMetadata(
+				state=AuthState.active,
+				key_id=key_id,
+				user_id=user_id,
+				version=b'1',
+				algorithm='ed25519',
+				expires=datetime.fromtimestamp(expires, timezone.utc),
+				issued=datetime.now(timezone.utc),
+				fingerprint=b'',
+			)})
+
+		# act
+		results = await verifyTokens(tokens)
+
+		# assert
+		assert 4 == len(results)
+		assert isinstance(results[0], AuthToken) and guids[0] == results[0].guid
+		assert isinstance(results[1], Unauthorized)
+		assert isinstance(results[2], Unauthorized)
+		assert isinstance(results[3], InvalidToken)
+		assert 1 == len(TestAuthToken.client.calls['get_many'])
+
+
+
+	async def test_VerifyToken_MalformedToken_RaisesInvalidToken(self) :
+
+		# arrange
+		version = b64encode(b'1').decode()
+		tokens = [
+			f'{version}.signature',
+			f'{version}.abcde.signature',
+			f'{version}.{b64encode(b"ed25519.AQ.AQ").decode()}.signature',
+			f'{version}.{b64encode(b"ed25519.AQ." + b64encode(int_to_bytes(expires)) + b".AQ.AQ.{}").decode()}.signature',
+		]
+
+		# act
+		for token in tokens :
+			with raises(InvalidToken) :
+				await verifyToken(token)
+
+
+	async def test_VerifyToken_ExpiredToken_RejectedBeforeKeyFetch(self, mocker) :
+
+		# arrange
+		fetch = mocker.patch('kh_common.auth.async_request')
+		mocker.patch('kh_common.auth.time', return_value=expires + 1)
+		token = mock_token(1, guid=uuid4(), key_id=12345)
+
+		# act
+		with raises(Unauthorized) :
+			await verifyToken(token)
+
+		# assert
+		fetch.assert_not_called()
+
+@pytest.mark.asyncio
+class TestKeyRing :
+
+	async def test_Get_ConcurrentRequests_SingleFetch(self) :
+
+		# arrange
+		calls = []
+
+		async def fetch(key_id, algorithm) :
+			calls.append((key_id, algorithm))
+			return 'key', time() + 1000
+
+		ring = KeyRing(fetch)
+
+		# act
+		results = await gather(*(ring.get(1, 'ed25519') for _ in range(5)))
+
+		# assert
+		assert ['key'] * 5 == results
+		assert [(1, 'ed25519')] == calls
+
+
+	async def test_Get_KeyExpired_Refetched(self) :
+
+		# arrange
+		calls = []
+
+		async def fetch(key_id, algorithm) :
+			calls.append(key_id)
+			return f'key{len(calls)}', time() - 1 if len(calls) == 1 else time() + 1000
+
+		ring = KeyRing(fetch)
+		await ring.get(1, 'ed25519')
+
+		# act
+		result = await ring.get(1, 'ed25519')
+
+		# assert
+		assert 'key2' == result
+		assert [1, 1] == calls
+
+
+	async def test_Refresh_KeysLoaded_StaleRefreshedAndNextKeyProbed(self) :
+
+		# arrange
+		calls = []
+
+		async def fetch(key_id, algorithm) :
+			calls.append(key_id)
+
+			if key_id == 3 :
+				raise Unauthorized('Key does not exist.')
+
+			return 'key', time() + (10 if key_id == 1 else 100000)
+
+		ring = KeyRing(fetch, refresh_before=3600)
+		await ring.preload([1, 2])
+		calls.clear()
+
+		# act
+		await ring.refresh()
+
+		# assert
+		assert [1, 3] == sorted(calls)
+		assert { (1, 'ed25519'), (2, 'ed25519') } == ring._keys.keys()
+
+
+	async def test_Start_KeyIds_LoadedBeforeReturning(self) :
+
+		# arrange
+		calls = []
+
+		async def fetch(key_id, algorithm) :
+			calls.append(key_id)
+
+			if key_id == 3 :
+				raise Unauthorized('Key does not exist.')
+
+			return f'key{key_id}', time() + 100000
+
+		ring = KeyRing(fetch)
+
+		# act
+		await ring.start([1, 2])
+		ring.stop()
+
+		# assert
+		assert { (1, 'ed25519'), (2, 'ed25519') } == ring._keys.keys()
+		assert 3 in calls
+		assert 'key2' == await ring.get(2, 'ed25519')
+		assert 3 == len(calls)
+
+
+	def test_ServerApp_AuthKeys_PreloadedOnStartup(self, mocker) :
+
+		# arrange
+		ring = KeyRing(None)
+		start = mocker.patch.object(ring, 'start')
+		mocker.patch('kh_common.auth.keyRing', ring)
+		app = ServerApp(auth=True, auth_keys=[1, 2])
+
+		# act
+		with TestClient(app) :
+			pass
+
+		# assert
+		start.assert_awaited_once_with([1, 2])
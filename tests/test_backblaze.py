@@ -0,0 +1,636 @@
+from kh_common.config import credentials; credentials.b2 = { 'key_id': 'id', 'key': 'key' }
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+from asyncio import gather
+from hashlib import sha1
+from io import BytesIO
+from os import urandom
+
+import pytest
+
+from kh_common.backblaze import B2Error, DownloadCache
+from tests.utilities.backblaze import B2Server, create_b2
+
+
+@pytest.mark.asyncio
+class TestLargeUpload :
+
+	@pytest.mark.parametrize(
+		"concurrency",
+		[1, 4],
+	)
+	async def test_UploadLarge_BytesSource_PartsAssembledInOrder(self, mocker, concurrency: int) :
+		mocker.patch('kh_common.backblaze.MinimumPartSize', 1)
+
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(1000)
+
+			# act
+			result = await b2.b2_upload_large_async(data, 'large.mp4', part_size=100, concurrency=concurrency)
+
+			# assert
+			assert server.files['large.mp4'][-1]['data'] == data
+			assert result['fileName'] == 'large.mp4'
+			assert server.calls.count('upload_part') == 10
+			assert not server.large
+
+
+	async def test_UploadLarge_PathSource_PartsUploadedFromFile(self, mocker, tmp_path) :
+		mocker.patch('kh_common.backblaze.MinimumPartSize', 1)
+
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(1000)
+			path = tmp_path / 'large.mp4'
+			path.write_bytes(data)
+
+			# act
+			await b2.b2_upload_large_async(str(path), 'large.mp4', part_size=300)
+
+			# assert
+			assert server.files['large.mp4'][-1]['data'] == data
+
+
+	async def test_UploadLarge_StreamSource_SplitIntoParts(self, mocker) :
+		mocker.patch('kh_common.backblaze.MinimumPartSize', 1)
+
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(1000)
+
+			async def stream() :
+				for i in range(0, len(data), 64) :
+					yield data[i:i + 64]
+
+			# act
+			await b2.b2_upload_large_async(stream(), 'large.mp4', part_size=300)
+
+			# assert
+			assert server.files['large.mp4'][-1]['data'] == data
+			assert server.calls.count('upload_part') == 4
+
+
+	async def test_UploadLarge_SinglePart_UploadedAsRegularFile(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+
+			# act
+			result = await b2.b2_upload_large_async(b'small', 'small.jpg')
+
+			# assert
+			assert server.files['small.jpg'][-1]['data'] == b'small'
+			assert result['contentSha1'] == sha1(b'small').hexdigest()
+			assert 'b2_start_large_file' not in server.calls
+
+
+	async def test_UploadLarge_PartFailsRetryable_PartRetriedOnNewUrl(self, mocker) :
+		mocker.patch('kh_common.backblaze.MinimumPartSize', 1)
+
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(1000)
+			server.fail['upload_part'] = 1
+
+			# act
+			await b2.b2_upload_large_async(data, 'large.mp4', part_size=500, concurrency=1)
+
+			# assert
+			assert server.files['large.mp4'][-1]['data'] == data
+			assert server.calls.count('upload_part') == 3
+			assert server.calls.count('b2_get_upload_part_url') == 2
+
+
+	async def test_UploadLarge_PartFails_LargeFileCancelled(self, mocker, tmp_path) :
+		mocker.patch('kh_common.backblaze.MinimumPartSize', 1)
+
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			path = tmp_path / 'large.mp4'
+			path.write_bytes(urandom(1000))
+			server.fail['upload_part'] = 100
+			server.fail_status = 400
+
+			# act
+			with pytest.raises(B2Error) :
+				await b2.b2_upload_large_async(str(path), 'large.mp4', part_size=100)
+
+			# assert
+			assert 'b2_cancel_large_file' in server.calls
+			assert 'b2_finish_large_file' not in server.calls
+			assert not server.large
+
+
+	async def test_UploadLarge_StartFails_PartsReleased(self, mocker, tmp_path) :
+		mocker.patch('kh_common.backblaze.MinimumPartSize', 1)
+
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			path = tmp_path / 'large.mp4'
+			path.write_bytes(urandom(1000))
+			server.fail['b2_start_large_file'] = 1
+			server.fail_status = 400
+
+			# act & assert
+			# a view left unreleased would fail closing the mmap with a BufferError instead
+			with pytest.raises(B2Error) :
+				await b2.b2_upload_large_async(str(path), 'large.mp4', part_size=100)
+
+			assert 'upload_part' not in server.calls
+
+
+@pytest.mark.asyncio
+class TestStreamUpload :
+
+	async def test_UploadStream_PathSource_Sha1SentAfterBody(self, mocker, tmp_path) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(100000)
+			path = tmp_path / 'stream.mp4'
+			path.write_bytes(data)
+
+			# act
+			result = await b2.b2_upload_stream_async(str(path), 'stream.mp4', chunk_size=4096)
+
+			# assert
+			assert server.files['stream.mp4'][-1]['data'] == data
+			assert result['contentSha1'] == sha1(data).hexdigest()
+
+
+	async def test_UploadStream_FileObjectAfterFailure_ResentFromStartPosition(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(100000)
+			file = BytesIO(b'skipped' + data)
+			file.seek(7)
+			server.fail['upload'] = 1
+
+			# act
+			await b2.b2_upload_stream_async(file, 'stream.mp4', chunk_size=4096)
+
+			# assert
+			assert server.files['stream.mp4'][-1]['data'] == data
+			assert server.calls.count('upload') == 2
+			assert server.calls.count('b2_get_upload_url') == 2
+
+
+	async def test_UploadStream_AsyncIterable_Uploaded(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(100000)
+
+			async def stream() :
+				for i in range(0, len(data), 4096) :
+					yield data[i:i + 4096]
+
+			# act
+			await b2.b2_upload_stream_async(stream(), 'stream.mp4', size=len(data))
+
+			# assert
+			assert server.files['stream.mp4'][-1]['data'] == data
+
+
+	@pytest.mark.parametrize(
+		"offset",
+		[-1, 1],
+	)
+	async def test_UploadStream_SizeMismatch_RaisesValueError(self, mocker, offset: int) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(100000)
+
+			async def stream() :
+				yield data
+
+			# act
+			with pytest.raises(ValueError) :
+				await b2.b2_upload_stream_async(stream(), 'stream.mp4', size=len(data) + offset)
+
+			# assert
+			assert 'stream.mp4' not in server.files
+
+
+	async def test_UploadStream_AsyncIterableWithoutSize_RaisesValueError(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+
+			async def stream() :
+				yield b'data'
+
+			# act & assert
+			with pytest.raises(ValueError) :
+				await b2.b2_upload_stream_async(stream(), 'stream.mp4')
+
+
+	async def test_UploadStream_EmptyFile_UploadedAsRegularFile(self, mocker, tmp_path) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			path = tmp_path / 'empty.mp4'
+			path.write_bytes(b'')
+
+			# act
+			await b2.b2_upload_stream_async(str(path), 'empty.mp4')
+
+			# assert
+			assert server.files['empty.mp4'][-1]['data'] == b''
+
+
+	async def test_UploadLarge_EmptyFile_UploadedAsRegularFile(self, mocker, tmp_path) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			path = tmp_path / 'empty.mp4'
+			path.write_bytes(b'')
+
+			# act
+			await b2.b2_upload_large_async(str(path), 'empty.mp4')
+
+			# assert
+			assert server.files['empty.mp4'][-1]['data'] == b''
+			assert 'b2_start_large_file' not in server.calls
+
+
+@pytest.mark.asyncio
+class TestUploadUrls :
+
+	async def test_UploadAsync_SequentialBatches_UploadUrlsReused(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			await gather(*(b2.b2_upload_async(urandom(100), f'{i}.jpg') for i in range(5)))
+			obtained = server.upload_urls
+
+			# act
+			await gather(*(b2.b2_upload_async(urandom(100), f'{i}.jpg') for i in range(5)))
+
+			# assert
+			assert obtained == 5
+			assert server.upload_urls == 5
+			assert len(b2._upload_urls) == 5
+
+
+	async def test_UploadAsync_MoreUrlsThanMax_PoolBounded(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker, max_upload_urls=2)
+
+			# act
+			await gather(*(b2.b2_upload_async(urandom(100), f'{i}.jpg') for i in range(5)))
+
+			# assert
+			assert len(b2._upload_urls) == 2
+
+
+	async def test_UploadAsync_UploadFails_UrlRetired(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			await b2.b2_upload_async(b'first', 'first.jpg')
+			failed = b2._upload_urls[0]
+			server.fail['upload'] = 1
+
+			# act
+			await b2.b2_upload_async(b'second', 'second.jpg')
+
+			# assert
+			assert server.files['second.jpg'][-1]['data'] == b'second'
+			assert server.upload_urls == 2
+			assert failed not in b2._upload_urls
+			assert len(b2._upload_urls) == 1
+
+
+	async def test_UploadAsync_PooledUrlExpired_NewUrlObtained(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			await b2.b2_upload_async(b'first', 'first.jpg')
+			b2._upload_urls[0]['expires'] = 0
+
+			# act
+			await b2.b2_upload_async(b'second', 'second.jpg')
+
+			# assert
+			assert server.upload_urls == 2
+			assert len(b2._upload_urls) == 1
+
+
+	async def test_UploadAsync_AuthTokenExpired_SingleReauthorization(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			server.token = 'token-2'
+
+			# act
+			await gather(*(b2.b2_upload_async(urandom(100), f'{i}.jpg') for i in range(10)))
+
+			# assert
+			assert server.calls.count('b2_authorize_account') == 1
+			assert b2.b2_auth_token == 'token-2'
+			assert len(server.files) == 10
+
+
+@pytest.mark.asyncio
+class TestListFiles :
+
+	async def test_ListFiles_MultiplePages_EveryFileYieldedInOrder(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+
+			for name in ['c.jpg', 'a.jpg', 'e.jpg', 'b.jpg', 'd.jpg'] :
+				server.store(name, b'data')
+
+			# act
+			result = [file['fileName'] async for file in b2.b2_list_files_async(page_size=2)]
+
+			# assert
+			assert result == ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'e.jpg']
+			assert server.calls.count('b2_list_file_names') == 3
+
+
+	async def test_ListFiles_VersionsSplitAcrossPages_EachVersionYieldedOnce(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			ids = [server.store('a.jpg', bytes([i]))['fileId'] for i in range(3)]
+			ids.append(server.store('b.jpg', b'b')['fileId'])
+
+			# act
+			result = [file['fileId'] async for file in b2.b2_list_files_async(versions=True, page_size=2)]
+
+			# assert
+			assert result == ids[2::-1] + ids[3:]
+
+
+	async def test_ListFiles_Prefix_OnlyMatchingFilesYielded(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+
+			for name in ['a/1.jpg', 'a/2.jpg', 'b/1.jpg'] :
+				server.store(name, b'data')
+
+			# act
+			result = [file['fileName'] async for file in b2.b2_list_files_async('a/')]
+
+			# assert
+			assert result == ['a/1.jpg', 'a/2.jpg']
+
+
+	async def test_DeleteFile_MultipleVersions_EveryVersionDeleted(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+
+			for i in range(3) :
+				server.store('a.jpg', bytes([i]))
+
+			server.store('a.jpg.bak', b'kept')
+
+			# act
+			result = await b2.b2_delete_file_async('a.jpg')
+
+			# assert
+			assert result
+			assert list(server.files) == ['a.jpg.bak']
+
+
+	async def test_DeleteMany_SomeMissing_ResultPerFile(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			server.store('a.jpg', b'a')
+			server.store('b.jpg', b'b')
+
+			# act
+			result = await b2.b2_delete_many_async(['a.jpg', 'b.jpg', 'c.jpg', 'a.jpg'])
+
+			# assert
+			assert result == { 'a.jpg': True, 'b.jpg': True, 'c.jpg': False }
+			assert not server.files
+
+
+	async def test_GetFileInfoMany_NewestVersionOrNone(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			server.store('a.jpg', b'old')
+			newest = server.store('a.jpg', b'new')
+			server.store('ab.jpg', b'ab')
+
+			# act
+			result = await b2.b2_get_file_info_many(['a.jpg', 'a', 'c.jpg'])
+
+			# assert
+			assert result['a.jpg']['fileId'] == newest['fileId']
+			assert result['a'] is None
+			assert result['c.jpg'] is None
+
+
+	async def test_ListFiles_ServiceUnavailable_Retried(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			server.store('a.jpg', b'a')
+			server.fail['b2_list_file_names'] = 2
+
+			# act
+			result = [file['fileName'] async for file in b2.b2_list_files_async()]
+
+			# assert
+			assert result == ['a.jpg']
+			assert server.calls.count('b2_list_file_names') == 3
+
+
+@pytest.mark.asyncio
+class TestDownload :
+
+	async def test_DownloadRange_MultipleParts_AssembledInOrder(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(1000)
+			server.store('a.jpg', data)
+
+			# act
+			result = b''.join([part async for part in b2.b2_download_range_async('a.jpg', 100, 900, part_size=64, concurrency=3)])
+
+			# assert
+			assert result == data[100:900]
+			assert server.calls.count('download') == 1 + 13
+
+
+	async def test_DownloadRange_EndPastFile_ClampedToFileSize(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(1000)
+			server.store('a.jpg', data)
+
+			# act
+			result = b''.join([part async for part in b2.b2_download_range_async('a.jpg', 900, 5000, part_size=64)])
+
+			# assert
+			assert result == data[900:]
+
+
+	async def test_Download_WholeFile_WrittenToDestination(self, mocker, tmp_path) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(1000)
+			server.store('a.jpg', data)
+			path = tmp_path / 'a.jpg'
+
+			# act
+			await b2.b2_download_async('a.jpg', str(path), part_size=64)
+
+			# assert
+			assert path.read_bytes() == data
+
+
+	async def test_Download_Sha1Mismatch_RaisesB2Error(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			server.store('a.jpg', urandom(1000), content_sha1=sha1(b'other').hexdigest())
+			destination = BytesIO()
+
+			# act & assert
+			with pytest.raises(B2Error) :
+				await b2.b2_download_async('a.jpg', destination, part_size=64)
+
+
+	async def test_Download_ExpectedSha1NotNewest_RaisesBeforeDownloading(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			server.store('a.jpg', urandom(1000))
+
+			# act
+			with pytest.raises(B2Error) :
+				await b2.b2_download_async('a.jpg', BytesIO(), sha1=sha1(b'other').hexdigest())
+
+			# assert
+			assert server.calls.count('download') == 1
+
+
+	async def test_Download_PartFails_Retried(self, mocker) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker)
+			data = urandom(1000)
+			server.store('a.jpg', data)
+			server.fail['download'] = 2
+			destination = BytesIO()
+
+			# act
+			await b2.b2_download_async('a.jpg', destination, part_size=300)
+
+			# assert
+			assert destination.getvalue() == data
+
+
+	async def test_Download_Cached_ReadWithoutNetworkCalls(self, mocker, tmp_path) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker, download_cache=DownloadCache(tmp_path))
+			data = urandom(1000)
+			server.store('a.jpg', data)
+			await b2.b2_download_async('a.jpg', BytesIO(), part_size=64)
+			calls = len(server.calls)
+			destination = BytesIO()
+
+			# act
+			await b2.b2_download_async('a.jpg', destination, sha1=sha1(data).hexdigest())
+
+			# assert
+			assert destination.getvalue() == data
+			assert len(server.calls) == calls
+
+
+	async def test_Download_ConcurrentDownloads_DownloadedOnce(self, mocker, tmp_path) :
+		async with B2Server() as server :
+			# arrange
+			b2 = create_b2(server, mocker, download_cache=DownloadCache(tmp_path))
+			data = urandom(1000)
+			server.store('a.jpg', data)
+			destinations = [BytesIO() for _ in range(3)]
+
+			# act
+			await gather(*(b2.b2_download_async('a.jpg', destination, part_size=100) for destination in destinations))
+
+			# assert
+			assert all(destination.getvalue() == data for destination in destinations)
+			# one HEAD per download, and the file's ten parts once
+			assert server.calls.count('download') == 3 + 10
+
+
+class TestDownloadCache :
+
+	def put(self, cache: DownloadCache, filename: str, data: bytes) -> None :
+		temp = cache.temp()
+
+		with open(temp, 'wb') as file :
+			file.write(data)
+
+		cache.put(filename, 'version', temp)
+
+
+	def test_DownloadCache_OverMaxSize_LeastRecentlyUsedEvicted(self, tmp_path) :
+		# arrange
+		cache = DownloadCache(tmp_path, max_size=250)
+		self.put(cache, 'a', b'a' * 100)
+		self.put(cache, 'b', b'b' * 100)
+		cache.open('a', 'version').close()
+
+		# act
+		self.put(cache, 'c', b'c' * 100)
+
+		# assert
+		assert cache.open('b', 'version') is None
+
+		with cache.open('a', 'version') as file :
+			assert file.read() == b'a' * 100
+
+		assert len(list(tmp_path.iterdir())) == 2
+
+
+	def test_DownloadCache_LargerThanCache_NotKept(self, tmp_path) :
+		# arrange
+		cache = DownloadCache(tmp_path, max_size=50)
+
+		# act
+		self.put(cache, 'a', b'a' * 100)
+
+		# assert
+		assert cache.open('a', 'version') is None
+		assert not list(tmp_path.iterdir())
+
+
+	def test_DownloadCache_ExistingDirectory_FilesAdoptedAndPartialsRemoved(self, tmp_path) :
+		# arrange
+		cache = DownloadCache(tmp_path)
+		self.put(cache, 'a', b'a' * 100)
+		(tmp_path / 'interrupted.part').write_bytes(b'partial')
+
+		# act
+		result = DownloadCache(tmp_path)
+
+		# assert
+		with result.open('a', 'version') as file :
+			assert file.read() == b'a' * 100
+
+		assert not (tmp_path / 'interrupted.part').exists()
@@ -0,0 +1,192 @@
+from kh_common.config import credentials; credentials.db = { }
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+import pytest
+
+from kh_common.blocking import Blocklist, UserBlocking, tag_mask
+
+
+class MockQuery :
+
+	def __init__(self, tags, users) :
+		self.tags = tags
+		self.users = users
+		self.calls = []
+
+
+	def __call__(self, sql, params, **kwargs) :
+		self.calls.append(params[0])
+		data = self.tags if 'tag_blocking' in sql else self.users
+		return [row for row in data if row[0] in params[0]]
+
+
+	async def query_async(self, *args, **kwargs) :
+		return self(*args, **kwargs)
+
+
+class TestUserBlocking :
+
+	def create_blocking(self, mocker) -> UserBlocking :
+		mocker.patch('kh_common.sql.SqlInterface._sql_connect')
+		blocking = UserBlocking()
+		blocking.query = MockQuery(
+			[(1, 'a', 1), (1, 'b', 4), (2, 'c', 2)],
+			[(1, 'user', 10)],
+		)
+		blocking.query_async = blocking.query.query_async
+		return blocking
+
+
+	def test_TagMask_TagIds_BitsSet(self) :
+		assert 0b10011 == tag_mask([0, 1, 4])
+
+
+	def test_UserBlocklists_ManyUsers_SingleQueryEach(self, mocker) :
+		# arrange
+		blocking = self.create_blocking(mocker)
+
+		# act
+		result = blocking.user_blocklists([1, 2, 3])
+
+		# assert
+		assert 2 == len(blocking.query.calls)
+		assert Blocklist(frozenset(['a', 'b']), 0b10010, frozenset(['user']), frozenset([10])) == result[1]
+		assert Blocklist(frozenset(['c']), 0b100, frozenset(), frozenset()) == result[2]
+		assert Blocklist(frozenset(), 0, frozenset(), frozenset()) == result[3]
+
+
+	def test_UserBlocklists_Cached_QueryNotCalled(self, mocker) :
+		# arrange
+		blocking = self.create_blocking(mocker)
+		blocking.user_blocklists([1, 2])
+
+		# act
+		blocking.user_blocklists([1, 2])
+		blocking.user_blocklist(1)
+
+		# assert
+		assert 2 == len(blocking.query.calls)
+
+
+	@pytest.mark.asyncio
+	async def test_UserBlocklistsAsync_ManyUsers_ReturnsBlocklists(self, mocker) :
+		# arrange
+		blocking = self.create_blocking(mocker)
+
+		# act
+		result = await blocking.user_blocklist_async(2)
+
+		# assert
+		assert frozenset(['c']) == result.tags
+
+
+	def test_Blocklist_Filter_BlockedItemsRemoved(self) :
+		# arrange
+		blocklist = Blocklist(frozenset(['a']), tag_mask([1]), frozenset(['user']), frozenset([10]))
+		posts = [
+			{ 'tags': ['a', 'b'], 'uploader': 'other' },
+			{ 'tags': ['b'], 'uploader': 'user' },
+			{ 'tags': ['b', 'c'], 'uploader': 'other' },
+		]
+
+		# act
+		result = blocklist.filter(posts, lambda x : x['tags'], lambda x : x['uploader'])
+
+		# assert
+		assert [posts[2]] == result
+		assert blocklist.blocked_mask(tag_mask([1, 2]))
+		assert not blocklist.blocked_mask(tag_mask([2, 3]))
+		assert blocklist.blocked_mask(0, uploader_id=10)
+
+
+	def test_Invalidate_Cached_UserQueriedAgain(self, mocker) :
+		# arrange
+		blocking = self.create_blocking(mocker)
+		blocking.user_blocklists([1, 2])
+
+		# act
+		blocking.invalidate(1)
+		blocking.user_blocklists([1, 2])
+
+		# assert
+		assert [[1, 2], [1, 2], [1], [1]] == list(map(sorted, blocking.query.calls))
+
+
+	def test_Invalidate_DuringQuery_StaleResultNotCached(self, mocker) :
+		# arrange
+		blocking = self.create_blocking(mocker)
+		query = blocking.query
+
+		def invalidating_query(sql, params, **kwargs) :
+			# the trigger fires after the rows were read, but before they're stored
+			blocking.invalidate(1)
+			blocking.query = query
+			return query(sql, params, **kwargs)
+
+		blocking.query = invalidating_query
+
+		# act
+		blocking.user_blocklists([1, 2])
+		blocking.user_blocklists([1, 2])
+
+		# assert
+		assert [[1, 2], [1, 2], [1], [1]] == list(map(sorted, query.calls))
+
+
+	def test_InvalidateAll_DuringQuery_StaleResultsNotCached(self, mocker) :
+		# arrange
+		blocking = self.create_blocking(mocker)
+		query = blocking.query
+
+		def invalidating_query(sql, params, **kwargs) :
+			blocking.invalidate_all()
+			blocking.query = query
+			return query(sql, params, **kwargs)
+
+		blocking.query = invalidating_query
+
+		# act
+		blocking.user_blocklists([1, 2])
+		blocking.user_blocklists([1, 2])
+
+		# assert
+		assert [[1, 2], [1, 2], [1, 2], [1, 2]] == list(map(sorted, query.calls))
+
+
+	def test_Invalidate_ManyInvalidations_OldestForgottenConservatively(self, mocker) :
+		# arrange
+		blocking = self.create_blocking(mocker)
+		blocking._max_invalidations = 2
+		query = blocking.query
+
+		def invalidating_query(sql, params, **kwargs) :
+			# user 1's invalidation is forgotten once the newer invalidations push it out
+			for user_id in (1, 5, 6) :
+				blocking.invalidate(user_id)
+
+			blocking.query = query
+			return query(sql, params, **kwargs)
+
+		blocking.query = invalidating_query
+
+		# act
+		blocking.user_blocklists([1])
+		blocking.user_blocklists([1])
+
+		# assert
+		assert [[1], [1], [1], [1]] == list(map(sorted, query.calls))
+
+
+	def test_UserBlockedTags_Invalidated_QueriedAgain(self, mocker) :
+		# arrange
+		blocking = self.create_blocking(mocker)
+		assert { 'a', 'b' } == blocking.user_blocked_tags(1)
+		assert { 'user' } == blocking.user_blocked_users(1)
+		blocking.query.tags = [(1, 'c', 2)]
+
+		# act
+		blocking.invalidate(1)
+		result = blocking.user_blocked_tags(1)
+
+		# assert
+		assert { 'c' } == result
+		assert 4 == len(blocking.query.calls)
@@ -1,14 +1,17 @@
 import json
-from asyncio import AbstractEventLoop, ensure_future, sleep
-from typing import Callable, Dict, Type
+from asyncio import AbstractEventLoop, TimeoutError, ensure_future, gather, sleep
+from time import monotonic
+from typing import Callable, Dict, List, Type
 
 import pytest
-from aiohttp import ClientResponse, ClientResponseError
+from aiohttp import ClientResponse, ClientResponseError, ContentTypeError
 from aiohttp.test_utils import TestServer
-from aiohttp.web import Application, Request, Response, RouteDef
-from pydantic import BaseModel
+from aiohttp.web import Application, Request, Response, RouteDef, StreamResponse
+from pydantic import BaseModel, ValidationError, parse_obj_as
 
-from kh_common.gateway import Gateway
+from kh_common.exceptions.http_error import ServiceUnavailable
+from kh_common.gateway import CircuitBreaker, ConcurrencyLimiter, DeadlineHeader, Gateway, LatencyTracker, ResponseCache, close_sessions, deadline, session, validator
+from kh_common.tracing import current_span, end_trace, start_trace
 
 
 from kh_common.logging import LogHandler; LogHandler.logging_available = False
@@ -316,3 +319,805 @@ class TestGateway :
 			# assert
 			assert result.success == True
 			assert self.attempts == 1
+
+
+	async def test_Gateway_MultipleCalls_ConnectionIsReused(self) :
+		peers = []
+
+		async def handler(request: Request) :
+			peers.append(request.transport.get_extra_info('peername'))
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel)
+			other: Gateway = Gateway(str(url), ResponseModel)
+
+			# act
+			await gateway()
+			await gateway()
+			await other()
+
+			# assert
+			assert len(peers) == 3
+			assert len(set(peers)) == 1
+			await close_sessions()
+
+
+	async def test_Gateway_SessionsClosed_NewSessionCreated(self) :
+		async with await create_test_server() as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel)
+			await gateway()
+			first = session()
+
+			# act
+			await close_sessions()
+			result: ResponseModel = await gateway()
+
+			# assert
+			assert first.closed
+			assert session() is not first
+			assert result.success == True
+			await close_sessions()
+
+
+	async def test_Gateway_ResponseSetsCookie_NotSentWithLaterRequests(self) :
+		self.cookies = []
+
+		async def handler(request: Request) :
+			self.cookies.append(request.headers.get('cookie'))
+			response = Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json')
+			response.set_cookie('kh-auth', 'token')
+			return response
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			# aiohttp's cookie jar ignores cookies from ip hosts, so a hostname is needed to reproduce
+			url = server.make_url('/').with_host('localhost')
+			gateway: Gateway = Gateway(str(url), ResponseModel)
+
+			# act
+			await gateway()
+			await gateway()
+
+			# assert
+			assert self.cookies == [None, None]
+			await close_sessions()
+
+
+	async def test_Gateway_CircuitOpen_RequestShedWithoutReachingServer(self) :
+		self.attempts = 0
+
+		async def handler(request: Request) :
+			self.attempts += 1
+			return Response(body=json.dumps({ 'success': False }).encode(), status=500, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), status_to_retry=[], circuit_breaker=CircuitBreaker('test', minimum_requests=2, cooldown=60))
+
+			for _ in range(2) :
+				with pytest.raises(ClientResponseError) :
+					await gateway()
+
+			# act & assert
+			with pytest.raises(ServiceUnavailable) :
+				await gateway()
+
+			assert self.attempts == 2
+			assert gateway.circuit_breaker.state == CircuitBreaker.Open
+			await close_sessions()
+
+
+	async def test_Gateway_ClientErrors_CircuitStaysClosed(self) :
+		async def handler(request: Request) :
+			return Response(body=json.dumps({ 'success': False }).encode(), status=404, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), circuit_breaker=CircuitBreaker('test', minimum_requests=2), concurrency_limiter=True)
+
+			# act
+			for _ in range(3) :
+				with pytest.raises(ClientResponseError) :
+					await gateway()
+
+			# assert
+			assert gateway.circuit_breaker.state == CircuitBreaker.Closed
+			assert gateway.concurrency_limiter.in_flight == 0
+			await close_sessions()
+
+
+	async def test_Gateway_AtConcurrencyLimit_RequestShed(self) :
+		async def handler(request: Request) :
+			await sleep(0.2)
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, concurrency_limiter=ConcurrencyLimiter('test', initial_limit=1))
+			first = ensure_future(gateway())
+			await sleep(0.05)
+
+			# act & assert
+			with pytest.raises(ServiceUnavailable) :
+				await gateway()
+
+			assert (await first).success == True
+			assert gateway.concurrency_limiter.in_flight == 0
+			await close_sessions()
+
+
+	async def test_Gateway_CachedGet_SecondCallServedFromCache(self) :
+		self.attempts = 0
+
+		async def handler(request: Request) :
+			self.attempts += 1
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json', headers={ 'cache-control': 'max-age=60' })
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, cache=True)
+
+			# act
+			first: ResponseModel = await gateway(params={ 'a': 1 })
+			second: ResponseModel = await gateway(params={ 'a': 1 })
+			third: ResponseModel = await gateway(params={ 'a': 2 })
+
+			# assert
+			assert first.success and second.success and third.success
+			assert first is not second
+			assert self.attempts == 2
+			await close_sessions()
+
+
+	async def test_Gateway_CachedGetNoStore_ResponseNotCached(self) :
+		self.attempts = 0
+
+		async def handler(request: Request) :
+			self.attempts += 1
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json', headers={ 'cache-control': 'no-store' })
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, cache=True)
+
+			# act
+			await gateway()
+			await gateway()
+
+			# assert
+			assert self.attempts == 2
+			await close_sessions()
+
+
+	async def test_Gateway_CachedGetWithEtag_RevalidatedWithIfNoneMatch(self) :
+		self.attempts = 0
+		conditional = []
+
+		async def handler(request: Request) :
+			self.attempts += 1
+			conditional.append(request.headers.get('if-none-match'))
+
+			if request.headers.get('if-none-match') == '"v1"' :
+				return Response(status=304, headers={ 'etag': '"v1"', 'cache-control': 'no-cache' })
+
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json', headers={ 'etag': '"v1"', 'cache-control': 'no-cache' })
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, cache=True)
+
+			# act
+			first: ResponseModel = await gateway()
+			second: ResponseModel = await gateway()
+
+			# assert
+			assert first.success and second.success
+			assert conditional == [None, '"v1"']
+			await close_sessions()
+
+
+	async def test_Gateway_CachedGetConcurrentCalls_RequestsCoalesced(self) :
+		self.attempts = 0
+
+		async def handler(request: Request) :
+			self.attempts += 1
+			await sleep(0.1)
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json', headers={ 'cache-control': 'no-store' })
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, cache=True)
+
+			# act
+			results = await gather(*(gateway() for _ in range(5)))
+
+			# assert
+			assert all(r.success for r in results)
+			assert self.attempts == 1
+			assert gateway._in_flight == { }
+			await close_sessions()
+
+
+	async def test_Gateway_CachedGetDifferentAuth_CachedSeparately(self) :
+		self.attempts = 0
+
+		async with await create_test_server() as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, cache=True)
+
+			# act
+			await gateway(auth='a')
+			await gateway(auth='b')
+			await gateway(auth='a')
+
+			# assert
+			assert len(gateway.cache._entries) == 2
+			await close_sessions()
+
+
+	async def test_Gateway_CachedGetDifferentCookies_CachedSeparately(self) :
+		self.cookies = []
+
+		async def handler(request: Request) :
+			self.cookies.append(request.headers.get('cookie'))
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, cache=True)
+
+			# act
+			await gateway(headers={ 'cookie': 'kh-auth=a' })
+			await gateway(headers={ 'cookie': 'kh-auth=b' })
+			await gateway(headers={ 'cookie': 'kh-auth=a' })
+
+			# assert
+			assert self.cookies == ['kh-auth=a', 'kh-auth=b']
+			await close_sessions()
+
+
+	async def test_Gateway_CoalescedGet_SentWithoutCallersDeadline(self) :
+		self.deadlines = []
+
+		async def handler(request: Request) :
+			self.deadlines.append(request.headers.get(DeadlineHeader))
+			await sleep(0.2)
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json', headers={ 'cache-control': 'no-store' })
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, cache=True)
+
+			async def hurried() :
+				with deadline(0.05) :
+					return await gateway()
+
+			# act
+			results = await gather(hurried(), gateway(), return_exceptions=True)
+
+			# assert
+			assert isinstance(results[0], TimeoutError)
+			assert results[1].success
+			assert self.deadlines == [None]
+			await close_sessions()
+
+
+	async def test_Gateway_ListModel_EachItemValidated(self) :
+		async def handler(request: Request) :
+			return Response(body=json.dumps([{ 'success': True }, { 'success': False }]).encode(), status=200, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), List[ResponseModel])
+
+			# act
+			result: List[ResponseModel] = await gateway()
+
+			# assert
+			assert result == [ResponseModel(success=True), ResponseModel(success=False)]
+			await close_sessions()
+
+
+	async def test_Gateway_NonJsonResponse_RaisesContentTypeError(self) :
+		async def handler(request: Request) :
+			return Response(body=b'<html></html>', status=200, content_type='text/html')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel)
+
+			# act & assert
+			with pytest.raises(ContentTypeError) :
+				await gateway()
+
+			await close_sessions()
+
+
+	async def test_Gateway_StreamListModel_ItemsYieldedAsReceived(self) :
+		async def handler(request: Request) :
+			response = StreamResponse(status=200, headers={ 'content-type': 'application/json' })
+			await response.prepare(request)
+			await response.write(b'[{"success": true}, {"succ')
+			await sleep(0.05)
+			await response.write(b'ess": false}]')
+			await response.write_eof()
+			return response
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), List[ResponseModel], concurrency_limiter=True)
+			result = []
+
+			# act
+			async for item in gateway.stream() :
+				result.append(item)
+
+			# assert
+			assert result == [ResponseModel(success=True), ResponseModel(success=False)]
+			assert gateway.concurrency_limiter.in_flight == 0
+			await close_sessions()
+
+
+	async def test_Gateway_StreamClosedEarlyUnderTrace_SpanNotCurrentAndTicketReleased(self) :
+		self.traceparents = []
+
+		async def handler(request: Request) :
+			self.traceparents.append(request.headers.get('traceparent'))
+			response = StreamResponse(status=200, headers={ 'content-type': 'application/json' })
+			await response.prepare(request)
+			await response.write(b'[{"success": true}, {"success": false}, ')
+			await sleep(0.05)
+			await response.write(b'{"success": true}]')
+			await response.write_eof()
+			return response
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), List[ResponseModel], concurrency_limiter=True)
+			root, token = start_trace('test')
+			current = []
+
+			# act
+			items = gateway.stream()
+
+			try :
+				async for item in items :
+					current.append(current_span())
+					break
+
+			finally :
+				await items.aclose()
+
+			end_trace(root, token)
+
+			# assert
+			assert current == [root]
+			assert current_span() is None
+			assert gateway.concurrency_limiter.in_flight == 0
+			assert [child.name for child in root.children] == ['gateway']
+			assert root.children[0].duration is not None
+			assert self.traceparents == [root.children[0].traceparent()]
+			await close_sessions()
+
+
+	async def test_Gateway_HedgedSlowResponse_HedgeResponseUsed(self) :
+		self.attempts = 0
+
+		async def handler(request: Request) :
+			self.attempts += 1
+
+			if self.attempts == 1 :
+				await sleep(2)
+
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, hedge=True, concurrency_limiter=True)
+
+			for _ in range(20) :
+				gateway.latency.observe(0.01)
+
+			start = monotonic()
+
+			# act
+			result: ResponseModel = await gateway()
+
+			# assert
+			assert result.success == True
+			assert monotonic() - start < 1
+			assert self.attempts == 2
+
+			# the losing request is cancelled, but not awaited
+			await sleep(0.01)
+			assert gateway.concurrency_limiter.in_flight == 0
+			await close_sessions()
+
+
+	async def test_Gateway_HedgedFastResponse_NoHedgeSent(self) :
+		self.attempts = 0
+
+		async def handler(request: Request) :
+			self.attempts += 1
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, hedge=True)
+
+			for _ in range(20) :
+				gateway.latency.observe(1)
+
+			# act
+			await gateway()
+
+			# assert
+			assert self.attempts == 1
+			await close_sessions()
+
+
+	def test_Gateway_HedgeNonIdempotentMethod_HedgingDisabled(self) :
+		# act
+		gateway: Gateway = Gateway('http://localhost/', method='POST', hedge=True)
+
+		# assert
+		assert gateway.latency is None
+
+
+	async def test_Gateway_Deadline_RemainingTimeSentToUpstream(self) :
+		received = []
+
+		async def handler(request: Request) :
+			received.append(float(request.headers['x-request-deadline']))
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel, deadline=10)
+
+			# act
+			await gateway()
+
+			with deadline(2) :
+				await gateway()
+
+			# assert
+			assert 9 < received[0] <= 10
+			assert 1 < received[1] <= 2
+			await close_sessions()
+
+
+	async def test_Gateway_DeadlineShorterThanBackoff_RetriesStopped(self) :
+		self.attempts = 0
+
+		async def handler(request: Request) :
+			self.attempts += 1
+			return Response(body=json.dumps({ 'success': False }).encode(), status=429, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), attempts=5, backoff=lambda x : 0.2, deadline=0.3)
+
+			# act & assert
+			with pytest.raises(ClientResponseError) :
+				await gateway()
+
+			assert self.attempts == 2
+			await close_sessions()
+
+
+	async def test_Gateway_DeadlineExceeded_TimeoutError(self) :
+		async def handler(request: Request) :
+			await sleep(1)
+			return Response(body=json.dumps({ 'success': True }).encode(), status=200, content_type='application/json')
+
+		async with await create_test_server(handler) as server :
+			# arrange
+			url = server.make_url('/')
+			gateway: Gateway = Gateway(str(url), ResponseModel)
+
+			# act & assert
+			with pytest.raises(TimeoutError) :
+				with deadline(0.1) :
+					await gateway()
+
+			await close_sessions()
+
+
+class TestLatencyTracker :
+
+	def test_LatencyTracker_TooFewSamples_NoEstimate(self) :
+		# arrange
+		tracker: LatencyTracker = LatencyTracker(minimum_samples=5)
+
+		# act
+		for i in range(4) :
+			tracker.observe(i)
+
+		# assert
+		assert tracker.quantile(0.95) is None
+
+
+	def test_LatencyTracker_Samples_QuantileEstimated(self) :
+		# arrange
+		tracker: LatencyTracker = LatencyTracker(size=100, minimum_samples=1, resort=1)
+
+		# act
+		for i in range(200) :
+			tracker.observe(i)
+
+		# assert
+		assert tracker.quantile(0.95) == 195
+		assert tracker.quantile(0) == 100
+
+
+class TestValidator :
+
+	@pytest.mark.parametrize(
+		"model, data",
+		[(ResponseModel, { 'success': True }), (List[ResponseModel], [{ 'success': 1 }]), (Dict[str, int], { 'a': '1' }), (int, '5')],
+	)
+	def test_Validator_ValidData_MatchesParseObjAs(self, model: Type, data) :
+		# arrange
+		validate = validator(model)
+
+		# act
+		result = validate(data)
+
+		# assert
+		assert result == parse_obj_as(model, data)
+
+
+	def test_Validator_InvalidData_RaisesValidationError(self) :
+		# arrange
+		validate = validator(List[ResponseModel])
+
+		# act & assert
+		with pytest.raises(ValidationError) as e :
+			validate([{ 'success': 'not a bool' }])
+
+		assert e.value.errors()[0]['loc'] == ('__root__', 0, 'success')
+
+
+class TestResponseCache :
+
+	@pytest.mark.parametrize(
+		"cache_control, expected",
+		[(None, 60), ('max-age=10', 10), ('public, max-age=600', 60), ('no-cache', 0), ('no-store', None), ('max-age=abc', 60)],
+	)
+	def test_ResponseCache_CacheControl_MaxAgeBoundedByTtl(self, cache_control: str, expected: float) :
+		# arrange
+		cache: ResponseCache = ResponseCache(ttl=60)
+
+		# act
+		max_age = cache.max_age(cache_control)
+
+		# assert
+		assert max_age == expected
+
+
+	def test_ResponseCache_Full_OldestEvicted(self) :
+		# arrange
+		cache: ResponseCache = ResponseCache(max_size=2)
+
+		# act
+		cache.put(1, 60, None, 'a')
+		cache.put(2, 60, None, 'b')
+		cache.put(3, 60, None, 'c')
+
+		# assert
+		assert cache.get(1) is None
+		assert cache.get(3)[2] == 'c'
+
+
+	def test_ResponseCache_ExpiredWithoutEtag_Dropped(self) :
+		# arrange
+		cache: ResponseCache = ResponseCache()
+		cache.put(1, 0, '"etag"', 'a')
+		cache.put(2, -1, None, 'b')
+
+		# act
+		stale = cache.get(1)
+		dropped = cache.get(2)
+
+		# assert
+		assert stale[1] == '"etag"'
+		assert dropped is None
+
+
+class TestCircuitBreaker :
+
+	def test_CircuitBreaker_FailureRateExceeded_CircuitOpens(self) :
+		# arrange
+		breaker: CircuitBreaker = CircuitBreaker('test', failure_rate=0.5, minimum_requests=4)
+
+		# act
+		for healthy in [True, False, True, False] :
+			ticket = breaker.allow()
+			assert ticket is not None
+			breaker.record(ticket, healthy)
+
+		# assert
+		assert breaker.state == CircuitBreaker.Open
+		assert breaker.allow() is None
+
+
+	def test_CircuitBreaker_BelowMinimumRequests_CircuitStaysClosed(self) :
+		# arrange
+		breaker: CircuitBreaker = CircuitBreaker('test', minimum_requests=4)
+
+		# act
+		for _ in range(3) :
+			breaker.record(breaker.allow(), False)
+
+		# assert
+		assert breaker.state == CircuitBreaker.Closed
+		assert breaker.counts() == [3, 3]
+
+
+	def test_CircuitBreaker_CooldownPassed_SingleProbeAllowed(self) :
+		# arrange
+		breaker: CircuitBreaker = CircuitBreaker('test', minimum_requests=1, cooldown=0)
+		breaker.record(breaker.allow(), False)
+
+		# act
+		first = breaker.allow()
+		second = breaker.allow()
+
+		# assert
+		assert first is not None
+		assert second is None
+		assert breaker.state == CircuitBreaker.HalfOpen
+
+
+	@pytest.mark.parametrize(
+		"healthy, state",
+		[(True, CircuitBreaker.Closed), (False, CircuitBreaker.Open), (None, CircuitBreaker.HalfOpen)],
+	)
+	def test_CircuitBreaker_ProbeCompletes_StateTransitions(self, healthy: bool, state: int) :
+		# arrange
+		breaker: CircuitBreaker = CircuitBreaker('test', minimum_requests=1, cooldown=0)
+		breaker.record(breaker.allow(), False)
+		probe = breaker.allow()
+
+		# act
+		breaker.record(probe, healthy)
+
+		# assert
+		assert breaker.state == state
+
+
+	def test_CircuitBreaker_RequestSentBeforeOpen_OutcomeIgnored(self) :
+		# arrange
+		breaker: CircuitBreaker = CircuitBreaker('test', minimum_requests=1, cooldown=0)
+		slow = breaker.allow()
+		breaker.record(breaker.allow(), False)
+		probe = breaker.allow()
+
+		# act
+		breaker.record(slow, True)
+
+		# assert
+		assert breaker.state == CircuitBreaker.HalfOpen
+		assert breaker.allow() is None
+		breaker.record(probe, True)
+		assert breaker.state == CircuitBreaker.Closed
+
+
+	def test_CircuitBreaker_ProbeCompletesAfterClose_OutcomeIgnored(self) :
+		# arrange
+		breaker: CircuitBreaker = CircuitBreaker('test', minimum_requests=1, cooldown=0, probes=2)
+		breaker.record(breaker.allow(), False)
+		first = breaker.allow()
+		second = breaker.allow()
+		breaker.record(first, True)
+
+		# act
+		breaker.record(second, False)
+
+		# assert
+		assert breaker.state == CircuitBreaker.Closed
+		assert breaker.counts() == [0, 0]
+
+
+class TestConcurrencyLimiter :
+
+	def test_ConcurrencyLimiter_AtLimit_AcquireFails(self) :
+		# arrange
+		limiter: ConcurrencyLimiter = ConcurrencyLimiter('test', initial_limit=2)
+
+		# act
+		results = [limiter.acquire() is not None for _ in range(3)]
+
+		# assert
+		assert results == [True, True, False]
+		assert limiter.in_flight == 2
+
+
+	def test_ConcurrencyLimiter_Failure_LimitDecreasesMultiplicatively(self) :
+		# arrange
+		limiter: ConcurrencyLimiter = ConcurrencyLimiter('test', initial_limit=10, backoff=0.5)
+		ticket = limiter.acquire()
+
+		# act
+		limiter.release(ticket, False)
+
+		# assert
+		assert limiter.limit == 5
+		assert limiter.in_flight == 0
+
+
+	def test_ConcurrencyLimiter_SuccessAtCapacity_LimitIncreasesAdditively(self) :
+		# arrange
+		limiter: ConcurrencyLimiter = ConcurrencyLimiter('test', initial_limit=2)
+		ticket = limiter.acquire()
+		limiter.acquire()
+
+		# act
+		limiter.release(ticket, True)
+
+		# assert
+		assert limiter.limit == 2.5
+
+
+	def test_ConcurrencyLimiter_SuccessUnderused_LimitUnchanged(self) :
+		# arrange
+		limiter: ConcurrencyLimiter = ConcurrencyLimiter('test', initial_limit=10)
+		ticket = limiter.acquire()
+
+		# act
+		limiter.release(ticket, True)
+
+		# assert
+		assert limiter.limit == 10
+
+
+	def test_ConcurrencyLimiter_RepeatedFailures_LimitNeverBelowMinimum(self) :
+		# arrange
+		limiter: ConcurrencyLimiter = ConcurrencyLimiter('test', initial_limit=2, min_limit=1)
+
+		# act
+		for _ in range(10) :
+			limiter.release(limiter.acquire(), False)
+
+		# assert
+		assert limiter.limit == 1
+
+
+	def test_ConcurrencyLimiter_FailuresInFlightTogether_LimitDecreasedOnce(self) :
+		# arrange
+		limiter: ConcurrencyLimiter = ConcurrencyLimiter('test', initial_limit=64, backoff=0.5)
+		tickets = [limiter.acquire() for _ in range(64)]
+
+		# act
+		for ticket in tickets :
+			limiter.release(ticket, False)
+
+		# assert
+		assert limiter.limit == 32
+		assert limiter.in_flight == 0
+		limiter.release(limiter.acquire(), False)
+		assert limiter.limit == 16
@@ -0,0 +1,281 @@
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+import logging
+import time
+from typing import Any, List, Tuple
+
+from kh_common import logging as kh_logging
+from kh_common.logging import DedupFilter, LogHandler, QueueLogHandler, RateLimitFilter, SampleFilter
+
+
+class MockBatch :
+
+	def __init__(self, agent: 'MockAgent') -> None :
+		self.agent = agent
+		self.entries: List[Tuple[str, Any, str]] = []
+
+	def log_text(self, log, severity='INFO') :
+		self.entries.append(('text', log, severity))
+
+	def log_struct(self, log, severity='INFO') :
+		self.entries.append(('struct', log, severity))
+
+	def __enter__(self) :
+		return self
+
+	def __exit__(self, *args) :
+		self.agent.batches.append(self.entries)
+
+
+class MockAgent :
+
+	def __init__(self) -> None :
+		self.batches: List[List[Tuple[str, Any, str]]] = []
+
+	def batch(self) :
+		return MockBatch(self)
+
+
+def create_record(msg: Any, *args: Any, lineno: int = 1) -> logging.LogRecord :
+	return logging.LogRecord('test', logging.INFO, __file__, lineno, msg, args, None)
+
+
+class TestQueueLogHandler :
+
+	def test_QueueLogHandler_ManyRecords_ShippedInBatches(self) :
+		# arrange
+		handler = QueueLogHandler('test', batch_size=2, flush_interval=60)
+		handler.agent = agent = MockAgent()
+
+		# act
+		for i in range(5) :
+			handler.emit(create_record('message %s', i))
+		handler.close()
+
+		# assert
+		assert [2, 2, 1] == list(map(len, agent.batches))
+		assert ('text', 'message 4', 'INFO') == agent.batches[-1][0]
+		assert 5 == handler.sent
+		assert 0 == handler.dropped
+
+
+	def test_QueueLogHandler_Flush_RecordsShipped(self) :
+		# arrange
+		handler = QueueLogHandler('test', flush_interval=0.01)
+		handler.agent = agent = MockAgent()
+
+		# act
+		handler.emit(create_record({ 'a': 1 }))
+		handler.flush()
+
+		# assert
+		assert [[('struct', { 'a': 1 }, 'INFO')]] == agent.batches
+		handler.close()
+
+
+	def test_QueueLogHandler_BufferFull_NewestDropped(self) :
+		# arrange
+		handler = QueueLogHandler('test', buffer_size=1)
+		handler.agent = MockAgent()
+		handler.close()
+		handler._closed = False
+
+		# act
+		handler.emit(create_record('a'))
+		handler.emit(create_record('b'))
+
+		# assert
+		assert 1 == handler.dropped
+		assert 'a' == handler._queue.get_nowait().msg
+
+
+	def test_QueueLogHandler_BufferFullDropOldest_OldestDropped(self) :
+		# arrange
+		handler = QueueLogHandler('test', buffer_size=1, drop_oldest=True)
+		handler.agent = MockAgent()
+		handler.close()
+		handler._closed = False
+
+		# act
+		handler.emit(create_record('a'))
+		handler.emit(create_record('b'))
+
+		# assert
+		assert 1 == handler.dropped
+		assert 'b' == handler._queue.get_nowait().msg
+
+
+class TestFilters :
+
+	def setup_method(self) :
+		kh_logging.fake_time_store = 0
+		kh_logging.time = lambda : kh_logging.fake_time_store
+
+
+	def teardown_method(self) :
+		kh_logging.time = time.time
+
+
+	def test_SampleFilter_RateZero_AllDropped(self) :
+		# arrange
+		sample = SampleFilter(0, { 'other': 1, f'{__file__}:2': 1 })
+
+		# assert
+		assert not sample.filter(create_record('a'))
+		assert sample.filter(create_record('a', lineno=2))
+
+
+	def test_RateLimitFilter_BurstExceeded_RecordsDropped(self) :
+		# arrange
+		limiter = RateLimitFilter(1, burst=2)
+
+		# act
+		result = [limiter.filter(create_record('a')) for _ in range(3)]
+		other_site = limiter.filter(create_record('a', lineno=2))
+		kh_logging.fake_time_store = 1
+		refilled = limiter.filter(create_record('a'))
+
+		# assert
+		assert [True, True, False] == result
+		assert other_site
+		assert refilled
+		assert 1 == limiter.dropped
+
+
+	def test_DedupFilter_RepeatedRecords_CollapsedWithCount(self) :
+		# arrange
+		dedup = DedupFilter(10)
+		handler = LogHandler('test')
+
+		# act
+		result = [dedup.filter(create_record('a')) for _ in range(4)]
+		kh_logging.fake_time_store = 11
+		record = create_record('a')
+		passed = dedup.filter(record)
+
+		# assert
+		assert [True, False, False, False] == result
+		assert passed
+		assert ('log_text', 'a (repeated 3 times)', 'INFO') == handler.prepare(record)
+
+
+	def test_DedupFilter_DifferentMessagesFromSameSite_NotCollapsed(self) :
+		# arrange
+		dedup = DedupFilter(10)
+
+		# act
+		result = [dedup.filter(create_record(msg)) for msg in ['a', 'b', 'a %s', 'a %s']]
+
+		# assert
+		assert [True, True, True, False] == result
+
+
+	def test_DedupFilter_DifferentExceptionMessages_NotCollapsed(self) :
+		# arrange
+		dedup = DedupFilter(10)
+
+		def create_error(message: str) :
+			record = create_record('failed')
+			record.exc_info = (ValueError, ValueError(message), None)
+			return record
+
+		# act
+		result = [dedup.filter(create_error(msg)) for msg in ['a', 'b', 'b']]
+
+		# assert
+		assert [True, True, False] == result
+
+
+	def test_DedupFilter_BurstStops_ReportedOnNextRecord(self) :
+		# arrange
+		handler = LogHandler('test')
+		handler.addFilter(DedupFilter(10))
+		handler.agent = agent = MockBatch(MockAgent())
+
+		for _ in range(3) :
+			handler.handle(create_record('a'))
+
+		# act
+		kh_logging.fake_time_store = 11
+		handler.handle(create_record('b'))
+
+		# assert
+		assert [('text', 'a', 'INFO'), ('text', 'b', 'INFO'), ('text', 'a (repeated 2 times)', 'INFO')] == agent.entries
+
+
+	def test_DedupFilter_BurstWithinWindow_ReportedOnClose(self) :
+		# arrange
+		handler = QueueLogHandler('test', flush_interval=60)
+		handler.addFilter(DedupFilter(10))
+		handler.agent = agent = MockAgent()
+
+		for _ in range(3) :
+			handler.handle(create_record('a'))
+
+		# act
+		handler.close()
+
+		# assert
+		assert [('text', 'a', 'INFO'), ('text', 'a (repeated 2 times)', 'INFO')] == [entry for batch in agent.batches for entry in batch]
+
+
+class TestLazyLogging :
+
+	def test_Prepare_DeferredMessage_Materialized(self) :
+		# arrange
+		handler = LogHandler('test')
+
+		# act
+		result = handler.prepare(create_record(lambda : { 'a': 1 }))
+
+		# assert
+		assert ('log_struct', { 'a': 1 }, 'INFO') == result
+
+
+	def test_Handle_DeferredMessageFiltered_NeverCalled(self) :
+		# arrange
+		handler = LogHandler('test')
+		handler.addFilter(SampleFilter(0))
+		calls = []
+
+		# act
+		handler.handle(create_record(lambda : calls.append(1)))
+
+		# assert
+		assert [] == calls
+
+
+	def test_GetLogger_LevelDisabled_ShortCircuits(self) :
+		# act
+		logger = kh_logging.getLogger('test', level=logging.WARNING)
+
+		# assert
+		assert not logger.isEnabledFor(logging.INFO)
+		assert logger.isEnabledFor(logging.ERROR)
+		kh_logging.configure()
+
+
+	def test_GetLogger_NoConfiguration_ConfiguredHandlerKept(self) :
+		# arrange
+		kh_logging.getLogger('svc', background=True, rate_limit=1, dedup_window=10)
+		handler = logging.root.handlers[0]
+
+		# act
+		kh_logging.getLogger()
+
+		# assert
+		assert [handler] == logging.root.handlers
+		assert isinstance(handler, QueueLogHandler)
+		assert { RateLimitFilter, DedupFilter } <= set(map(type, handler.filters))
+		kh_logging.configure()
+
+
+	def test_GetLogger_Unconfigured_ConfiguresRoot(self) :
+		# arrange
+		logging.root.handlers.clear()
+
+		# act
+		kh_logging.getLogger()
+
+		# assert
+		assert 1 == len(logging.root.handlers)
+		assert type(logging.root.handlers[0]) is LogHandler
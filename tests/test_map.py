@@ -0,0 +1,87 @@
+from kh_common.config import credentials; credentials.db = { }
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+from asyncio import gather
+
+import pytest
+
+from kh_common.map import BatchMap
+
+
+class MockQuery :
+
+	def __init__(self, data) :
+		self.data = data
+		self.calls = []
+
+
+	async def __call__(self, sql, params, **kwargs) :
+		self.calls.append(params[0])
+		return [(k, self.data[k]) for k in params[0] if k in self.data]
+
+
+@pytest.mark.asyncio
+class TestBatchMap :
+
+	def create_map(self, mocker, data, **kwargs) -> BatchMap :
+		mocker.patch('kh_common.sql.SqlInterface._sql_connect')
+		batch_map = BatchMap('users', 'user_id', 'handle', **kwargs)
+		batch_map.query_async = MockQuery(data)
+		return batch_map
+
+
+	async def test_BatchMap_GetSameTick_SingleQuery(self, mocker) :
+		# arrange
+		batch_map = self.create_map(mocker, { 1: 'a', 2: 'b', 3: 'c' })
+
+		# act
+		result = await gather(batch_map.get(1), batch_map.get(2), batch_map.get(3), batch_map.get(1))
+
+		# assert
+		assert ['a', 'b', 'c', 'a'] == result
+		assert [[1, 2, 3]] == batch_map.query_async.calls
+
+
+	async def test_BatchMap_GetMany_MissingKeysReturnNone(self, mocker) :
+		# arrange
+		batch_map = self.create_map(mocker, { 1: 'a', 2: 'b' })
+
+		# act
+		result = await batch_map.get_many([1, 2, 3])
+
+		# assert
+		assert { 1: 'a', 2: 'b', 3: None } == result
+		assert 1 == len(batch_map.query_async.calls)
+
+
+	async def test_BatchMap_GetMissingKey_RaisesKeyError(self, mocker) :
+		# arrange
+		batch_map = self.create_map(mocker, { })
+
+		# act & assert
+		with pytest.raises(KeyError) :
+			await batch_map.get(1)
+
+
+	async def test_BatchMap_CachePopulated_QueryNotCalled(self, mocker) :
+		# arrange
+		batch_map = self.create_map(mocker, { 1: 'a', 2: 'b' })
+		await batch_map.get_many([1, 2])
+
+		# act
+		result = await batch_map.get_many([1, 2])
+
+		# assert
+		assert { 1: 'a', 2: 'b' } == result
+		assert [[1, 2]] == batch_map.query_async.calls
+
+
+	async def test_BatchMap_MaxSizeExceeded_OldestEvicted(self, mocker) :
+		# arrange
+		batch_map = self.create_map(mocker, { 1: 'a', 2: 'b', 3: 'c' }, max_size=2)
+
+		# act
+		await batch_map.get_many([1, 2, 3])
+		await batch_map.get(1)
+
+		# assert
+		assert [[1, 2, 3], [1]] == batch_map.query_async.calls
@@ -0,0 +1,162 @@
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.testclient import TestClient
+
+from kh_common.caching import ArgsCache
+from kh_common.metrics import LockedHistogramValue, Registry, aerospike_latency, cache_requests, request_latency, sql_latency
+from kh_common.server import ServerApp
+
+
+base_url = 'https://dev.fuzz.ly'
+
+
+class TestMetrics :
+
+	def test_Counter_Labels_RenderedWithLabels(self) :
+		# arrange
+		registry = Registry()
+		counter = registry.counter('test_total', 'test counter.', ('route', 'status'))
+
+		# act
+		counter.labels('/a"b', '200').inc()
+		counter.labels('/a"b', '200').inc(2)
+
+		# assert
+		assert registry.render() == '# HELP test_total test counter.\n# TYPE test_total counter\ntest_total{route="/a\\"b",status="200"} 3\n'
+
+
+	def test_Gauge_IncDec_ValueTracked(self) :
+		# arrange
+		registry = Registry()
+		gauge = registry.gauge('test_gauge', 'test gauge.')
+
+		# act
+		gauge.inc()
+		gauge.inc()
+		gauge.dec()
+
+		# assert
+		assert 'test_gauge 1\n' in registry.render()
+
+
+	def test_Histogram_Observe_CumulativeBuckets(self) :
+		# arrange
+		registry = Registry()
+		histogram = registry.histogram('test_seconds', 'test histogram.', buckets=(0.1, 1))
+
+		# act
+		histogram.observe(0.05)
+		histogram.observe(0.1)
+		histogram.observe(0.5)
+		histogram.observe(5)
+
+		# assert
+		lines = registry.render().splitlines()
+		assert 'test_seconds_bucket{le="0.1"} 2' in lines
+		assert 'test_seconds_bucket{le="1"} 3' in lines
+		assert 'test_seconds_bucket{le="+Inf"} 4' in lines
+		assert 'test_seconds_sum 5.65' in lines
+		assert 'test_seconds_count 4' in lines
+
+
+	def test_Histogram_Threadsafe_NoUpdatesLostAcrossThreads(self) :
+		# arrange
+		registry = Registry()
+		histogram = registry.histogram('test_seconds', 'test histogram.', threadsafe=True)
+
+		def observe(_) :
+			for _ in range(10000) :
+				histogram.observe(0.01)
+
+		# act
+		with ThreadPoolExecutor(8) as executor :
+			list(executor.map(observe, range(8)))
+
+		# assert
+		assert 80000 == histogram.labels().count
+		assert 80000 == sum(histogram.labels().counts)
+
+
+	def test_ExecutorMetrics_Threadsafe(self) :
+		# assert
+		assert isinstance(sql_latency.labels(), LockedHistogramValue)
+		assert isinstance(aerospike_latency.labels('get'), LockedHistogramValue)
+
+
+	def test_Registry_DuplicateName_ExistingMetricReturned(self) :
+		# arrange
+		registry = Registry()
+		counter = registry.counter('test_total', 'test counter.')
+
+		# act
+		result = registry.counter('test_total', 'test counter.')
+
+		# assert
+		assert result is counter
+
+
+	def test_ArgsCache_HitsAndMisses_Counted(self) :
+		# arrange
+		@ArgsCache(10)
+		def metrics_cached(a) :
+			return a
+
+		# act
+		metrics_cached(1)
+		metrics_cached(1)
+		metrics_cached(2)
+
+		# assert
+		name = metrics_cached.__qualname__
+		assert 1 == cache_requests.labels(name, 'hit').value
+		assert 2 == cache_requests.labels(name, 'miss').value
+
+
+	def test_ServerApp_Metrics_LatencyRecordedAndServed(self) :
+		# arrange
+		app = ServerApp(auth=False, metrics=True)
+
+		@app.get('/metrics_test/{item}')
+		async def test_func(item: int) :
+			return { 'item': item }
+
+		client = TestClient(app, base_url=base_url)
+
+		# act
+		client.get(base_url + '/metrics_test/1')
+		client.get(base_url + '/metrics_test/2')
+		response = client.get(base_url + '/metrics')
+
+		# assert
+		assert 200 == response.status_code
+		assert response.headers['content-type'].startswith('text/plain')
+		assert 2 == request_latency.labels('GET', '/metrics_test/{item}', '200').count
+		assert 'kh_request_duration_seconds_count{method="GET",route="/metrics_test/{item}",status="200"} 2' in response.text
+		assert 'kh_requests_in_flight 0' in response.text
+
+
+	def test_ServerApp_MetricsUntrustedHost_Rejected(self) :
+		# arrange
+		app = ServerApp(auth=False, metrics=True)
+		client = TestClient(app, base_url=base_url)
+
+		# act
+		response = client.get('http://10.0.0.1/metrics')
+
+		# assert
+		assert 400 == response.status_code
+		assert 'kh_requests_in_flight' not in response.text
+
+
+	def test_ServerApp_MetricsWithAuth_ServedUnauthenticated(self) :
+		# arrange
+		app = ServerApp(auth=True, metrics=True)
+		client = TestClient(app, base_url=base_url)
+
+		# act
+		response = client.get(base_url + '/metrics')
+
+		# assert
+		assert 200 == response.status_code
+		assert 'kh_requests_in_flight' in response.text
@@ -1,20 +1,25 @@
 from kh_common.logging import LogHandler; LogHandler.logging_available = False
 from datetime import datetime, timezone
+from time import monotonic
 from uuid import uuid4
 
 import pytest
 from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.testclient import TestClient
 from pytest import raises
 
-from kh_common.auth import Scope
+from kh_common.auth import Scope, tokenFromHeaders
 from kh_common.caching.key_value_store import KeyValueStore
 from kh_common.config.repo import short_hash
 from kh_common.exceptions.http_error import BadRequest, Forbidden, Unauthorized
+from kh_common.gateway import request_deadline
 from kh_common.models.auth import AuthState, TokenMetadata
+from kh_common.server import ServerApp
 from kh_common.server.middleware import CustomHeaderMiddleware, HeadersToSet
 from kh_common.server.middleware.auth import KhAuthMiddleware
 from kh_common.server.middleware.cors import KhCorsMiddleware
+from kh_common.server.middleware.deadline import KhDeadlineMiddleware
 from kh_common.utilities.json import json_stream
 from tests.utilities.aerospike import AerospikeClient
 from tests.utilities.auth import expires, mock_pk, mock_token
@@ -257,6 +262,56 @@ class TestAuthMiddleware :
 			client.get('/', headers={ 'authorization': f'Bearer {token}' })
 
 
+
+	def test_AuthMiddleware_UnauthenticatedPath_VerificationSkipped(self, mocker) :
+
+		# arrange
+		verify = mocker.patch('kh_common.auth.verifyToken')
+
+		app = FastAPI()
+		app.add_middleware(KhAuthMiddleware, required=True, unauthenticated_paths=['/health'])
+
+		@app.get('/health')
+		async def app_func() :
+			return { 'success': True }
+
+		client = TestClient(app)
+
+		# act
+		result = client.get('/health', headers={ 'authorization': 'Bearer token' })
+
+		# assert
+		assert 200 == result.status_code
+		assert { 'success': True } == result.json()
+		verify.assert_not_called()
+
+
+	def test_TokenFromHeaders_CookieOnly_AuthCookieParsed(self) :
+
+		# act
+		result = tokenFromHeaders([(b'host', b'localhost'), (b'cookie', b'a=1; kh-auth="abc.def"; b=2')])
+
+		# assert
+		assert 'abc.def' == result
+
+
+	def test_TokenFromHeaders_HeaderAndCookie_HeaderPreferred(self) :
+
+		# act
+		result = tokenFromHeaders([(b'cookie', b'kh-auth=cookie'), (b'authorization', b'Bearer header')])
+
+		# assert
+		assert 'Bearer header' == result
+
+
+	def test_TokenFromHeaders_NoToken_ReturnsNone(self) :
+
+		# act
+		result = tokenFromHeaders([(b'cookie', b'not-kh-auth=cookie'), (b'authorization', b'')])
+
+		# assert
+		assert result is None
+
 class TestCorsMiddleware :
 
 	CorsHeaders = {
@@ -456,13 +511,79 @@ class TestCorsMiddleware :
 		assert 'false' == result.headers['access-control-allow-credentials']
 
 
+
+	def test_CorsMiddleware_WildcardSubdomain_Success(self) :
+
+		# arrange
+		app = FastAPI()
+		app.add_middleware(KhCorsMiddleware, allowed_origins={ '*.kheina.com' })
+
+		@app.get('/')
+		async def app_func(req: Request) :
+			return { 'success': True }
+
+		client = TestClient(app)
+
+		# act
+		result = client.get('/', headers={ 'origin': 'https://dev.kheina.com' })
+		apex = client.get('/', headers={ 'origin': 'https://kheina.com' })
+		lookalike = client.get('/', headers={ 'origin': 'https://evilkheina.com' })
+
+		# assert
+		assert 200 == result.status_code
+		assert 'https://dev.kheina.com' == result.headers['access-control-allow-origin']
+		assert 400 == apex.status_code
+		assert 400 == lookalike.status_code
+
+
+	def test_CorsMiddleware_Preflight_NoContent(self) :
+
+		# arrange
+		app = FastAPI()
+		app.add_middleware(KhCorsMiddleware, allowed_origins={ 'kheina.com' }, allowed_methods=['get'], max_age=123)
+
+		@app.get('/')
+		async def app_func(req: Request) :
+			return { 'success': True }
+
+		client = TestClient(app)
+
+		# act
+		result = client.options('/', headers={ 'origin': 'https://kheina.com', 'access-control-request-method': 'GET' })
+
+		# assert
+		assert 204 == result.status_code
+		assert self.CorsHeaders.issubset(result.headers.keys())
+		assert 'https://kheina.com' == result.headers['access-control-allow-origin']
+		assert 'GET' == result.headers['access-control-allow-methods']
+		assert '123' == result.headers['access-control-max-age']
+
+
+	def test_CorsMiddleware_OriginMatched_ResultMemoized(self) :
+
+		# arrange
+		middleware = KhCorsMiddleware(None, allowed_origins={ 'kheina.com' }, max_cached_origins=2)
+
+		# act
+		results = [
+			middleware.origin_allowed(b'https://kheina.com'),
+			middleware.origin_allowed(b'https://google.com'),
+			middleware.origin_allowed(b'https://kheina.com'),
+		]
+
+		# assert
+		assert [True, False, True] == results
+		assert 2 == len(middleware._origins)
+		assert middleware.origin_allowed(b'http://kheina.com') is False
+		assert 1 == len(middleware._origins)
+
 class TestCustomHeadersMiddleware :
 
 	def test_CustomHeadersMiddleware_ValidRequest_HeadersAccurate(self) :
 
 		# arrange
 		app = FastAPI()
-		app.middleware('http')(CustomHeaderMiddleware)
+		app.add_middleware(CustomHeaderMiddleware)
 
 		@app.get('/')
 		async def app_func(req: Request) :
@@ -483,7 +604,7 @@ class TestCustomHeadersMiddleware :
 
 		# arrange
 		app = FastAPI()
-		app.middleware('http')(CustomHeaderMiddleware)
+		app.add_middleware(CustomHeaderMiddleware)
 		HeadersToSet.clear()
 		HeadersToSet.update({
 			'kh-hash': short_hash,
@@ -504,3 +625,116 @@ class TestCustomHeadersMiddleware :
 		assert { 'success': True } == result.json()
 		assert short_hash == result.headers.get('kh-hash')
 		assert 'custom' == result.headers.get('kh-custom')
+
+
+	def test_CustomHeadersMiddleware_StreamingResponse_HeadersInjected(self) :
+
+		# arrange
+		app = FastAPI()
+		app.add_middleware(CustomHeaderMiddleware, headers={ 'kh-hash': short_hash })
+
+		@app.get('/')
+		async def app_func(req: Request) :
+			return StreamingResponse(iter([b'a', b'b', b'c']))
+
+		client = TestClient(app)
+
+		# act
+		result = client.get('/')
+
+		# assert
+		assert 200 == result.status_code
+		assert b'abc' == result.content
+		assert short_hash == result.headers['kh-hash']
+
+
+	def test_CustomHeadersMiddleware_HeaderSetByApp_HeaderReplaced(self) :
+
+		# arrange
+		app = FastAPI()
+		app.add_middleware(CustomHeaderMiddleware, headers={ 'kh-hash': short_hash })
+
+		@app.get('/')
+		async def app_func(req: Request) :
+			return Response(b'', headers={ 'kh-hash': 'app' })
+
+		client = TestClient(app)
+
+		# act
+		result = client.get('/')
+
+		# assert
+		assert 200 == result.status_code
+		assert [short_hash] == result.headers.get_list('kh-hash')
+
+
+class TestDeadlineMiddleware :
+
+	def create_app(self) -> FastAPI :
+		app = FastAPI()
+		app.add_middleware(KhDeadlineMiddleware)
+
+		@app.get('/')
+		async def app_func(req: Request) :
+			deadline = request_deadline.get()
+			return { 'remaining': deadline - monotonic() if deadline else None }
+
+		return app
+
+
+	def test_DeadlineMiddleware_DeadlineHeader_DeadlineApplied(self) :
+		# arrange
+		client = TestClient(self.create_app())
+
+		# act
+		result = client.get('/', headers={ 'x-request-deadline': '2.5' })
+
+		# assert
+		assert 200 == result.status_code
+		assert 0 < result.json()['remaining'] <= 2.5
+
+
+	def test_DeadlineMiddleware_LongDeadline_ClampedToMax(self) :
+		# arrange
+		client = TestClient(self.create_app())
+
+		# act
+		result = client.get('/', headers={ 'x-request-deadline': '86400' })
+
+		# assert
+		assert 200 == result.status_code
+		assert 0 < result.json()['remaining'] <= 30
+
+
+	@pytest.mark.parametrize(
+		"headers",
+		[{ }, { 'x-request-deadline': 'abc' }, { 'x-request-deadline': '0' }, { 'x-request-deadline': '-1' }, { 'x-request-deadline': 'nan' }, { 'x-request-deadline': 'inf' }],
+	)
+	def test_DeadlineMiddleware_NoValidHeader_NoDeadline(self, headers) :
+		# arrange
+		client = TestClient(self.create_app())
+
+		# act
+		result = client.get('/', headers=headers)
+
+		# assert
+		assert 200 == result.status_code
+		assert { 'remaining': None } == result.json()
+
+
+	def test_ServerApp_Default_DeadlineHeaderIgnored(self) :
+		# arrange
+		app = ServerApp(auth=False, custom_headers=False, cors=False)
+
+		@app.get('/')
+		async def app_func() :
+			return { 'deadline': request_deadline.get() }
+
+		client = TestClient(app, base_url='https://localhost')
+
+		# act
+		result = client.get('/', headers={ 'x-request-deadline': '0.001' })
+
+		# assert
+		assert 200 == result.status_code
+		assert { 'deadline': None } == result.json()
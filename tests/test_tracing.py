@@ -0,0 +1,145 @@
+from kh_common.logging import LogHandler; LogHandler.logging_available = False
+import json
+from tempfile import NamedTemporaryFile
+from threading import current_thread
+
+from fastapi.testclient import TestClient
+
+from kh_common.server import ServerApp
+from kh_common.tracing import OTLPFileCollector, TraceCollector, current_span, end_trace, server_timing, span, start_trace, trace_id
+
+
+base_url = 'https://dev.fuzz.ly'
+
+
+class TestTracing :
+
+	def test_Span_NoTrace_DoesNothing(self) :
+		# act
+		with span('sql') as s :
+			pass
+
+		# assert
+		assert s is None
+		assert trace_id() is None
+
+
+	def test_Span_NestedSpans_ChildrenRecorded(self) :
+		# arrange
+		root, token = start_trace('request')
+
+		# act
+		with span('auth') as auth :
+			with span('aerospike') as aerospike :
+				assert trace_id() == root.trace_id
+				assert current_span() is aerospike
+
+		with span('sql') :
+			pass
+
+		end_trace(root, token)
+
+		# assert
+		assert trace_id() is None
+		assert ['request', 'auth', 'aerospike', 'sql'] == [s.name for s in root.walk()]
+		assert aerospike.parent_id == auth.span_id
+		assert auth.parent_id == root.span_id
+		assert all(s.duration is not None for s in root.walk())
+
+
+	def test_StartTrace_TraceParent_TraceContinued(self) :
+		# arrange
+		traceparent = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+
+		# act
+		root, token = start_trace('request', traceparent)
+		end_trace(root, token)
+
+		# assert
+		assert '0af7651916cd43dd8448eb211c80319c' == root.trace_id
+		assert 'b7ad6b7169203331' == root.parent_id
+
+
+	def test_ServerTiming_ChildSpans_SummedByName(self) :
+		# arrange
+		root, token = start_trace('request')
+
+		for _ in range(2) :
+			with span('sql') :
+				pass
+
+		end_trace(root, token)
+
+		# act
+		result = server_timing(root)
+
+		# assert
+		assert ['sql', 'app'] == [entry.split(';')[0] for entry in result.split(', ')]
+
+
+	def test_OTLPFileCollector_Export_SpansWritten(self) :
+		# arrange
+		with NamedTemporaryFile('r') as file :
+			collector = OTLPFileCollector(file.name, 'test')
+			root, token = start_trace('request')
+
+			with span('sql') :
+				pass
+
+			end_trace(root, token)
+
+			# act
+			collector.export(root)
+			collector.flush()
+
+			# assert
+			spans = json.loads(file.read())['resourceSpans'][0]['scopeSpans'][0]['spans']
+			assert ['request', 'sql'] == [s['name'] for s in spans]
+			assert spans[1]['parentSpanId'] == spans[0]['spanId']
+			assert all(s['traceId'] == root.trace_id for s in spans)
+			collector.close()
+
+
+	def test_OTLPFileCollector_Export_WrittenInBackground(self) :
+		# arrange
+		with NamedTemporaryFile('r') as file :
+			collector = OTLPFileCollector(file.name, 'test', flush_interval=0.01)
+			root, token = start_trace('request')
+			end_trace(root, token)
+			threads = []
+			write = collector._write
+			collector._write = lambda roots : threads.append(current_thread()) or write(roots)
+
+			# act
+			collector.export(root)
+			collector.export(root)
+			collector.close()
+
+			# assert
+			assert threads and current_thread() not in threads
+			assert 2 == len(file.read().splitlines())
+
+
+	def test_ServerApp_Tracing_ServerTimingHeaderAndTraceExported(self) :
+		# arrange
+		collector = TraceCollector()
+		app = ServerApp(auth=False, tracing=True, trace_collector=collector)
+
+		@app.get('/')
+		async def test_func() :
+			with span('sql') :
+				pass
+			return { 'trace_id': trace_id() }
+
+		client = TestClient(app, base_url=base_url)
+
+		# act
+		response = client.get(base_url + '/')
+
+		# assert
+		assert 200 == response.status_code
+		assert 'sql;dur=' in response.headers['server-timing']
+		assert 1 == len(collector.traces)
+		assert response.json()['trace_id'] == collector.traces[0].trace_id
+		assert 200 == collector.traces[0].attributes['status']
+		assert 'sql' in [s.name for s in collector.traces[0].walk()]
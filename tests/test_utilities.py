@@ -1,12 +1,15 @@
+import json
 from datetime import datetime, timezone
 from enum import Enum
 from os import getpid, kill
 from signal import SIGTERM
 from uuid import uuid4
 
+import pytest
+
 from kh_common.auth import AuthToken, KhUser, Scope
 from kh_common.utilities import int_from_bytes, int_to_bytes
-from kh_common.utilities.json import json_stream
+from kh_common.utilities.json import JsonArrayDecoder, json_default, json_dumps, json_stream
 from kh_common.utilities.signal import Terminated
 
 
@@ -47,6 +50,149 @@ class TestJson :
 		assert expected == result
 
 
+	def test_JsonStream_StrEnum_ReturnedAsIs(self) :
+		# arrange
+		class StrEnum(str, Enum) :
+			value: str = 'value'
+
+		# act
+		result = json_stream([StrEnum.value, AnEnum.value_b])
+
+		# assert
+		assert ['value', 'value_b'] == result
+
+
+	def test_JsonDumps(self) :
+		# arrange
+		date = datetime.now(timezone.utc)
+		guid = uuid4()
+		user = KhUser(3, AuthToken(3, date, guid, { 'some': 'data' }, 'token'), set([Scope.user]))
+		data = (1, '2', date, (1, 2), { 'a': 1, 'b': (2,), 3: 4 }, { 1, 2, 3 }, AnEnum.value_a, user)
+		expected = [1, '2', str(date), [1, 2], { 'a': 1, 'b': [2], '3': 4 }, [1, 2, 3], 'value_a', { 'user_id': 3, 'scope': ['user'], 'token': { 'expires': str(date), 'guid': guid.hex, 'data': { 'some': 'data' } } }]
+
+		# act
+		result = json_dumps(data)
+
+		# assert
+		assert json.loads(result) == expected
+
+
+	def test_JsonDumps_NestedKhUser_Converted(self) :
+		# arrange
+		user = KhUser(3, None, set())
+		data = { 'users': [{ 'user': user }], 'unchanged': [1, 2] }
+
+		# act
+		result = json_dumps(data)
+
+		# assert
+		assert { 'users': [{ 'user': { 'user_id': 3, 'scope': [], 'token': None } }], 'unchanged': [1, 2] } == json.loads(result)
+
+
+	def test_JsonDumps_Paths_SlashesNotEscaped(self) :
+		# act
+		result = json_dumps({ 'path': '/root/package/kh_common', 'url': 'https://fuzz.ly/' })
+
+		# assert
+		assert b'{"path":"/root/package/kh_common","url":"https://fuzz.ly/"}' == result
+
+
+	def test_JsonDefault_KhUser(self) :
+		# arrange
+		date = datetime.now(timezone.utc)
+		guid = uuid4()
+		user = KhUser(3, AuthToken(3, date, guid, { 'some': 'data' }, 'token'), set([Scope.user]))
+
+		# act
+		result = json_default(user)
+
+		# assert
+		assert { 'user_id': 3, 'scope': { Scope.user }, 'token': { 'expires': date, 'guid': guid, 'data': { 'some': 'data' } } } == result
+
+
+	@pytest.mark.parametrize(
+		"chunk_size",
+		[1, 3, 7, 4096],
+	)
+	def test_JsonArrayDecoder_ChunkedArray_ItemsDecodedIncrementally(self, chunk_size: int) :
+		# arrange
+		data = [{ 'a': 'quoted \\"], {', 'b': [1, { 'c': 2 }] }, 1, 's,]', None, [3, 4], { }, 'unicode ✓']
+		document = json.dumps(data, ensure_ascii=False).encode()
+		decoder = JsonArrayDecoder()
+		result = []
+
+		# act
+		for i in range(0, len(document), chunk_size) :
+			result += decoder.feed(document[i:i + chunk_size])
+
+		decoder.close()
+
+		# assert
+		assert result == data
+
+
+	def test_JsonArrayDecoder_ItemCompleted_ReturnedBeforeArrayEnds(self) :
+		# arrange
+		decoder = JsonArrayDecoder()
+
+		# act
+		first = decoder.feed(b'[{"a": 1}, {"b"')
+		second = decoder.feed(b': 2}]')
+
+		# assert
+		assert first == [{ 'a': 1 }]
+		assert second == [{ 'b': 2 }]
+
+
+	@pytest.mark.parametrize(
+		"document",
+		[b'{"a": 1}', b'1, [2]', b'[1] [2]', b'[,1]', b'[1,]', b'[1,,2]', b'[1] x'],
+	)
+	def test_JsonArrayDecoder_NotAnArray_RaisesValueError(self, document: bytes) :
+		# arrange
+		decoder = JsonArrayDecoder()
+
+		# act & assert
+		with pytest.raises(ValueError) :
+			decoder.feed(document)
+
+
+	def test_JsonArrayDecoder_IncompleteArray_CloseRaisesValueError(self) :
+		# arrange
+		decoder = JsonArrayDecoder()
+		decoder.feed(b'[1, 2')
+
+		# act & assert
+		with pytest.raises(ValueError) :
+			decoder.close()
+
+
+	@pytest.mark.parametrize(
+		"document",
+		[b'[]', b' [ ] ', b'[1]\n'],
+	)
+	def test_JsonArrayDecoder_OnlyWhitespaceAroundArray_Decoded(self, document: bytes) :
+		# arrange
+		decoder = JsonArrayDecoder()
+
+		# act
+		result = decoder.feed(document)
+		decoder.close()
+
+		# assert
+		assert result == json.loads(document)
+
+
+	def test_JsonArrayDecoder_DataAfterArrayInLaterChunk_RaisesValueError(self) :
+		# arrange
+		decoder = JsonArrayDecoder()
+		decoder.feed(b'[1] ')
+
+		# act & assert
+		with pytest.raises(ValueError) :
+			decoder.feed(b'x ')
+
+
 class TestTerminated :
 
 	def test_TerminatedHandlesSigterm(self) :
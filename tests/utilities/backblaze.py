@@ -0,0 +1,244 @@
+from hashlib import sha1
+from itertools import count
+from typing import Any, Dict, List, Optional
+from urllib.parse import unquote
+
+from aiohttp.test_utils import TestServer
+from aiohttp.web import Application, Request, Response, json_response
+
+from kh_common.backblaze import B2Interface
+from kh_common.gateway import close_sessions
+
+
+class B2Server :
+	"""
+	in-memory stand-in for the parts of the b2 api used by B2Interface, served from an aiohttp TestServer.
+	fail maps a call name to how many of its next requests fail with fail_status.
+	"""
+
+	def __init__(self: 'B2Server') -> None :
+		# filename -> versions, oldest first
+		self.files: Dict[str, List[Dict[str, Any]]] = { }
+		self.large: Dict[str, Dict[str, Any]] = { }
+		self.calls: List[str] = []
+		self.fail: Dict[str, int] = { }
+		self.fail_status: int = 503
+		self.token: str = 'token-1'
+		self.upload_urls: int = 0
+		self._ids = count(1)
+		self.server: TestServer = None
+
+
+	async def __aenter__(self: 'B2Server') -> 'B2Server' :
+		app: Application = Application(client_max_size=1024 ** 3)
+		app.router.add_get('/b2api/v2/b2_authorize_account', self._authorize)
+		app.router.add_get('/b2api/v2/b2_download_file_by_id', self._download)
+		app.router.add_post('/b2api/v2/{call}', self._api)
+		app.router.add_post('/upload', self._upload)
+		app.router.add_post('/upload_part/{file_id}', self._upload_part)
+		app.router.add_get('/file/bucket/{name:.+}', self._download)
+		self.server = TestServer(app)
+		await self.server.start_server()
+		return self
+
+
+	async def __aexit__(self: 'B2Server', *exc: Any) -> None :
+		await self.server.close()
+		await close_sessions()
+
+
+	def url(self: 'B2Server') -> str :
+		return str(self.server.make_url('')).rstrip('/')
+
+
+	def authorization(self: 'B2Server') -> Dict[str, Any] :
+		return {
+			'apiUrl': self.url(),
+			'authorizationToken': self.token,
+			'allowed': { 'bucketId': 'bucket', 'bucketName': 'bucket' },
+			'downloadUrl': self.url(),
+		}
+
+
+	def store(self: 'B2Server', filename: str, data: bytes, content_sha1: Optional[str] = None, file_id: Optional[str] = None, content_type: str = 'application/octet-stream') -> Dict[str, Any] :
+		version: Dict[str, Any] = {
+			'fileId': file_id or f'file-{next(self._ids)}',
+			'fileName': filename,
+			'contentType': content_type,
+			'contentSha1': sha1(data).hexdigest() if content_sha1 is None else content_sha1,
+			'contentLength': len(data),
+			'data': data,
+		}
+		self.files.setdefault(filename, []).append(version)
+		return self._info(version)
+
+
+	def _info(self: 'B2Server', version: Dict[str, Any]) -> Dict[str, Any] :
+		return { k: v for k, v in version.items() if k != 'data' }
+
+
+	def _check(self: 'B2Server', request: Request, call: str) -> Optional[Response] :
+		self.calls.append(call)
+
+		if self.fail.get(call) :
+			self.fail[call] -= 1
+			# retry immediately, rather than after B2Interface's one second backoff
+			return json_response({ 'code': 'service_unavailable' }, status=self.fail_status, headers={ 'retry-after': '0' })
+
+		authorization: str = request.headers.get('authorization', '')
+
+		if authorization != self.token and not authorization.startswith('upload-') :
+			return json_response({ 'code': 'expired_auth_token' }, status=401)
+
+
+	async def _authorize(self: 'B2Server', request: Request) -> Response :
+		self.calls.append('b2_authorize_account')
+		return json_response(self.authorization())
+
+
+	async def _api(self: 'B2Server', request: Request) -> Response :
+		call: str = request.match_info['call']
+		error: Optional[Response] = self._check(request, call)
+
+		if error :
+			return error
+
+		body: Dict[str, Any] = await request.json()
+
+		if call in { 'b2_get_upload_url', 'b2_get_upload_part_url' } :
+			self.upload_urls += 1
+			path: str = '/upload' if call == 'b2_get_upload_url' else '/upload_part/' + body['fileId']
+			return json_response({ 'uploadUrl': self.url() + path, 'authorizationToken': f'upload-{self.upload_urls}' })
+
+		if call == 'b2_start_large_file' :
+			file_id: str = f'large-{next(self._ids)}'
+			self.large[file_id] = { 'fileName': body['fileName'], 'contentType': body['contentType'], 'parts': { } }
+			return json_response({ 'fileId': file_id })
+
+		if call == 'b2_finish_large_file' :
+			large: Dict[str, Any] = self.large.pop(body['fileId'])
+			parts: List[bytes] = [large['parts'][i] for i in range(1, len(large['parts']) + 1)]
+
+			if [sha1(part).hexdigest() for part in parts] != body['partSha1Array'] :
+				return json_response({ 'code': 'bad_request' }, status=400)
+
+			return json_response(self.store(large['fileName'], b''.join(parts), 'none', body['fileId'], large['contentType']))
+
+		if call == 'b2_cancel_large_file' :
+			self.large.pop(body['fileId'], None)
+			return json_response({ 'fileId': body['fileId'] })
+
+		if call in { 'b2_list_file_names', 'b2_list_file_versions' } :
+			entries: List[Dict[str, Any]] = []
+
+			for filename in sorted(self.files) :
+				if filename >= body.get('startFileName', '') and filename.startswith(body.get('prefix', '')) :
+					# b2 lists versions newest first
+					entries += list(reversed(self.files[filename])) if call == 'b2_list_file_versions' else self.files[filename][-1:]
+
+			file_ids: List[str] = [entry['fileId'] for entry in entries]
+
+			if body.get('startFileId') in file_ids :
+				entries = entries[file_ids.index(body['startFileId']):]
+
+			page: int = body.get('maxFileCount', 100)
+			following: Optional[Dict[str, Any]] = entries[page] if len(entries) > page else None
+			return json_response({
+				'files': [self._info(entry) for entry in entries[:page]],
+				'nextFileName': following and following['fileName'],
+				'nextFileId': following and following['fileId'],
+			})
+
+		if call == 'b2_delete_file_version' :
+			self.files[body['fileName']] = [v for v in self.files.get(body['fileName'], []) if v['fileId'] != body['fileId']]
+
+			if not self.files[body['fileName']] :
+				del self.files[body['fileName']]
+
+			return json_response({ 'fileId': body['fileId'], 'fileName': body['fileName'] })
+
+		return json_response({ 'code': 'bad_request' }, status=400)
+
+
+	def _body(self: 'B2Server', request: Request, data: bytes) -> Optional[bytes] :
+		content_sha1: str = request.headers['x-bz-content-sha1']
+
+		if content_sha1 == 'hex_digits_at_end' :
+			data, content_sha1 = data[:-40], data[-40:].decode()
+
+		return data if sha1(data).hexdigest() == content_sha1 else None
+
+
+	async def _upload(self: 'B2Server', request: Request) -> Response :
+		error: Optional[Response] = self._check(request, 'upload')
+
+		if error :
+			return error
+
+		raw: bytes = await request.read()
+		data: Optional[bytes] = self._body(request, raw)
+
+		if int(request.headers['content-length']) != len(raw) or data is None :
+			return json_response({ 'code': 'bad_request', 'message': 'sha1 did not match data received' }, status=400)
+
+		return json_response(self.store(unquote(request.headers['x-bz-file-name']), data, content_type=request.headers['content-type']))
+
+
+	async def _upload_part(self: 'B2Server', request: Request) -> Response :
+		error: Optional[Response] = self._check(request, 'upload_part')
+
+		if error :
+			return error
+
+		data: Optional[bytes] = self._body(request, await request.read())
+
+		if data is None :
+			return json_response({ 'code': 'bad_request', 'message': 'sha1 did not match data received' }, status=400)
+
+		part_number: int = int(request.headers['x-bz-part-number'])
+		self.large[request.match_info['file_id']]['parts'][part_number] = data
+		return json_response({ 'contentSha1': sha1(data).hexdigest(), 'partNumber': part_number })
+
+
+	async def _download(self: 'B2Server', request: Request) -> Response :
+		error: Optional[Response] = self._check(request, 'download')
+
+		if error :
+			return error
+
+		if 'fileId' in request.query :
+			version: Dict[str, Any] = next(v for versions in self.files.values() for v in versions if v['fileId'] == request.query['fileId'])
+
+		elif request.match_info['name'] in self.files :
+			version = self.files[request.match_info['name']][-1]
+
+		else :
+			return json_response({ 'code': 'not_found' }, status=404)
+
+		data: bytes = version['data']
+		headers: Dict[str, str] = {
+			'x-bz-content-sha1': version['contentSha1'],
+			'x-bz-file-id': version['fileId'],
+			'content-type': version['contentType'],
+		}
+
+		if 'range' in request.headers :
+			start, end = map(int, request.headers['range'].split('=')[1].split('-'))
+			end = min(end, len(data) - 1)
+			headers['content-range'] = f'bytes {start}-{end}/{len(data)}'
+			return Response(body=data[start:end + 1], status=206, headers=headers)
+
+		if request.method == 'HEAD' :
+			headers['content-length'] = str(len(data))
+			return Response(headers=headers)
+
+		return Response(body=data, headers=headers)
+
+
+def create_b2(server: B2Server, mocker: Any, **kwargs: Any) -> B2Interface :
+	"""
+	creates a B2Interface authorized against server. the initial authorization is blocking, so it's skipped rather than sent to a server on the same event loop
+	"""
+	mocker.patch('kh_common.backblaze.AuthorizeAccountUrl', server.url() + '/b2api/v2/b2_authorize_account')
+	mocker.patch.object(B2Interface, '_b2_authorize', lambda self : self._set_authorization(server.authorization()))
+	return B2Interface(**kwargs)